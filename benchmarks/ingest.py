@@ -0,0 +1,66 @@
+"""
+Parse step of collector ingest path (LogsCollectorView): messages per second on one core.
+Compares pydantic validation of messages with lightweight records (fspy.common.records).
+
+Usage: python -m benchmarks.ingest [--entries 10 100 1000] [--depth 3] [--duration 1]
+"""
+import argparse
+import json
+import time
+
+from benchmarks.protocol import create_chunk
+from fspy.collector.decoding import parse_diff_message
+from fspy.common import protocol
+from fspy.common.model import DiffChunk
+
+
+def messages_per_second(fn, data, duration: float) -> float:
+    count = 0
+    start = time.perf_counter()
+
+    while True:
+        for _ in range(10):
+            fn(data)
+        count += 10
+
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def run(name: str, fn, data, entries: int, duration: float, baseline: float = None) -> float:
+    rate = messages_per_second(fn, data, duration)
+    speedup = f"  x{rate / baseline:.1f}" if baseline else ""
+
+    print(f"{name:<32} entries: {entries:<6} messages/s: {rate:10.0f}  entries/s: {rate * entries:11.0f}{speedup}")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser("FSPY collector ingest parse benchmark")
+    parser.add_argument("--entries", type=int, nargs="+", default=[10, 100, 1000],
+                        help="Changed files in diff chunk")
+    parser.add_argument("--depth", type=int, default=3, help="Directory levels between target and files")
+    parser.add_argument("--duration", type=float, default=1, help="Seconds to run each case")
+
+    args = parser.parse_args()
+
+    for entries in args.entries:
+        chunk = create_chunk(entries, args.depth)
+        params = dict(entries=entries, duration=args.duration)
+
+        json_data = chunk.json()
+        baseline = run("json pydantic", lambda data: DiffChunk(**json.loads(data)), json_data, **params)
+        run("json records", lambda data: parse_diff_message(data, protocol.JSON_PROTOCOL, "benchmark"), json_data,
+            baseline=baseline, **params)
+
+        version = protocol.BINARY_PROTOCOL_V4
+        binary_data = protocol.encode_diff_chunk(chunk, version)
+        baseline = run(f"{version} pydantic models", lambda data: protocol.decode_diff_chunk(data, version),
+                       binary_data, **params)
+        run(f"{version} records", lambda data: parse_diff_message(data, version, "benchmark"), binary_data,
+            baseline=baseline, **params)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Compares wire protocols of agent -> collector connection: size and encode / decode time of diff chunk.
+Compression trades CPU time for bandwidth: "link" is transfer time of message over link of --bandwidth Mbit/s,
+ "total" - CPU time of both ends plus transfer time.
+
+Usage: python -m benchmarks.protocol [--entries 1000] [--depth 3] [--bandwidth 10] [--repeat 5]
+"""
+import argparse
+import hashlib
+import json
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import pytz
+
+from fspy.common import protocol
+from fspy.common.model import DiffChunk, FullDiff, FileState, FileDiff
+
+
+def create_chunk(entries: int, depth: int) -> DiffChunk:
+    now = datetime.now(pytz.utc)
+    deep_dir = "".join(f"/nested_directory_{level}" for level in range(depth))
+
+    def file_state(i: int, size: int) -> FileState:
+        return FileState(
+            path=f"/var/log/app{deep_dir}/dir_{i // 100}/file_{i}.log",
+            date_created=now - timedelta(days=1),
+            date_updated=now,
+            size=size,
+            content_hash=hashlib.sha1(str(i).encode()).hexdigest(),
+        )
+
+    third = entries // 3
+    return DiffChunk(
+        source_name="benchmark",
+        scan_id="0123456789abcdef0123456789abcdef",
+        chunk_index=0,
+        last=True,
+        # Required by sequenced protocol
+        seq=0,
+        diff=FullDiff(
+            run_start=now,
+            run_end=now,
+            created=[file_state(i, 100) for i in range(third)],
+            deleted=[file_state(i, 100) for i in range(third, 2 * third)],
+            updated=[FileDiff(before=file_state(i, 100), after=file_state(i, 200))
+                     for i in range(2 * third, entries)],
+        ),
+    )
+
+
+def best_time(fn, repeat: int) -> float:
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def deflate(data: bytes) -> bytes:
+    """Same as permessage-deflate of aiohttp (default level, raw deflate stream)"""
+    compressor = zlib.compressobj(wbits=-15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def inflate(data: bytes) -> bytes:
+    return zlib.decompressobj(wbits=-15).decompress(data)
+
+
+def run_protocol(name: str, encode, decode, chunk: DiffChunk, entries: int, repeat: int, bandwidth: float):
+    data = encode(chunk)
+    encode_time = best_time(lambda: encode(chunk), repeat)
+    decode_time = best_time(lambda: decode(data), repeat)
+    link_time = len(data) * 8 / (bandwidth * 1e6)
+
+    print(f"{name:<24} bytes: {len(data):<8} per entry: {len(data) / entries:6.1f}  "
+          f"encode: {encode_time * 1000:7.1f} ms  decode: {decode_time * 1000:7.1f} ms  "
+          f"link: {link_time * 1000:7.1f} ms  total: {(encode_time + decode_time + link_time) * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser("FSPY wire protocol benchmark")
+    parser.add_argument("--entries", type=int, default=1000, help="Changed files in diff chunk")
+    parser.add_argument("--depth", type=int, default=3, help="Directory levels between target and files")
+    parser.add_argument("--bandwidth", type=float, default=10, help="Link bandwidth (Mbit/s)")
+    parser.add_argument("--repeat", type=int, default=5)
+
+    args = parser.parse_args()
+
+    chunk = create_chunk(args.entries, args.depth)
+    params = dict(chunk=chunk, entries=args.entries, repeat=args.repeat, bandwidth=args.bandwidth)
+
+    run_protocol(
+        protocol.JSON_PROTOCOL,
+        lambda c: c.json().encode(),
+        lambda data: DiffChunk(**json.loads(data)),
+        **params
+    )
+    run_protocol(
+        f"{protocol.JSON_PROTOCOL} deflate",
+        lambda c: deflate(c.json().encode()),
+        lambda data: DiffChunk(**json.loads(inflate(data))),
+        **params
+    )
+
+    for version in reversed(protocol.BINARY_PROTOCOLS):
+        run_protocol(
+            version,
+            lambda c: protocol.encode_diff_chunk(c, version),
+            lambda data: protocol.decode_diff_chunk(data, version),
+            **params
+        )
+
+    v3 = protocol.BINARY_PROTOCOL_V3
+
+    run_protocol(
+        f"{v3} deflate",
+        lambda c: deflate(protocol.encode_diff_chunk(c, v3)),
+        lambda data: protocol.decode_diff_chunk(inflate(data), v3),
+        **params
+    )
+
+    for level in (1, 6, 9):
+        run_protocol(
+            f"{v3} zlib level {level}",
+            lambda c: protocol.encode_diff_chunk(c, v3, compress_threshold=0, compress_level=level),
+            lambda data: protocol.decode_diff_chunk(data, v3),
+            **params
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Ingest throughput of collector writing thread while report queries run concurrently.
+
+Writer saves small reports in group-committed transactions (as writing thread does) for --duration seconds,
+ while --readers threads repeatedly read all file diffs ordered by time (as /flat_report does) through
+ read-only engine. With rollback journal readers lock writer out, with WAL it is not blocked.
+Readers are CPU-bound, so with fewer cores than threads writer also gets only its share of CPU.
+
+Usage: python -m benchmarks.report_contention [--rows 200000] [--readers 2] [--duration 5]
+"""
+import argparse
+import tempfile
+import threading
+import time
+from os import path
+
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from benchmarks.storage import create_report
+from fspy.collector import db
+from fspy.collector.storage import create_write_engine, create_read_engine
+
+
+def read_reports(engine, stop: threading.Event, counts: list):
+    file_diffs = db.FileDiff.__table__
+    diff_reports = db.DiffReport.__table__
+
+    query = select([diff_reports.c.source_name, file_diffs.c.file_path, file_diffs.c.operation,
+                    file_diffs.c.operation_time]).select_from(
+        file_diffs.join(diff_reports, file_diffs.c.diff_report_id == diff_reports.c.id)
+    ).order_by(file_diffs.c.operation_time)
+
+    while not stop.is_set():
+        with engine.connect() as connection:
+            for _ in connection.execute(query):
+                pass
+        counts.append(1)
+
+
+def run_case(name: str, db_path: str, wal: bool, readers: int, duration: float, batch_size: int, report):
+    write_engine = create_write_engine(db_path, wal=wal)
+    read_engine = create_read_engine(db_path, pool_size=max(readers, 1))
+
+    stop = threading.Event()
+    reports_done = []
+    threads = [threading.Thread(target=read_reports, args=(read_engine, stop, reports_done)) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+
+    saved = 0
+    failed = 0
+    start = time.perf_counter()
+
+    while time.perf_counter() - start < duration:
+        session = Session(bind=write_engine)
+        try:
+            for _ in range(batch_size):
+                db.insert_diff_report(session, report)
+            session.commit()
+            saved += batch_size
+        except OperationalError:
+            session.rollback()
+            failed += batch_size
+        finally:
+            session.close()
+
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    read_engine.dispose()
+    write_engine.dispose()
+
+    print(f"{name:<10} readers: {readers}  reports/s: {saved / elapsed:8.0f}  failed (locked): {failed:<6} "
+          f"report queries: {len(reports_done)}")
+
+
+def main():
+    parser = argparse.ArgumentParser("FSPY collector report contention benchmark")
+    parser.add_argument("--rows", type=int, default=200000, help="File diffs in DB before run")
+    parser.add_argument("--readers", type=int, default=2, help="Threads running report queries")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds to run each case")
+    parser.add_argument("--batch_size", type=int, default=10, help="Reports saved in one transaction")
+
+    args = parser.parse_args()
+
+    report = create_report(10)
+    big_report = create_report(10000)
+
+    for wal in (False, True):
+        name = "wal" if wal else "rollback"
+
+        with tempfile.TemporaryDirectory(prefix="fspy-benchmark") as temp_dir:
+            db_path = path.join(temp_dir, "benchmark.sqlite")
+
+            engine = create_write_engine(db_path, wal=wal)
+            db.Base.metadata.create_all(engine)
+            session = Session(bind=engine)
+            for _ in range(max(args.rows // 10000, 1)):
+                db.insert_diff_report(session, big_report)
+            session.commit()
+            session.close()
+            engine.dispose()
+
+            for readers in (0, args.readers):
+                run_case(name, db_path, wal, readers, args.duration, args.batch_size, report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Compares snapshot engines of the agent scanner.
+
+Usage: python -m benchmarks.scanner [--dirs 200] [--files_per_dir 100] [--repeat 5] [--workers 8] [--target DIR]
+"""
+import argparse
+import os
+import tempfile
+import time
+from os import path
+from concurrent.futures import ThreadPoolExecutor
+
+from fspy.agent import scanner, snapshot
+
+
+def create_tree(base_dir: str, dirs: int, files_per_dir: int):
+    for d in range(dirs):
+        # Two levels of nesting to get more realistic path lengths
+        dir_path = path.join(base_dir, f"level_{d % 10}", f"dir_{d}")
+        os.makedirs(dir_path)
+
+        for f in range(files_per_dir):
+            with open(path.join(dir_path, f"file_{f}.log"), "wb") as out_file:
+                out_file.write(b"\0" * (f % 64))
+
+    # Move directories mtime out of racy window, so incremental scans can trust them
+    an_hour_ago = time.time() - 3600
+    for dir_path, _, _ in os.walk(base_dir):
+        os.utime(dir_path, (an_hour_ago, an_hour_ago))
+
+
+def run_engine(name: str, fn, target: str, repeat: int):
+    timings = []
+    files_count = 0
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        files_count = len(fn(target))
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    print(f"{name:<18} files: {files_count:<10} best: {best * 1000:9.1f} ms  "
+          f"per file: {best / max(files_count, 1) * 1e6:6.2f} us")
+
+
+def run_rescan(name: str, comparator: scanner.SimpleComparator, repeat: int):
+    """Measures scans of idle tree after the initial one"""
+    comparator.scan()
+    run_engine(name, lambda _: comparator.get_snapshot(), None, repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser("FSPY scanner benchmark")
+    parser.add_argument("--target", type=str, help="Existing directory to scan instead of generated one")
+    parser.add_argument("--dirs", type=int, default=200)
+    parser.add_argument("--files_per_dir", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=8, help="Threads for parallel traversal")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="fspy-bench") as tmp_dir:
+        target = args.target
+
+        if target is None:
+            target = tmp_dir
+            create_tree(target, args.dirs, args.files_per_dir)
+
+        run_engine("walk", scanner.walk_snapshot, target, args.repeat)
+        run_engine("scandir", scanner.scandir_snapshot, target, args.repeat)
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            run_engine(f"parallel[{args.workers}]",
+                       lambda t: scanner.parallel_scandir_snapshot(t, executor), target, args.repeat)
+
+        run_rescan("incremental", scanner.SimpleComparator(target, incremental=True), args.repeat)
+        run_rescan("fast_incremental", scanner.SimpleComparator(target, fast=True), args.repeat)
+
+        # Agent restart with persisted baseline instead of full rescan
+        with tempfile.TemporaryDirectory(prefix="fspy-bench") as state_dir:
+            snapshot_path = path.join(state_dir, "snapshot.bin")
+            snapshot.save_snapshot(scanner.scandir_snapshot(target), snapshot_path, target)
+
+            run_engine("snapshot_load", lambda t: snapshot.load_snapshot(snapshot_path, t), target, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
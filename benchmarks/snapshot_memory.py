@@ -0,0 +1,50 @@
+"""
+Compares memory per file of dict-of-FileState snapshot and compact Snapshot.
+
+Usage: python -m benchmarks.snapshot_memory [--dirs 200] [--files_per_dir 100] [--target DIR]
+"""
+import argparse
+import gc
+import tempfile
+import tracemalloc
+
+from benchmarks.scanner import create_tree
+from fspy.agent import scanner
+
+
+def measure(name: str, fn, target: str):
+    gc.collect()
+    tracemalloc.start()
+
+    result = fn(target)
+
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    files_count = len(result)
+    print(f"{name:<10} files: {files_count:<10} total: {allocated / 2 ** 20:8.1f} MiB  "
+          f"per file: {allocated / max(files_count, 1):7.1f} B")
+
+
+def main():
+    parser = argparse.ArgumentParser("FSPY snapshot memory benchmark")
+    parser.add_argument("--target", type=str, help="Existing directory to scan instead of generated one")
+    parser.add_argument("--dirs", type=int, default=200)
+    parser.add_argument("--files_per_dir", type=int, default=100)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="fspy-bench") as tmp_dir:
+        target = args.target
+
+        if target is None:
+            target = tmp_dir
+            create_tree(target, args.dirs, args.files_per_dir)
+
+        measure("dict", scanner.walk_snapshot, target)
+        measure("compact", scanner.scandir_snapshot, target)
+
+
+if __name__ == '__main__':
+    main()
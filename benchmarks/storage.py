@@ -0,0 +1,136 @@
+"""
+Write path of collector writing thread: rows of file_diffs per second saved to SQLite
+ by ORM object graph (report_to_orm, former write path) and by bulk Core insert (db.insert_diff_report).
+Reports are saved in transactions of --batch_size reports, as by group commit of writing thread.
+
+Usage: python -m benchmarks.storage [--events 10 100000] [--rows 200000] [--batch_size 100]
+"""
+import argparse
+import tempfile
+import time
+from os import path
+
+from sqlalchemy import create_engine, pool
+from sqlalchemy.orm import Session
+
+from benchmarks.protocol import create_chunk
+from fspy.collector import db
+from fspy.common import protocol
+from fspy.common.records import ReportRecord, DiffRecord
+
+
+def _add_file_diffs(diff_report: db.DiffReport, diff: DiffRecord):
+    for file_state in diff.created:
+        db.FileDiff(
+            diff_report=diff_report,
+            file_path=file_state.path,
+
+            operation=db.OperationsEnum.CREATE,
+            size_after=file_state.size,
+            hash_after=file_state.content_hash,
+
+            operation_time=file_state.date_created
+        )
+
+    for file_diff in diff.updated:
+        db.FileDiff(
+            diff_report=diff_report,
+            file_path=file_diff.before.path,
+
+            operation=db.OperationsEnum.UPDATE,
+            size_before=file_diff.before.size,
+            size_after=file_diff.after.size,
+            hash_before=file_diff.before.content_hash,
+            hash_after=file_diff.after.content_hash,
+
+            operation_time=file_diff.after.date_updated,
+        )
+
+    for file_state in diff.deleted:
+        db.FileDiff(
+            diff_report=diff_report,
+            file_path=file_state.path,
+
+            operation=db.OperationsEnum.DELETE,
+            size_before=file_state.size,
+            hash_before=file_state.content_hash,
+
+            operation_time=diff.run_start,
+        )
+
+
+def report_to_orm(dr: ReportRecord) -> db.DiffReport:
+    """Former write path: ORM object graph of report, baseline for bulk insert"""
+    diff_report = db.DiffReport(
+        source_name=dr.source_name,
+        run_start=dr.diff.run_start,
+        run_end=dr.diff.run_end,
+
+        chunks_received=1,
+        chunks_total=1,
+        complete=True,
+    )
+
+    _add_file_diffs(diff_report, dr.diff)
+
+    return diff_report
+
+
+def create_report(events: int) -> ReportRecord:
+    version = protocol.BINARY_PROTOCOL_V4
+    chunk = protocol.decode_chunk_record(protocol.encode_diff_chunk(create_chunk(events, depth=3), version), version)
+    return ReportRecord(source_name=chunk.source_name, diff=chunk.diff)
+
+
+def save_orm(session: Session, report: ReportRecord):
+    session.add(report_to_orm(report))
+
+
+def save_bulk(session: Session, report: ReportRecord):
+    db.insert_diff_report(session, report)
+
+
+def rows_per_second(save, report: ReportRecord, reports_count: int, batch_size: int) -> float:
+    with tempfile.TemporaryDirectory(prefix="fspy-benchmark") as temp_dir:
+        engine = create_engine(f"sqlite:///{path.join(temp_dir, 'benchmark.sqlite')}",
+                               poolclass=pool.SingletonThreadPool)
+        db.Base.metadata.create_all(engine)
+
+        start = time.perf_counter()
+
+        for batch_start in range(0, reports_count, batch_size):
+            session = Session(bind=engine)
+            for _ in range(min(batch_size, reports_count - batch_start)):
+                save(session, report)
+            session.commit()
+            session.close()
+
+        elapsed = time.perf_counter() - start
+        engine.dispose()
+
+    return reports_count * len(report.diff.created + report.diff.deleted + report.diff.updated) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser("FSPY collector storage benchmark")
+    parser.add_argument("--events", type=int, nargs="+", default=[10, 100000], help="File events in report")
+    parser.add_argument("--rows", type=int, default=200000, help="Total file events saved in each case")
+    parser.add_argument("--batch_size", type=int, default=100, help="Reports saved in one transaction")
+
+    args = parser.parse_args()
+
+    for events in args.events:
+        report = create_report(events)
+        reports_count = max(args.rows // events, 1)
+
+        baseline = None
+        for name, save in (("orm", save_orm), ("bulk", save_bulk)):
+            rate = rows_per_second(save, report, reports_count, args.batch_size)
+            speedup = f"  x{rate / baseline:.1f}" if baseline else ""
+            baseline = baseline or rate
+
+            print(f"{name:<6} events: {events:<8} reports: {reports_count:<6} rows/s: {rate:10.0f}{speedup}")
+
+
+if __name__ == '__main__':
+    main()
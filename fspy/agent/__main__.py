@@ -1,6 +1,8 @@
+import os
+import socket
 from os import path
-from fspy.agent import runner
-from fspy.common import defaults
+from fspy.agent import runner, config, schedule, hashing, sender, spool, coalesce
+from fspy.common import defaults, protocol
 
 import logging.config
 
@@ -11,18 +13,149 @@ from fspy.common.logging_config import LOG_FMT
 
 def main():
     parser = argparse.ArgumentParser("FSPY client")
-    parser.add_argument("--target", type=str, help="Directory to scan", required=True)
-    parser.add_argument("--source_name", type=str, help="Name of this FSPY client instance", required=True)
+    parser.add_argument("--target", type=str, action="append", default=[],
+                        help="Directory to scan as PATH or PATH=NAME (NAME is source name of its diffs, "
+                             "--source_name by default). May be repeated, each target needs own source name")
+    parser.add_argument("--config", type=str, default=None,
+                        help="JSON file with scan targets: "
+                             '{"targets": [{"path": ..., "source_name": ..., "scan_interval": ...}, ...]}. '
+                             "Missing target fields are taken from command line")
+    parser.add_argument("--source_name", type=str, default=socket.gethostname(),
+                        help="Name of this FSPY client instance (source name of targets which do not have own one)")
     parser.add_argument("--server_host", type=str, help="FSPY server hostname/IP", default="127.0.0.1")
     parser.add_argument("--server_port", type=int, help="FSPY server port", default=defaults.DEFAULT_PORT)
+    parser.add_argument("--scan_interval", type=float, default=config.DEFAULT_SCAN_INTERVAL,
+                        help="Delay (seconds) between scans of each target")
+    parser.add_argument("--adaptive_interval", action='store_true',
+                        help="Adjust delay between scans to scan cost and changes rate. "
+                             "--scan_interval is used as initial delay")
+    parser.add_argument("--min_scan_interval", type=float, default=schedule.DEFAULT_MIN_SCAN_INTERVAL,
+                        help="Lower bound (seconds) of adaptive scan interval")
+    parser.add_argument("--max_scan_interval", type=float, default=schedule.DEFAULT_MAX_SCAN_INTERVAL,
+                        help="Upper bound (seconds) of adaptive scan interval")
+    parser.add_argument("--scan_budget", type=float, default=schedule.DEFAULT_SCAN_BUDGET,
+                        help="Max share of time (0..1] spent on scanning of each target with adaptive interval")
+    parser.add_argument("--incremental", help="Do not list again directories with unchanged mtime/inode",
+                        action='store_true')
+    parser.add_argument("--fast_incremental", action='store_true',
+                        help="Same as --incremental, but also do not re-stat files in unchanged directories "
+                             "(in-place file updates are detected only when containing directory changes)")
+    parser.add_argument("--backend", choices=config.BACKENDS, default=config.POLL_BACKEND,
+                        help="Change detection backend: periodic scans or inotify events (Linux only)")
+    parser.add_argument("--reconcile_interval", type=float, default=config.DEFAULT_RECONCILE_INTERVAL,
+                        help="Interval (seconds) of full reconcile scans for event-driven backend")
+    parser.add_argument("--include", type=str, action="append", default=[],
+                        help="Glob of files to report (e.g. '*.log'). May be repeated. "
+                             "Pattern without '/' is matched against file name, otherwise against path "
+                             "relative to target. If not provided - all files are reported")
+    parser.add_argument("--exclude", type=str, action="append", default=[],
+                        help="Glob of files and directories to skip (e.g. 'node_modules', '.git'). May be repeated. "
+                             "Excluded directories are not descended")
+    parser.add_argument("--max_depth", type=int, default=None,
+                        help="Number of directory levels below target to descend (0 - target files only)")
+    parser.add_argument("--max_file_size", type=int, default=None,
+                        help="Skip files larger than this size (bytes)")
+    parser.add_argument("--content_hash", action='store_true',
+                        help="Add content hashes to reported changes, so content changes can be told from touch. "
+                             "File is hashed only when its inode/size/mtime changes "
+                             "(hash cache is persisted to --state_dir)")
+    parser.add_argument("--hash_workers", type=int, default=hashing.DEFAULT_HASH_WORKERS,
+                        help="Number of threads to hash files with, shared by all targets "
+                             "(both for files of first scan and for changed files)")
+    parser.add_argument("--hash_rate_limit", type=float, default=hashing.DEFAULT_HASH_RATE_LIMIT,
+                        help="Max disk read rate (MiB/s) for hashing of all targets. 0 - unlimited")
+    parser.add_argument("--max_chunk_entries", type=int, default=runner.DEFAULT_MAX_CHUNK_ENTRIES,
+                        help="Max number of changed files in one message. Bigger diffs are sent in several chunks")
+    parser.add_argument("--json_protocol", action='store_true',
+                        help="Send diffs as JSON even if collector supports compact binary protocol")
+    parser.add_argument("--compression", choices=protocol.COMPRESSION_MODES, default=protocol.COMPRESSION_NONE,
+                        help="Compression of diffs sent to collector (useful for slow links): "
+                             "zlib - binary messages larger than --compress_threshold, "
+                             "deflate - all messages (permessage-deflate WebSocket extension)")
+    parser.add_argument("--compress_threshold", type=int, default=protocol.DEFAULT_COMPRESS_THRESHOLD,
+                        help="Min size (bytes) of message to compress with zlib")
+    parser.add_argument("--compress_level", type=int, choices=range(1, 10), default=protocol.DEFAULT_COMPRESS_LEVEL,
+                        help="zlib compression level: 1 - fastest, 9 - smallest")
+    parser.add_argument("--send_window", type=int, default=sender.DEFAULT_SEND_WINDOW,
+                        help="Max number of diff messages sent to collector but not acknowledged yet "
+                             "(higher values help on links with long round trip)")
+    parser.add_argument("--heartbeat", type=float, default=sender.DEFAULT_HEARTBEAT,
+                        help="Interval (seconds) of pings to collector, dead connection is detected in this time. "
+                             "0 - no pings")
+    parser.add_argument("--coalesce_threshold", type=int, default=coalesce.DEFAULT_COALESCE_THRESHOLD,
+                        help="Number of queued diff messages from which queued scans of each target are merged "
+                             f"into one net diff (max {runner.DEFAULT_DIFF_QUEUE_SIZE} messages are queued). "
+                             "0 - never merge. Not used with --spool_dir")
+    parser.add_argument("--spool_dir", type=str, default=None,
+                        help="Directory to keep diffs in until collector acknowledges them, so diffs survive "
+                             "agent restarts and collector outages. If not provided - diffs are kept in memory")
+    parser.add_argument("--spool_max_size", type=int, default=spool.DEFAULT_SPOOL_MAX_SIZE,
+                        help="Max disk space (MiB) used by --spool_dir")
+    parser.add_argument("--spool_policy", choices=spool.SPOOL_POLICIES, default=spool.SPOOL_POLICY_BLOCK,
+                        help="What to do when spool is full: block - pause scans until collector catches up, "
+                             "drop_oldest - delete oldest diffs, drop_newest - discard new diffs")
+    parser.add_argument("--state_dir", type=str, default=None,
+                        help="Directory to persist reference snapshot between restarts. "
+                             "If not provided - first scan after each start only builds the baseline")
+    parser.add_argument("--scan_threads", type=int, default=None,
+                        help="Number of targets which can be scanned at the same time")
+    parser.add_argument("--scan_workers", type=int, default=1,
+                        help="Number of threads to traverse directory tree concurrently "
+                             "(useful for network file systems, poll backend only)")
 
     args = parser.parse_args()
 
+    target_defaults = dict(
+        source_name=args.source_name,
+        scan_interval=args.scan_interval,
+        adaptive_interval=args.adaptive_interval,
+        min_scan_interval=args.min_scan_interval,
+        max_scan_interval=args.max_scan_interval,
+        scan_budget=args.scan_budget,
+        backend=args.backend,
+        reconcile_interval=args.reconcile_interval,
+        incremental=args.incremental,
+        fast_incremental=args.fast_incremental,
+        include=args.include,
+        exclude=args.exclude,
+        max_depth=args.max_depth,
+        max_file_size=args.max_file_size,
+        content_hash=args.content_hash,
+    )
+
+    try:
+        targets = []
+        for target in args.target:
+            target_path, source_name = config.parse_target_arg(target)
+            targets.append(config.TargetConfig(**{**target_defaults, "path": target_path,
+                                                  "source_name": source_name or args.source_name}))
+    except ValueError as e:
+        parser.error(f"Invalid target options: {e}")
+
+    if args.config is not None:
+        try:
+            targets.extend(config.load_agent_config(args.config, target_defaults).targets)
+        except (OSError, ValueError) as e:
+            parser.error(f"Can not load config {args.config}: {e}")
+
+    if not targets:
+        parser.error("At least one target must be provided with --target or --config")
+
+    try:
+        config.check_source_names(targets)
+    except ValueError as e:
+        parser.error(str(e))
+
+    for target in targets:
+        target.path = path.abspath(target.path)
+
+        if not path.isdir(target.path):
+            parser.error(f"{target.path} is not a directory")
+
     ws_url = f"ws://{args.server_host}:{args.server_port}/ws?source_name={args.source_name}"
-    target = path.abspath(args.target)
 
-    if not path.isdir(target):
-        print(f"{target} is not a directory")
+    if args.state_dir is not None:
+        os.makedirs(args.state_dir, exist_ok=True)
 
     logging.config.dictConfig({
         'version': 1,
@@ -54,13 +187,38 @@ def main():
             'fspy.agent.scanner': {
                 'level': 'INFO',
             },
+            'fspy.agent.snapshot': {
+                'level': 'INFO',
+            },
+            'fspy.agent.hashing': {
+                'level': 'INFO',
+            },
+            'fspy.agent.inotify': {
+                'level': 'INFO',
+            },
             'fspy.agent.sender': {
                 'level': 'INFO',
+            },
+            'fspy.agent.spool': {
+                'level': 'INFO',
             }
         },
     })
 
-    runner.main(ws_url=ws_url, scan_target=target)
+    runner.main(ws_url=ws_url, targets=targets, state_dir=args.state_dir,
+                scan_workers=args.scan_workers, scan_threads=args.scan_threads,
+                hash_workers=args.hash_workers, hash_rate_limit=args.hash_rate_limit * 1024 * 1024,
+                max_chunk_entries=args.max_chunk_entries,
+                protocols=(protocol.JSON_PROTOCOL,) if args.json_protocol else protocol.SUPPORTED_PROTOCOLS,
+                compression=args.compression,
+                compress_threshold=args.compress_threshold,
+                compress_level=args.compress_level,
+                send_window=args.send_window,
+                spool_dir=args.spool_dir,
+                spool_max_size=args.spool_max_size * 1024 * 1024,
+                spool_policy=args.spool_policy,
+                coalesce_threshold=args.coalesce_threshold,
+                heartbeat=args.heartbeat or None)
 
 
 if __name__ == '__main__':
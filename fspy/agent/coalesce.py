@@ -0,0 +1,144 @@
+from typing import List, Dict, Tuple, Union, Optional, Iterable
+
+import uuid
+from collections import OrderedDict
+
+import logging
+
+from fspy.agent.scanner import split_diff, DEFAULT_MAX_CHUNK_ENTRIES
+from fspy.agent.snapshot import CREATED, DELETED, UPDATED
+from fspy.common.model import FileState, FileDiff, FullDiff, DiffChunk
+
+log = logging.getLogger(__name__)
+
+# Queued diff chunks, from which backlog is coalesced
+DEFAULT_COALESCE_THRESHOLD = 8
+
+_Change = Tuple[str, Union[FileState, FileDiff]]
+
+
+def _merge_change(older: _Change, newer: _Change) -> Optional[_Change]:
+    """Net change of the same path by two consecutive diffs. None if changes cancel each other"""
+    older_kind, older_entry = older
+    newer_kind, newer_entry = newer
+
+    if older_kind == CREATED:
+        if newer_kind == DELETED:
+            return None
+        if newer_kind == UPDATED:
+            return CREATED, newer_entry.after
+
+    elif older_kind == UPDATED:
+        if newer_kind == UPDATED:
+            if older_entry.before == newer_entry.after:
+                return None
+            return UPDATED, FileDiff(before=older_entry.before, after=newer_entry.after)
+        if newer_kind == DELETED:
+            return DELETED, older_entry.before
+
+    elif older_kind == DELETED:
+        if newer_kind == CREATED:
+            return UPDATED, FileDiff(before=older_entry, after=newer_entry)
+
+    # Inconsistent pair (e.g. created twice), newer diff wins
+    return newer
+
+
+def _iter_changes(diff: FullDiff) -> Iterable[Tuple[str, _Change]]:
+    for file_state in diff.created:
+        yield file_state.path, (CREATED, file_state)
+    for file_state in diff.deleted:
+        yield file_state.path, (DELETED, file_state)
+    for file_diff in diff.updated:
+        yield file_diff.after.path, (UPDATED, file_diff)
+
+
+def merge_diffs(diffs: List[FullDiff]) -> FullDiff:
+    """
+    Merges consecutive diffs of the same source into one net diff: create and delete of the same file cancel out,
+     chained updates collapse into one. Run covers runs of all diffs.
+    """
+    changes = OrderedDict()  # type: Dict[str, _Change]
+
+    for diff in diffs:
+        for file_path, change in _iter_changes(diff):
+            prev_change = changes.pop(file_path, None)
+
+            if prev_change is not None:
+                change = _merge_change(prev_change, change)
+
+            if change is not None:
+                changes[file_path] = change
+
+    merged = FullDiff(
+        run_start=min(diff.run_start for diff in diffs),
+        run_end=max(diff.run_end for diff in diffs),
+        created=[], deleted=[], updated=[],
+    )
+
+    for kind, entry in changes.values():
+        getattr(merged, kind).append(entry)
+
+    return merged
+
+
+def _is_complete(chunks: List[DiffChunk]) -> bool:
+    return [chunk.chunk_index for chunk in chunks] == list(range(len(chunks))) and chunks[-1].last
+
+
+def coalesce_chunks(chunks: List[DiffChunk],
+                    max_chunk_entries: Optional[int] = DEFAULT_MAX_CHUNK_ENTRIES) -> List[DiffChunk]:
+    """
+    Replaces consecutive complete scans of each source by one scan with their net diff.
+    Scans with some chunks missing (partially sent or still running) are kept as is, so are chunks order
+     within each source and order of scans which are not merged.
+    """
+    # Runs of mergeable scans by source. Run is broken by incomplete scan of the same source
+    runs = OrderedDict()  # type: Dict[str, List[List[List[int]]]]
+
+    # Indexes of chunks of each scan, in order of first chunk
+    scans = OrderedDict()  # type: Dict[str, List[int]]
+    for index, chunk in enumerate(chunks):
+        scans.setdefault(chunk.scan_id, []).append(index)
+
+    for indexes in scans.values():
+        source_runs = runs.setdefault(chunks[indexes[0]].source_name, [[]])
+
+        if _is_complete([chunks[index] for index in indexes]):
+            source_runs[-1].append(indexes)
+        elif source_runs[-1]:
+            source_runs.append([])
+
+    # Merged scan takes place of the first scan of its run
+    replacements = {}  # type: Dict[int, List[DiffChunk]]
+    dropped = set()
+
+    for source_name, source_runs in runs.items():
+        for run in source_runs:
+            if len(run) < 2:
+                continue
+
+            run_chunks = [chunks[index] for indexes in run for index in indexes]
+            merged = merge_diffs([chunk.diff for chunk in run_chunks])
+            # Changes may cancel each other completely
+            merged_chunks = list(split_diff(merged, max_chunk_entries)) if merged else []
+
+            scan_id = uuid.uuid4().hex
+            replacements[run[0][0]] = [
+                DiffChunk(source_name=source_name, scan_id=scan_id, chunk_index=chunk_index,
+                          last=chunk_index == len(merged_chunks) - 1, diff=diff)
+                for chunk_index, diff in enumerate(merged_chunks)
+            ]
+            dropped.update(index for indexes in run for index in indexes)
+
+            log.info(f"[{source_name}] {len(run)} queued scans ({len(run_chunks)} chunks) "
+                     f"coalesced into {len(merged_chunks)} chunks")
+
+    result = []
+    for index, chunk in enumerate(chunks):
+        if index in replacements:
+            result.extend(replacements[index])
+        elif index not in dropped:
+            result.append(chunk)
+
+    return result
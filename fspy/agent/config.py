@@ -0,0 +1,132 @@
+from typing import List, Optional, Tuple
+
+import json
+
+import pydantic
+from pydantic import BaseModel
+
+from fspy.agent.schedule import DEFAULT_MIN_SCAN_INTERVAL, DEFAULT_MAX_SCAN_INTERVAL, DEFAULT_SCAN_BUDGET
+
+POLL_BACKEND = "poll"
+INOTIFY_BACKEND = "inotify"
+BACKENDS = (POLL_BACKEND, INOTIFY_BACKEND)
+
+DEFAULT_SCAN_INTERVAL = 2
+DEFAULT_RECONCILE_INTERVAL = 600
+
+# Command line target is PATH[=NAME]
+TARGET_NAME_SEPARATOR = "="
+
+
+class TargetConfig(BaseModel):
+    path: str
+    source_name: str
+
+    scan_interval: float = DEFAULT_SCAN_INTERVAL
+
+    # If enabled scan_interval is only the initial delay
+    adaptive_interval: bool = False
+    min_scan_interval: float = DEFAULT_MIN_SCAN_INTERVAL
+    max_scan_interval: float = DEFAULT_MAX_SCAN_INTERVAL
+    scan_budget: float = DEFAULT_SCAN_BUDGET
+
+    backend: str = POLL_BACKEND
+    reconcile_interval: float = DEFAULT_RECONCILE_INTERVAL
+
+    incremental: bool = False
+    fast_incremental: bool = False
+
+    # Glob patterns, see fspy.agent.filters.PathFilter
+    include: List[str] = []
+    exclude: List[str] = []
+    max_depth: Optional[int] = None
+    max_file_size: Optional[int] = None
+
+    # Add content hashes to diff, see fspy.agent.hashing.ContentHasher
+    content_hash: bool = False
+
+    # noinspection PyMethodParameters
+    @pydantic.validator("backend")
+    def check_backend(cls, value: str):
+        if value not in BACKENDS:
+            raise ValueError(f"unknown backend, expected one of: {', '.join(BACKENDS)}")
+        return value
+
+    # noinspection PyMethodParameters
+    @pydantic.validator("max_scan_interval")
+    def check_max_scan_interval(cls, value: float, values: dict, **kwargs):
+        if value < values.get("min_scan_interval", 0):
+            raise ValueError("must not be less than min_scan_interval")
+        return value
+
+    # noinspection PyMethodParameters
+    @pydantic.validator("max_depth", "max_file_size")
+    def check_not_negative(cls, value: Optional[int]):
+        if value is not None and value < 0:
+            raise ValueError("must not be negative")
+        return value
+
+    # noinspection PyMethodParameters
+    @pydantic.validator("scan_budget")
+    def check_scan_budget(cls, value: float):
+        if not 0 < value <= 1:
+            raise ValueError("must be in (0, 1]")
+        return value
+
+    class Config:
+        ignore_extra = False
+
+
+class AgentConfig(BaseModel):
+    targets: List[TargetConfig] = []
+
+    class Config:
+        ignore_extra = False
+
+
+def load_agent_config(config_path: str, target_defaults: Optional[dict] = None) -> AgentConfig:
+    """
+    Loads agent config from JSON file:
+        {"targets": [{"path": "/var/log", "source_name": "logs", "scan_interval": 5}, ...]}
+    Fields missing in target entries are taken from target_defaults (e.g. command line values).
+    """
+    with open(config_path) as config_file:
+        raw_config = json.load(config_file)
+
+    if not isinstance(raw_config, dict):
+        raise ValueError(f"Agent config {config_path} must be a JSON object")
+
+    raw_config["targets"] = [
+        {**(target_defaults or {}), **raw_target} if isinstance(raw_target, dict) else raw_target
+        for raw_target in raw_config.get("targets", [])
+    ]
+
+    return AgentConfig(**raw_config)
+
+
+def parse_target_arg(value: str) -> Tuple[str, Optional[str]]:
+    """Splits command line target PATH[=NAME] into path and source name (None if not provided)"""
+    dir_path, separator, source_name = value.rpartition(TARGET_NAME_SEPARATOR)
+
+    if not separator:
+        return value, None
+
+    if not dir_path or not source_name:
+        raise ValueError(f"Target {value!r} must be PATH or PATH{TARGET_NAME_SEPARATOR}NAME")
+
+    return dir_path, source_name
+
+
+def check_source_names(targets: List[TargetConfig]):
+    """
+    Diffs of targets are told apart (and coalesced, and sharded on collector) by source name only,
+     so each target must have its own one. Raises ValueError
+    """
+    paths_by_name = {}
+    for target in targets:
+        paths_by_name.setdefault(target.source_name, []).append(target.path)
+
+    for source_name, paths in paths_by_name.items():
+        if len(paths) > 1:
+            raise ValueError(f"Targets {', '.join(paths)} have the same source name {source_name!r}. "
+                             f"Name them with --target PATH{TARGET_NAME_SEPARATOR}NAME or in --config")
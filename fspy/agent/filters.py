@@ -0,0 +1,101 @@
+from typing import Optional, Sequence, Tuple, Pattern
+
+import os
+import re
+import fnmatch
+
+
+def _compile_patterns(patterns: Sequence[str]) -> Tuple[Optional[Pattern], Optional[Pattern]]:
+    """
+    Compiles glob patterns into two regular expressions:
+     for patterns matched against entry name and for patterns matched against relative path
+    """
+    name_patterns = []
+    path_patterns = []
+
+    for pattern in patterns:
+        pattern = pattern.rstrip("/")
+
+        if "/" in pattern:
+            path_patterns.append(fnmatch.translate(pattern.lstrip("/")))
+        elif pattern:
+            name_patterns.append(fnmatch.translate(pattern))
+
+    def join(translated):
+        return re.compile("|".join(translated)) if translated else None
+
+    return join(name_patterns), join(path_patterns)
+
+
+class PathFilter:
+    """
+    Include/exclude rules evaluated during traversal of target directory.
+
+    Patterns are case-sensitive globs. Pattern without "/" is matched against entry name at any depth
+     ("node_modules", "*.pyc"), pattern with "/" - against path relative to target root ("build/*.o").
+    Exclude patterns apply to both directories and files, excluded directories are not descended.
+    Include patterns select files only: directories are descended unless excluded.
+    max_depth is number of directory levels below target root to descend (0 - files of root directory only).
+    Files larger than max_file_size bytes are skipped.
+    """
+
+    def __init__(self, root: str, include: Sequence[str] = (), exclude: Sequence[str] = (),
+                 max_depth: Optional[int] = None, max_file_size: Optional[int] = None):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.max_depth = max_depth
+        self.max_file_size = max_file_size
+
+        self._root_prefix = root if root.endswith(os.sep) else root + os.sep
+
+        self._include_names, self._include_paths = _compile_patterns(self.include)
+        self._exclude_names, self._exclude_paths = _compile_patterns(self.exclude)
+
+    @property
+    def empty(self) -> bool:
+        return not (self.include or self.exclude) and self.max_depth is None and self.max_file_size is None
+
+    @property
+    def key(self) -> str:
+        """Describes rules, so state produced with other rules can be told apart"""
+        if self.empty:
+            return ""
+
+        return repr((self.include, self.exclude, self.max_depth, self.max_file_size))
+
+    def _rel_path(self, dir_path: str, name: str) -> str:
+        rel_dir = dir_path[len(self._root_prefix):]
+
+        if os.sep != "/":
+            rel_dir = rel_dir.replace(os.sep, "/")
+
+        return rel_dir + "/" + name if rel_dir else name
+
+    def _excluded(self, dir_path: str, name: str) -> bool:
+        if self._exclude_names is not None and self._exclude_names.match(name):
+            return True
+
+        return self._exclude_paths is not None and bool(self._exclude_paths.match(self._rel_path(dir_path, name)))
+
+    def descend(self, dir_path: str, name: str) -> bool:
+        """Checks sub-directory name of dir_path"""
+        if self.max_depth is not None and self._rel_path(dir_path, name).count("/") >= self.max_depth:
+            return False
+
+        return not self._excluded(dir_path, name)
+
+    def accept_name(self, dir_path: str, name: str) -> bool:
+        """Checks file name of dir_path. Called before stat"""
+        if self._excluded(dir_path, name):
+            return False
+
+        if self._include_names is None and self._include_paths is None:
+            return True
+
+        if self._include_names is not None and self._include_names.match(name):
+            return True
+
+        return self._include_paths is not None and bool(self._include_paths.match(self._rel_path(dir_path, name)))
+
+    def accept_stat(self, stat_info: os.stat_result) -> bool:
+        return self.max_file_size is None or stat_info.st_size <= self.max_file_size
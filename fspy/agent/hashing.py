@@ -0,0 +1,432 @@
+from typing import Dict, Optional, List, Tuple, Iterable
+
+import os
+import stat
+import time
+import zlib
+import struct
+import hashlib
+import threading
+from os import path
+from concurrent.futures import Executor
+
+import logging
+
+from fspy.agent.snapshot import Snapshot, _fsync_dir
+from fspy.common.model import FullDiff
+
+log = logging.getLogger(__name__)
+
+HASH_ALGORITHM = "sha1"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_HASH_WORKERS = 2
+# MiB per second for all hashing threads of agent
+DEFAULT_HASH_RATE_LIMIT = 20
+
+# Files of baseline hashed by one executor task
+BASELINE_BATCH_SIZE = 64
+# Seconds between saves of hash cache while baseline is hashed
+BASELINE_SAVE_INTERVAL = 60
+
+# inode, size, mtime_ns
+FileKey = Tuple[int, int, int]
+
+
+class RateLimiter:
+    """
+    Limits throughput (e.g. bytes per second) shared by many threads.
+    Each consumer reserves its time slot under lock and sleeps outside of it.
+    """
+
+    def __init__(self, rate: float):
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive, got {rate}")
+
+        self.rate = rate
+
+        self._lock = threading.Lock()
+        self._available_at = time.monotonic()
+
+    def consume(self, amount: int):
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._available_at, now)
+            self._available_at = start + amount / self.rate
+
+        if start > now:
+            time.sleep(start - now)
+
+
+def hash_file(file_path: str, key: FileKey, limiter: Optional[RateLimiter] = None,
+              chunk_size: int = HASH_CHUNK_SIZE) -> Optional[str]:
+    """
+    Returns content hash of regular file or None if file can not be read
+     or was changed since it was stat'ed with given key (it will be hashed on next scan).
+    """
+    try:
+        # Non-blocking open: FIFOs are recorded as files, but must not be read
+        fd = os.open(file_path, os.O_RDONLY | getattr(os, "O_NONBLOCK", 0))
+    except FileNotFoundError:
+        log.debug("File disappeared before hashing: %s", file_path)
+        return None
+    except OSError as e:
+        log.warning("Can not open %s for hashing: %s", file_path, e)
+        return None
+
+    with open(fd, "rb", buffering=0) as in_file:
+        file_stat = os.fstat(fd)
+
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+
+        if (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns) != key:
+            log.debug("File changed before hashing: %s", file_path)
+            return None
+
+        digest = hashlib.new(HASH_ALGORITHM)
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        remaining = file_stat.st_size
+
+        try:
+            while True:
+                if limiter is not None and remaining > 0:
+                    limiter.consume(min(remaining, chunk_size))
+
+                read_count = in_file.readinto(buf)
+                if not read_count:
+                    break
+
+                digest.update(view[:read_count])
+                remaining -= read_count
+
+        except OSError as e:
+            log.warning("Can not read %s for hashing: %s", file_path, e)
+            return None
+
+    return digest.hexdigest()
+
+
+HASH_CACHE_FILE_MAGIC = b"FSPYHASH"
+HASH_CACHE_FILE_VERSION = 1
+
+# magic, version, CRC32 of body, entries count
+_CACHE_HEADER = struct.Struct("<8sIIQ")
+# inode, size, mtime_ns, path length, digest length
+_CACHE_RECORD = struct.Struct("<QQqHB")
+
+
+def hash_cache_file_name(dir_path: str, variant: str = "") -> str:
+    """variant distinguishes caches of the same directory kept with different rules (e.g. path filters)"""
+    key = os.fsencode(dir_path)
+    if variant:
+        key += b"\0" + variant.encode()
+
+    return "hashes-" + hashlib.sha1(key).hexdigest()[:16] + ".bin"
+
+
+class HashCache:
+    """Content hashes of files with (inode, size, mtime_ns) at the moment of hashing"""
+
+    def __init__(self):
+        self._entries = {}  # type: Dict[str, Tuple[FileKey, str]]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, file_path: str, key: FileKey) -> Optional[str]:
+        """Returns hash if file was not changed since it was hashed"""
+        entry = self._entries.get(file_path)
+        return entry[1] if entry is not None and entry[0] == key else None
+
+    def last(self, file_path: str) -> Optional[str]:
+        """Returns last known hash of file, changed or not"""
+        entry = self._entries.get(file_path)
+        return None if entry is None else entry[1]
+
+    def put(self, file_path: str, key: FileKey, content_hash: str):
+        self._entries[file_path] = (key, content_hash)
+
+    def discard(self, file_path: str):
+        self._entries.pop(file_path, None)
+
+    def retain(self, file_paths: Iterable[str]):
+        self._entries = {p: self._entries[p] for p in file_paths if p in self._entries}
+
+    def copy(self) -> "HashCache":
+        cache = HashCache()
+        cache._entries = dict(self._entries)
+        return cache
+
+    def save(self, file_path: str):
+        """Writes cache to file atomically (temporary file + rename)"""
+        records = []
+
+        for entry_path, ((inode, size, mtime_ns), content_hash) in self._entries.items():
+            path_bytes = os.fsencode(entry_path)
+            digest = bytes.fromhex(content_hash)
+            record = _CACHE_RECORD.pack(inode, size, mtime_ns, len(path_bytes), len(digest))
+            records.append(record + path_bytes + digest)
+
+        body = b"".join(records)
+        header = _CACHE_HEADER.pack(HASH_CACHE_FILE_MAGIC, HASH_CACHE_FILE_VERSION, zlib.crc32(body), len(records))
+
+        tmp_path = file_path + ".tmp"
+
+        with open(tmp_path, "wb") as out_file:
+            out_file.write(header)
+            out_file.write(body)
+
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+        os.replace(tmp_path, file_path)
+        _fsync_dir(path.dirname(path.abspath(file_path)))
+
+    @classmethod
+    def load(cls, file_path: str) -> "HashCache":
+        """Loads cache saved by save(). Returns empty cache if file is missing or damaged"""
+        cache = cls()
+
+        try:
+            with open(file_path, "rb") as in_file:
+                buf = in_file.read()
+        except FileNotFoundError:
+            return cache
+        except OSError as e:
+            log.warning(f"Can not read hash cache {file_path}: {e}")
+            return cache
+
+        try:
+            magic, version, crc, count = _CACHE_HEADER.unpack_from(buf, 0)
+
+            if magic != HASH_CACHE_FILE_MAGIC or version != HASH_CACHE_FILE_VERSION:
+                raise ValueError("Not a hash cache file or unsupported version")
+
+            if zlib.crc32(buf[_CACHE_HEADER.size:]) != crc:
+                raise ValueError("Checksum mismatch")
+
+            offset = _CACHE_HEADER.size
+
+            for _ in range(count):
+                inode, size, mtime_ns, path_len, digest_len = _CACHE_RECORD.unpack_from(buf, offset)
+                offset += _CACHE_RECORD.size
+
+                entry_path = os.fsdecode(buf[offset:offset + path_len])
+                offset += path_len
+
+                cache.put(entry_path, (inode, size, mtime_ns), buf[offset:offset + digest_len].hex())
+                offset += digest_len
+
+        except (struct.error, ValueError) as e:
+            log.warning(f"Hash cache {file_path} is damaged and will be rebuilt: {e}")
+            return cls()
+
+        return cache
+
+
+class ContentHasher:
+    """
+    Adds content hashes to diffs of one target, so real content changes can be told from metadata-only ones.
+
+    File is hashed only if its (inode, size, mtime_ns) changed since it was hashed last time.
+    Hashes are kept in HashCache, which is persisted to cache_path (if provided) after scans with changes.
+    Files are read in chunks on executor, limiter (shared by all targets of agent) bounds disk throughput.
+
+    Files of the first (baseline) snapshot are hashed in background, so scans are not held by it: in tasks
+     of BASELINE_BATCH_SIZE files, one task of each target at a time, so executor (shared by targets) bounds
+     the number of hashing threads and changed files of scans are hashed in between. Meanwhile cache is saved
+     every BASELINE_SAVE_INTERVAL seconds. Later only changed files of diffs are hashed.
+     Files changed before baseline hashing finishes have no hash of their previous state.
+    """
+
+    def __init__(self, executor: Executor, limiter: Optional[RateLimiter] = None, cache_path: Optional[str] = None):
+        self._executor = executor
+        self._limiter = limiter
+        self._cache_path = cache_path
+
+        self._cache = HashCache.load(cache_path) if cache_path is not None else HashCache()
+        self._cache_changed = False
+        # Cache is used by scan thread and background hashing of baseline
+        self._lock = threading.Lock()
+        # Cache is serialized outside of _lock, saves must not overlap
+        self._save_lock = threading.Lock()
+        self._saved_at = time.monotonic()
+
+        # Set when hashing of baseline is finished or interrupted, None - not started yet
+        self._baseline_done = None  # type: Optional[threading.Event]
+        self._baseline_keys = []  # type: List[Tuple[str, FileKey]]
+        self._baseline_hashed = 0
+        self._stopped = threading.Event()
+        # Number of files of snapshot cache was last cleaned up for
+        self._files_count = None  # type: Optional[int]
+
+        if len(self._cache):
+            log.info(f"Hash cache with {len(self._cache)} entries loaded from {cache_path}")
+
+    def _hash_stale(self, keys: List[Tuple[str, FileKey]]):
+        with self._lock:
+            stale = [(file_path, key) for file_path, key in keys if self._cache.get(file_path, key) is None]
+
+        if not stale:
+            return
+
+        log.debug(f"Hashing {len(stale)} files")
+
+        hashes = list(self._executor.map(lambda item: hash_file(item[0], item[1], self._limiter), stale))
+
+        with self._lock:
+            for (file_path, key), content_hash in zip(stale, hashes):
+                if content_hash is not None:
+                    self._cache.put(file_path, key, content_hash)
+
+            self._cache_changed = True
+
+    def _start_baseline(self, keys: List[Tuple[str, FileKey]]):
+        self._baseline_done = threading.Event()
+        self._baseline_keys = keys
+        self._submit_baseline_batch(0)
+
+    def _finish_baseline(self, finished: bool):
+        log.info(f"Hashing of baseline is {'finished' if finished else 'interrupted'}, "
+                 f"{self._baseline_hashed} files are hashed")
+
+        self._baseline_keys = []
+        self.save()
+        self._baseline_done.set()
+
+    def _submit_baseline_batch(self, offset: int):
+        if self._stopped.is_set():
+            self._finish_baseline(False)
+        elif offset >= len(self._baseline_keys):
+            self._finish_baseline(True)
+        else:
+            try:
+                self._executor.submit(self._hash_baseline_batch, offset)
+            except RuntimeError:
+                # Executor is shut down
+                self._finish_baseline(False)
+
+    def _hash_baseline_batch(self, offset: int):
+        """Runs on executor. Hashes batch of baseline files and submits the next one"""
+        batch = self._baseline_keys[offset:offset + BASELINE_BATCH_SIZE]
+
+        # noinspection PyBroadException
+        try:
+            for file_path, key in batch:
+                if self._stopped.is_set():
+                    break
+
+                with self._lock:
+                    if self._cache.get(file_path, key) is not None:
+                        continue
+
+                content_hash = hash_file(file_path, key, self._limiter)
+
+                if content_hash is not None:
+                    with self._lock:
+                        self._cache.put(file_path, key, content_hash)
+                        self._cache_changed = True
+
+                    self._baseline_hashed += 1
+
+            if time.monotonic() - self._saved_at >= BASELINE_SAVE_INTERVAL:
+                self.save()
+
+        except Exception:
+            log.exception("Error during hashing of baseline")
+            self._finish_baseline(False)
+            return
+
+        self._submit_baseline_batch(offset + len(batch))
+
+    def refresh(self, snapshot: Snapshot):
+        """
+        Forgets files missing in snapshot, only if number of files changed (deleted ones are forgotten by annotate).
+        First call starts hashing of all files of snapshot which were changed since last hashing in background.
+        Cache is saved only after baseline is hashed
+        """
+        if self._files_count is None or len(snapshot) != self._files_count:
+            self._files_count = len(snapshot)
+            keys = list(snapshot.iter_file_keys())
+
+            with self._lock:
+                cached_count = len(self._cache)
+                self._cache.retain(file_path for file_path, _ in keys)
+                self._cache_changed = self._cache_changed or len(self._cache) != cached_count
+
+            if self._baseline_done is None and not self._stopped.is_set():
+                self._start_baseline(keys)
+
+        if self._baseline_done is not None and self._baseline_done.is_set():
+            self.save()
+
+    def wait_baseline(self, timeout: Optional[float] = None):
+        """Waits for background hashing of baseline (if it was started)"""
+        if self._baseline_done is not None:
+            self._baseline_done.wait(timeout)
+
+    def stop(self):
+        """Interrupts background hashing of baseline (after file being hashed), so executor is not held by it"""
+        self._stopped.set()
+
+    def close(self):
+        """Interrupts background hashing of baseline and saves cache"""
+        self.stop()
+        self.wait_baseline()
+        self.save()
+
+    def annotate(self, full_diff: FullDiff, snapshot: Snapshot):
+        """
+        Sets content_hash of diff entries (diff may be a chunk of the whole one).
+        New snapshot must already contain changes of the diff. Cache is not saved.
+        """
+        # Hashes of previous states are known only until cache is updated
+        with self._lock:
+            for file_state in full_diff.deleted:
+                file_state.content_hash = self._cache.last(file_state.path)
+                self._cache.discard(file_state.path)
+                self._cache_changed = True
+
+            for file_diff in full_diff.updated:
+                file_diff.before.content_hash = self._cache.last(file_diff.before.path)
+
+        new_states = []
+        keys = []
+
+        for file_state in full_diff.created + [file_diff.after for file_diff in full_diff.updated]:
+            key = snapshot.file_key(*path.split(file_state.path))
+
+            if key is not None:
+                new_states.append(file_state)
+                keys.append((file_state.path, key))
+
+        self._hash_stale(keys)
+
+        with self._lock:
+            for file_state, (file_path, key) in zip(new_states, keys):
+                file_state.content_hash = self._cache.get(file_path, key)
+
+    def save(self):
+        if self._cache_path is None:
+            return
+
+        with self._save_lock:
+            # Copy is serialized, so scan and baseline hashing are not held by writing of whole cache
+            with self._lock:
+                if not self._cache_changed:
+                    return
+
+                cache = self._cache.copy()
+                self._cache_changed = False
+
+            try:
+                cache.save(self._cache_path)
+            except OSError as e:
+                log.error(f"Can not save hash cache to {self._cache_path}: {e}")
+
+                with self._lock:
+                    self._cache_changed = True
+
+            self._saved_at = time.monotonic()
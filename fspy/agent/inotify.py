@@ -0,0 +1,498 @@
+from typing import (
+    Dict, Optional, List, Set, Tuple, Iterator, )
+
+import os
+from os import path
+import sys
+import time
+import errno
+import threading
+import struct
+import ctypes
+import ctypes.util
+
+import logging
+
+from datetime import datetime
+import pytz
+
+from fspy.agent.filters import PathFilter
+from fspy.agent.hashing import ContentHasher
+# noinspection PyProtectedMember
+from fspy.agent.scanner import (
+    ScanInProgressError, check_scan_target, _scan_dir, iter_diff_chunks, split_diff, DEFAULT_MAX_CHUNK_ENTRIES, )
+from fspy.agent.snapshot import DirState, Snapshot, file_state_from_stat, load_snapshot, save_snapshot
+from fspy.common.model import FileDiff, FullDiff
+
+log = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+LISTING_CHANGE_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+FILE_CHANGE_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE
+
+_EVENT_HEADER = struct.Struct("iIII")
+_READ_BUFFER_SIZE = 64 * 1024
+
+MAX_USER_WATCHES_PATH = "/proc/sys/fs/inotify/max_user_watches"
+
+# None values mean removal
+DirChanges = Dict[str, Optional[DirState]]
+FileChanges = Dict[Tuple[str, str], Optional[os.stat_result]]
+
+
+class InotifyError(OSError):
+    pass
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+    if not hasattr(libc, "inotify_init1"):
+        return None
+
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+    return libc
+
+
+_libc = _load_libc()
+
+
+def inotify_available() -> bool:
+    return _libc is not None
+
+
+def get_max_user_watches() -> Optional[int]:
+    try:
+        with open(MAX_USER_WATCHES_PATH) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+class Inotify:
+    """Thin ctypes wrapper around non-blocking inotify file descriptor"""
+
+    def __init__(self):
+        if _libc is None:
+            raise InotifyError(errno.ENOSYS, "inotify is not available on this platform")
+
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise InotifyError(err, f"inotify_init1 failed: {os.strerror(err)}")
+
+        self._fd = fd
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def add_watch(self, dir_path: str, mask: int = WATCH_MASK) -> int:
+        wd = _libc.inotify_add_watch(self._fd, os.fsencode(dir_path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise InotifyError(err, f"inotify_add_watch failed for {dir_path}: {os.strerror(err)}")
+        return wd
+
+    def rm_watch(self, wd: int):
+        # Fails with EINVAL if watch was already removed by kernel (e.g. directory was deleted), that is OK
+        _libc.inotify_rm_watch(self._fd, wd)
+
+    def read_events(self) -> List[Tuple[int, int, str]]:
+        """Reads all pending events as (wd, mask, name) tuples without blocking"""
+        events = []
+
+        while True:
+            try:
+                data = os.read(self._fd, _READ_BUFFER_SIZE)
+            except BlockingIOError:
+                break
+
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, name_len = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+
+                name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+                offset += name_len
+
+                events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class InotifyComparator:
+    """
+    Event-driven counterpart of SimpleComparator.
+
+    Kernel events only mark directories and files as dirty, scan() then re-lists/re-stats
+     just the dirty part of the tree and produces the same FullDiff as a full scan would.
+    On watch queue overflow, or if watch-count limit does not allow to watch whole tree,
+     full reconcile scans are used instead. Reconcile scan is also done every reconcile_interval seconds.
+
+    If snapshot_path is provided, reference snapshot is loaded from it on start and saved
+     after each reconcile scan and on close (not after each event: that would cost O(files) per event).
+
+    Directories excluded by path_filter are neither scanned nor watched.
+    If content_hasher is provided, diff entries get content hashes.
+    """
+
+    def __init__(self, dir_path: str, reconcile_interval: float = 600, max_watches: Optional[int] = None,
+                 snapshot_path: Optional[str] = None, path_filter: Optional[PathFilter] = None,
+                 content_hasher: Optional[ContentHasher] = None):
+        if not inotify_available():
+            raise ValueError(f"Can not create InotifyComparator for '{dir_path}': inotify is not available")
+
+        self._dir_path = check_scan_target(dir_path, type(self).__name__)
+
+        self.reconcile_interval = reconcile_interval
+        self._path_filter = path_filter if path_filter is not None and not path_filter.empty else None
+        self._content_hasher = content_hasher
+
+        system_max_watches = get_max_user_watches()
+        if max_watches is None or (system_max_watches is not None and max_watches > system_max_watches):
+            max_watches = system_max_watches
+        self._max_watches = max_watches
+
+        self._inotify = Inotify()
+        self._wd_to_path = {}  # type: Dict[int, str]
+        self._path_to_wd = {}  # type: Dict[str, int]
+        self._watch_limit_reached = False
+
+        self._scan_lock = threading.Lock()
+
+        self._snapshot_path = snapshot_path
+        self._ref_snapshot = None  # type: Snapshot
+        self._last_reconcile = None  # type: float
+
+        if snapshot_path is not None:
+            self._ref_snapshot = load_snapshot(snapshot_path, self._dir_path)
+
+    @property
+    def dir_path(self) -> str:
+        return self._dir_path
+
+    @property
+    def degraded(self) -> bool:
+        """True if not the whole tree can be watched and every scan has to be a full one"""
+        return self._watch_limit_reached
+
+    def fileno(self) -> int:
+        return self._inotify.fileno()
+
+    def close(self):
+        self._inotify.close()
+
+        if self._last_reconcile is not None:
+            self._save_snapshot()
+
+    def _save_snapshot(self):
+        if self._snapshot_path is None:
+            return
+
+        try:
+            save_snapshot(self._ref_snapshot, self._snapshot_path, self._dir_path)
+        except OSError as e:
+            log.error(f"Can not save reference snapshot to {self._snapshot_path}: {e}")
+
+    def _add_watch(self, dir_path: str):
+        if self._watch_limit_reached:
+            return
+
+        # Watched directories are added again on reconcile (same inode keeps its wd), they are not counted twice
+        if self._max_watches is not None and dir_path not in self._path_to_wd \
+                and len(self._wd_to_path) >= self._max_watches:
+            log.warning(f"Watch-count limit ({self._max_watches}) reached. Falling back to reconcile scans")
+            self._watch_limit_reached = True
+            return
+
+        try:
+            wd = self._inotify.add_watch(dir_path)
+        except InotifyError as e:
+            if e.errno == errno.ENOSPC:
+                log.warning("Kernel inotify watch limit reached. Falling back to reconcile scans")
+                self._watch_limit_reached = True
+            elif e.errno != errno.ENOENT:
+                log.warning("Can not watch %s: %s", dir_path, e)
+            return
+
+        old_path = self._wd_to_path.get(wd)
+        if old_path is not None and self._path_to_wd.get(old_path) == wd:
+            # Same directory inode watched again under new path (directory was moved)
+            del self._path_to_wd[old_path]
+
+        self._wd_to_path[wd] = dir_path
+        self._path_to_wd[dir_path] = wd
+
+    def _rm_watch(self, dir_path: str):
+        wd = self._path_to_wd.pop(dir_path, None)
+
+        if wd is not None and self._wd_to_path.get(wd) == dir_path:
+            del self._wd_to_path[wd]
+            self._inotify.rm_watch(wd)
+
+    def _add_subtree(self, dir_path: str, dir_changes: DirChanges, file_changes: FileChanges):
+        pending_dirs = [dir_path]
+
+        while pending_dirs:
+            current_dir = pending_dirs.pop()
+
+            # Watch is added before listing, so changes made during listing are not lost
+            self._add_watch(current_dir)
+            dir_state, files = _scan_dir(current_dir, path_filter=self._path_filter)
+
+            if dir_state is None:
+                self._rm_watch(current_dir)
+                continue
+
+            dir_changes[current_dir] = dir_state
+
+            for name, stat_info in files:
+                file_changes[(current_dir, name)] = stat_info
+
+            pending_dirs.extend(dir_state.sub_dirs)
+
+    def _remove_subtree(self, dir_path: str, dir_changes: DirChanges, file_changes: FileChanges):
+        pending_dirs = [dir_path]
+
+        while pending_dirs:
+            current_dir = pending_dirs.pop()
+
+            self._rm_watch(current_dir)
+            dir_changes[current_dir] = None
+
+            for name in self._ref_snapshot.file_names(current_dir):
+                file_changes[(current_dir, name)] = None
+
+            dir_state = self._ref_snapshot.dir_state(current_dir)
+            if dir_state is not None:
+                pending_dirs.extend(dir_state.sub_dirs)
+
+    def _read_dirty(self) -> Tuple[bool, Set[str], Set[str]]:
+        """Returns (overflow, dirty directories, dirty files)"""
+        overflow = False
+        dirty_dirs = set()
+        dirty_files = set()
+
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+
+            dir_path = self._wd_to_path.get(wd)
+            if dir_path is None:
+                continue
+
+            if mask & IN_IGNORED:
+                if self._path_to_wd.get(dir_path) == wd:
+                    del self._path_to_wd[dir_path]
+                del self._wd_to_path[wd]
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # Parent directory receives its own event, nothing to do here
+                continue
+
+            if mask & LISTING_CHANGE_MASK:
+                dirty_dirs.add(dir_path)
+            elif mask & FILE_CHANGE_MASK and not mask & IN_ISDIR:
+                dirty_files.add(path.join(dir_path, name))
+
+        return overflow, dirty_dirs, dirty_files
+
+    def _apply_changes(self, dir_changes: DirChanges, file_changes: FileChanges,
+                       run_start: datetime, run_end: datetime) -> FullDiff:
+        created = []
+        deleted = []
+        updated = []
+
+        for dir_path, dir_state in dir_changes.items():
+            if dir_state is not None:
+                self._ref_snapshot.set_dir(dir_path, dir_state)
+
+        for (dir_path, name), stat_info in file_changes.items():
+            old_state = self._ref_snapshot.file_state(dir_path, name)
+
+            if stat_info is None:
+                if old_state is not None:
+                    deleted.append(old_state)
+                    self._ref_snapshot.remove_file(dir_path, name)
+
+            elif self._ref_snapshot.set_file(dir_path, name, stat_info):
+                new_state = file_state_from_stat(path.join(dir_path, name), stat_info)
+
+                if old_state is None:
+                    created.append(new_state)
+                else:
+                    updated.append(FileDiff(before=old_state, after=new_state))
+
+        for dir_path, dir_state in dir_changes.items():
+            if dir_state is None:
+                self._ref_snapshot.remove_dir(dir_path)
+
+        return FullDiff(run_start=run_start, run_end=run_end, created=created, deleted=deleted, updated=updated)
+
+    def _reconcile(self, max_entries: Optional[int] = None) -> Iterator[FullDiff]:
+        log.info("Running reconcile scan")
+
+        # Events read so far are covered by the full scan
+        self._inotify.read_events()
+
+        dir_changes = {}  # type: DirChanges
+        file_changes = {}  # type: FileChanges
+
+        scan_start = datetime.now(pytz.utc)
+        self._add_subtree(self._dir_path, dir_changes, file_changes)
+        scan_end = datetime.now(pytz.utc)
+
+        new_snapshot = Snapshot()
+        for dir_path, dir_state in dir_changes.items():
+            new_snapshot.set_dir(dir_path, dir_state)
+        for (dir_path, name), stat_info in file_changes.items():
+            new_snapshot.set_file(dir_path, name, stat_info)
+
+        for dir_path in list(self._path_to_wd):
+            if new_snapshot.dir_state(dir_path) is None:
+                self._rm_watch(dir_path)
+
+        self._last_reconcile = time.monotonic()
+
+        old_snapshot = self._ref_snapshot
+        self._ref_snapshot = new_snapshot
+        self._save_snapshot()
+
+        if old_snapshot is not None:
+            for chunk in iter_diff_chunks(old_snapshot.iter_diff(new_snapshot), scan_start, scan_end, max_entries):
+                if self._content_hasher is not None:
+                    self._content_hasher.annotate(chunk, new_snapshot)
+
+                yield chunk
+
+        if self._content_hasher is not None:
+            self._content_hasher.refresh(new_snapshot)
+
+    def scan(self) -> Optional[FullDiff]:
+        """Returns diff with previous scan or None for the first scan"""
+        chunks = list(self.scan_chunks(max_entries=None))
+        return chunks[0] if chunks else None
+
+    def scan_chunks(self, max_entries: Optional[int] = DEFAULT_MAX_CHUNK_ENTRIES) -> Iterator[FullDiff]:
+        """Same as SimpleComparator.scan_chunks"""
+        if not self._scan_lock.acquire(blocking=False):
+            raise ScanInProgressError(f"Scan of {self._dir_path} is already running")
+
+        try:
+            yield from self._scan_chunks(max_entries)
+        finally:
+            self._scan_lock.release()
+
+    def _scan_chunks(self, max_entries: Optional[int]) -> Iterator[FullDiff]:
+        if self._last_reconcile is None:
+            yield from self._reconcile(max_entries)
+            return
+
+        overflow, dirty_dirs, dirty_files = self._read_dirty()
+
+        if overflow:
+            log.warning("Inotify queue overflow")
+
+        if overflow or self.degraded or time.monotonic() - self._last_reconcile >= self.reconcile_interval:
+            yield from self._reconcile(max_entries)
+            return
+
+        scan_start = datetime.now(pytz.utc)
+
+        dir_changes = {}  # type: DirChanges
+        file_changes = {}  # type: FileChanges
+        added_dirs = []  # type: List[str]
+
+        for dir_path in dirty_dirs:
+            old_dir_state = self._ref_snapshot.dir_state(dir_path)
+            if old_dir_state is None:
+                continue
+
+            dir_state, files = _scan_dir(dir_path, path_filter=self._path_filter)
+
+            if dir_state is None:
+                self._remove_subtree(dir_path, dir_changes, file_changes)
+                continue
+
+            dir_changes.setdefault(dir_path, dir_state)
+
+            for name in self._ref_snapshot.file_names(dir_path):
+                file_changes.setdefault((dir_path, name), None)
+            for name, stat_info in files:
+                file_changes[(dir_path, name)] = stat_info
+
+            added_dirs.extend(set(dir_state.sub_dirs) - set(old_dir_state.sub_dirs))
+
+            for sub_dir in set(old_dir_state.sub_dirs) - set(dir_state.sub_dirs):
+                self._remove_subtree(sub_dir, dir_changes, file_changes)
+
+        # Sub-trees are added after all removals: directory may be moved inside watched tree
+        for dir_path in added_dirs:
+            self._add_subtree(dir_path, dir_changes, file_changes)
+
+        for file_path in dirty_files:
+            dir_path, name = path.split(file_path)
+
+            if (dir_path, name) in file_changes:
+                continue
+
+            if self._path_filter is not None and not self._path_filter.accept_name(dir_path, name):
+                continue
+
+            try:
+                stat_info = os.stat(file_path)
+
+                if self._path_filter is None or self._path_filter.accept_stat(stat_info):
+                    file_changes[(dir_path, name)] = stat_info
+                else:
+                    file_changes[(dir_path, name)] = None
+            except FileNotFoundError:
+                file_changes[(dir_path, name)] = None
+            except OSError as e:
+                log.warning("Can not get stat for %s: %s", file_path, e)
+
+        full_diff = self._apply_changes(dir_changes, file_changes, run_start=scan_start, run_end=datetime.now(pytz.utc))
+
+        if self._content_hasher is not None and full_diff:
+            self._content_hasher.annotate(full_diff, self._ref_snapshot)
+            self._content_hasher.save()
+
+        # Changes are applied to reference snapshot in place, so their diff is built as a whole anyway
+        yield from split_diff(full_diff, max_entries)
@@ -1,14 +1,34 @@
+from typing import Optional, List, Union, Callable, NamedTuple, Sequence
+
+import time
+import uuid
 import asyncio
+import threading
+from os import path
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, Future, Executor
 
 import logging
 import logging.config
 
-from fspy.agent.scanner import SimpleComparator
-from fspy.agent.sender import DiffSender
-from fspy.common import model
+from fspy.agent.coalesce import DEFAULT_COALESCE_THRESHOLD
+from fspy.agent.config import TargetConfig, INOTIFY_BACKEND, POLL_BACKEND
+from fspy.agent.filters import PathFilter
+from fspy.agent.hashing import ContentHasher, RateLimiter, hash_cache_file_name, DEFAULT_HASH_WORKERS
+from fspy.agent.inotify import InotifyComparator
+from fspy.agent.schedule import AdaptiveScanInterval
+from fspy.agent.scanner import SimpleComparator, DEFAULT_MAX_CHUNK_ENTRIES
+from fspy.agent.snapshot import snapshot_file_name
+from fspy.agent.sender import DiffSender, DEFAULT_SEND_WINDOW, DEFAULT_HEARTBEAT
+from fspy.agent.spool import DiffSpool, SpoolClosedError, DEFAULT_SPOOL_MAX_SIZE, SPOOL_POLICY_BLOCK
+from fspy.common import model, protocol
 
 log = logging.getLogger(__name__)
 
+DEFAULT_SCAN_THREADS = 4
+# Diff chunks waiting for sending. When queue is full, scans wait for free space
+DEFAULT_DIFF_QUEUE_SIZE = 16
+
 
 def log_full_diff(full_diff: model.FullDiff):
     if log.isEnabledFor(logging.DEBUG) and full_diff:
@@ -20,59 +40,381 @@ def log_full_diff(full_diff: model.FullDiff):
             log.debug("File was updated: %s", fds)
 
 
+def create_path_filter(config: TargetConfig) -> PathFilter:
+    return PathFilter(path.abspath(config.path), include=config.include, exclude=config.exclude,
+                      max_depth=config.max_depth, max_file_size=config.max_file_size)
+
+
+def create_content_hasher(config: TargetConfig, executor: Executor, limiter: Optional[RateLimiter] = None,
+                          state_dir: Optional[str] = None) -> Optional[ContentHasher]:
+    if not config.content_hash:
+        return None
+
+    cache_path = None
+    if state_dir is not None:
+        # Cache kept with other filters misses files, same as snapshot
+        cache_path = path.join(state_dir, hash_cache_file_name(path.abspath(config.path),
+                                                               create_path_filter(config).key))
+
+    return ContentHasher(executor, limiter=limiter, cache_path=cache_path)
+
+
+def create_comparator(config: TargetConfig, state_dir: Optional[str] = None,
+                      traversal_executor: Optional[Executor] = None,
+                      content_hasher: Optional[ContentHasher] = None) -> Union[SimpleComparator, InotifyComparator]:
+    dir_path = path.abspath(config.path)
+
+    path_filter = create_path_filter(config)
+
+    snapshot_path = None
+    if state_dir is not None:
+        # Snapshot taken with other filters is not a valid reference
+        snapshot_path = path.join(state_dir, snapshot_file_name(dir_path, path_filter.key))
+
+    if config.backend == INOTIFY_BACKEND:
+        return InotifyComparator(dir_path, reconcile_interval=config.reconcile_interval,
+                                 snapshot_path=snapshot_path, path_filter=path_filter,
+                                 content_hasher=content_hasher)
+
+    if config.backend == POLL_BACKEND:
+        return SimpleComparator(dir_path, incremental=config.incremental, fast=config.fast_incremental,
+                                snapshot_path=snapshot_path, traversal_executor=traversal_executor,
+                                path_filter=path_filter, content_hasher=content_hasher)
+
+    raise ValueError(f"Unknown scan backend: {config.backend}")
+
+
+class ScanSummary(NamedTuple):
+    created: int
+    deleted: int
+    updated: int
+    chunks: int
+
+    @property
+    def changes_count(self) -> int:
+        return self.created + self.deleted + self.updated
+
+
+class ScanTarget:
+    def __init__(self, config: TargetConfig, comparator: Union[SimpleComparator, InotifyComparator],
+                 content_hasher: Optional[ContentHasher] = None):
+        self.config = config
+        self.comparator = comparator
+        self.content_hasher = content_hasher
+
+        # Scans of the same target are launched strictly one by one
+        self.scan_future = None  # type: Future
+        self.last_scan_duration = 0.0
+
+        self.adaptive_interval = None  # type: Optional[AdaptiveScanInterval]
+        if config.adaptive_interval:
+            self.adaptive_interval = AdaptiveScanInterval(
+                initial=config.scan_interval,
+                min_interval=config.min_scan_interval,
+                max_interval=config.max_scan_interval,
+                budget=config.scan_budget,
+            )
+
+    @property
+    def source_name(self) -> str:
+        return self.config.source_name
+
+    @property
+    def scan_interval(self) -> float:
+        if self.adaptive_interval is None:
+            return self.config.scan_interval
+        return self.adaptive_interval.seconds
+
+    def _diff_chunk(self, scan_id: str, chunk_index: int, diff: model.FullDiff, last: bool) -> model.DiffChunk:
+        return model.DiffChunk(source_name=self.source_name, scan_id=scan_id, chunk_index=chunk_index,
+                               last=last, diff=diff)
+
+    def scan(self, emit: Callable[[model.DiffChunk], None],
+             max_chunk_entries: Optional[int] = DEFAULT_MAX_CHUNK_ENTRIES) -> Optional[ScanSummary]:
+        """
+        Scans target in calling thread, non-empty diff chunks of the scan are passed to emit as soon as they are ready.
+        Returns None for the first scan (baseline).
+        """
+        # Called in scan thread, so time spent in executor queue is not counted
+        started = time.monotonic()
+
+        scan_id = uuid.uuid4().hex
+        summary = None  # type: ScanSummary
+        # Chunk is held back until it is known whether it is the last one
+        pending_chunk = None  # type: model.FullDiff
+
+        try:
+            for chunk in self.comparator.scan_chunks(max_chunk_entries):
+                if summary is None:
+                    summary = ScanSummary(0, 0, 0, 0)
+
+                if not chunk:
+                    continue
+
+                if pending_chunk is not None:
+                    emit(self._diff_chunk(scan_id, summary.chunks - 1, pending_chunk, last=False))
+
+                summary = ScanSummary(
+                    created=summary.created + len(chunk.created),
+                    deleted=summary.deleted + len(chunk.deleted),
+                    updated=summary.updated + len(chunk.updated),
+                    chunks=summary.chunks + 1,
+                )
+                pending_chunk = chunk
+
+            if pending_chunk is not None:
+                emit(self._diff_chunk(scan_id, summary.chunks - 1, pending_chunk, last=True))
+
+            return summary
+        finally:
+            self.last_scan_duration = time.monotonic() - started
+
+    def update_scan_interval(self, summary: Optional[ScanSummary]):
+        if self.adaptive_interval is None:
+            return
+
+        changes_count = 0 if summary is None else summary.changes_count
+
+        prev_seconds = self.adaptive_interval.seconds
+        interval = self.adaptive_interval.update(self.last_scan_duration, changes_count)
+
+        if interval.seconds != prev_seconds:
+            log.info(f"[{self.source_name}] Scan interval {prev_seconds:.2f}s -> {interval.seconds:.2f}s "
+                     f"({interval.reason})")
+        else:
+            log.debug(f"[{self.source_name}] Scan interval {interval.seconds:.2f}s ({interval.reason})")
+
+    @property
+    def event_driven(self) -> bool:
+        return isinstance(self.comparator, InotifyComparator) and not self.comparator.degraded
+
+    def close(self):
+        if isinstance(self.comparator, InotifyComparator):
+            self.comparator.close()
+
+        if self.content_hasher is not None:
+            self.content_hasher.close()
+
+
 class Agent:
-    def __init__(self, ws_url: str, scan_target: str, loop: asyncio.AbstractEventLoop):
+    """
+    Scans any number of targets, each with its own comparator, schedule and source name.
+    All targets share one scan thread pool and one connection to the collector.
+    """
+
+    def __init__(self, ws_url: str, targets: List[TargetConfig], loop: asyncio.AbstractEventLoop,
+                 state_dir: Optional[str] = None, scan_workers: int = 1, scan_threads: Optional[int] = None,
+                 hash_workers: int = DEFAULT_HASH_WORKERS, hash_rate_limit: Optional[float] = None,
+                 max_chunk_entries: int = DEFAULT_MAX_CHUNK_ENTRIES, diff_queue_size: int = DEFAULT_DIFF_QUEUE_SIZE,
+                 protocols: Sequence[str] = protocol.SUPPORTED_PROTOCOLS,
+                 compression: str = protocol.COMPRESSION_NONE,
+                 compress_threshold: int = protocol.DEFAULT_COMPRESS_THRESHOLD,
+                 compress_level: int = protocol.DEFAULT_COMPRESS_LEVEL,
+                 send_window: int = DEFAULT_SEND_WINDOW,
+                 spool_dir: Optional[str] = None, spool_max_size: int = DEFAULT_SPOOL_MAX_SIZE * 1024 * 1024,
+                 spool_policy: str = SPOOL_POLICY_BLOCK,
+                 coalesce_threshold: Optional[int] = DEFAULT_COALESCE_THRESHOLD,
+                 heartbeat: Optional[float] = DEFAULT_HEARTBEAT):
         self._loop = loop
-        self._diff_queue = asyncio.Queue(loop=loop)
-        self._launch_delay = 2
+        self._diff_queue = asyncio.Queue(maxsize=diff_queue_size, loop=loop)
+
+        # Diffs survive restarts and collector outages in spool, memory queue is not used then
+        self._spool = None  # type: Optional[DiffSpool]
+        if spool_dir is not None:
+            self._spool = DiffSpool(spool_dir, max_size=spool_max_size, policy=spool_policy)
+        self._max_chunk_entries = max_chunk_entries
+        self._closing = threading.Event()
+        # Burst of FS events is handled by single scan
+        self._events_debounce = 0.1
+
+        self._scan_executor = ThreadPoolExecutor(
+            max_workers=scan_threads or min(len(targets), DEFAULT_SCAN_THREADS) or 1,
+            thread_name_prefix="fspy-scan"
+        )
+
+        self._traversal_executor = None  # type: ThreadPoolExecutor
+        if scan_workers > 1:
+            self._traversal_executor = ThreadPoolExecutor(max_workers=scan_workers,
+                                                          thread_name_prefix="fspy-traversal")
+
+        # Hashing threads and disk throughput limit are shared by all targets
+        self._hash_executor = None  # type: ThreadPoolExecutor
+        self._hash_limiter = None  # type: RateLimiter
+        if any(config.content_hash for config in targets):
+            self._hash_executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="fspy-hash")
+
+            if hash_rate_limit:
+                self._hash_limiter = RateLimiter(hash_rate_limit)
+
+        self._targets = []  # type: List[ScanTarget]
+        for config in targets:
+            content_hasher = create_content_hasher(config, self._hash_executor, self._hash_limiter, state_dir)
+            comparator = create_comparator(config, state_dir, self._traversal_executor, content_hasher)
+            self._targets.append(ScanTarget(config, comparator, content_hasher))
+        self._target_tasks = []  # type: List[asyncio.Task]
+
+        self._diff_sender = DiffSender(
+            ws_url=ws_url,
+            diff_queue=self._diff_queue,
+            loop=loop,
+            protocols=protocols,
+            compression=compression,
+            compress_threshold=compress_threshold,
+            compress_level=compress_level,
+            window=send_window,
+            spool=self._spool,
+            coalesce_threshold=coalesce_threshold,
+            max_chunk_entries=max_chunk_entries,
+            heartbeat=heartbeat,
+        )
+
+    def _emit_chunk(self, chunk: model.DiffChunk):
+        """Called in scan thread. Blocks while diff queue is full, so scan can not run far ahead of sending"""
+        log_full_diff(chunk.diff)
+
+        if self._spool is not None:
+            try:
+                self._spool.put(chunk)
+                return
+            except SpoolClosedError:
+                raise concurrent.futures.CancelledError()
+
+        put_future = asyncio.run_coroutine_threadsafe(self._diff_queue.put(chunk), self._loop)
+
+        while True:
+            try:
+                return put_future.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                if self._closing.is_set():
+                    put_future.cancel()
+                    raise concurrent.futures.CancelledError()
 
-        self._scanner = SimpleComparator(scan_target)
-        self._diff_sender = DiffSender(ws_url=ws_url, diff_queue=self._diff_queue, loop=loop)
+    async def _collect_diff(self, target: ScanTarget):
+        # Thread of cancelled scan keeps running, so check state of the scan itself, not of awaiting coroutine
+        if target.scan_future is not None and not target.scan_future.done():
+            log.warning(f"[{target.source_name}] Previous directory scan is still running. Skipping this launch")
+            return
 
-    # TODO FIX: use single thread executor to totally prevent parallel launches of SimpleComparator
-    async def _collect_diff(self):
         # noinspection PyBroadException
         try:
-            log.debug("Running directory scan")
-            full_diff = await self._loop.run_in_executor(None, self._scanner.scan)
-            log.debug("Directory scan finished")
-
-            if full_diff:
-                log.info(f"FS changes detected "
-                         f"created: {len(full_diff.created)} "
-                         f"deleted: {len(full_diff.deleted)} "
-                         f"updated: {len(full_diff.updated)}")
-                log_full_diff(full_diff)
-
-                await self._diff_queue.put(full_diff)
+            log.debug(f"[{target.source_name}] Running directory scan")
+            target.scan_future = self._scan_executor.submit(target.scan, self._emit_chunk, self._max_chunk_entries)
+            summary = await asyncio.wrap_future(target.scan_future, loop=self._loop)
+            log.debug(f"[{target.source_name}] Directory scan finished in {target.last_scan_duration:.3f}s")
+
+            target.update_scan_interval(summary)
+
+            if summary is not None and summary.changes_count:
+                log.info(f"[{target.source_name}] FS changes detected "
+                         f"created: {summary.created} "
+                         f"deleted: {summary.deleted} "
+                         f"updated: {summary.updated} "
+                         f"chunks: {summary.chunks}")
             else:
-                log.debug("No FS changes was detected")
+                log.debug(f"[{target.source_name}] No FS changes was detected")
 
         except Exception:
-            log.exception("Exception during diff collection")
+            log.exception(f"[{target.source_name}] Exception during diff collection")
+
+    async def _wait_next_scan(self, target: ScanTarget):
+        if not target.event_driven:
+            await asyncio.sleep(target.scan_interval)
+            return
+
+        changed = self._loop.create_future()
+        fd = target.comparator.fileno()
+
+        self._loop.add_reader(fd, lambda: changed.done() or changed.set_result(None))
+        try:
+            await asyncio.wait_for(changed, timeout=target.config.reconcile_interval, loop=self._loop)
+            await asyncio.sleep(self._events_debounce)
+        except asyncio.TimeoutError:
+            log.debug(f"[{target.source_name}] No FS events during reconcile interval")
+        finally:
+            self._loop.remove_reader(fd)
+
+    async def _run_target(self, target: ScanTarget):
+        log.info(f"[{target.source_name}] Starting infinite scanning of {target.comparator.dir_path}")
+
+        while True:
+            await self._collect_diff(target)
+            await self._wait_next_scan(target)
 
     async def close(self):
+        self._closing.set()
+
+        for task in self._target_tasks:
+            task.cancel()
+
         await self._diff_sender.close()
 
+        if self._spool is not None:
+            self._spool.close()
+
+        # Background hashing of baselines is interrupted, so hash executor is not held by it
+        for target in self._targets:
+            if target.content_hasher is not None:
+                target.content_hasher.stop()
+
+        # Running scans stop at next emitted chunk (spool and queue are closed), they are waited for,
+        #  so inotify fd, snapshot and hash cache of targets are not closed under them. Scans wait for traversal
+        #  and hashing, so those executors are shut down after scan one
+        for executor in (self._scan_executor, self._traversal_executor, self._hash_executor):
+            if executor is not None:
+                await self._loop.run_in_executor(None, executor.shutdown)
+
+        for target in self._targets:
+            target.close()
+
     async def run(self):
         log.info("Running diff sender")
         await self._diff_sender.run()
 
-        log.info("Starting infinite directory scanning")
-        while True:
-            await self._collect_diff()
-            await asyncio.sleep(self._launch_delay)
+        self._target_tasks = [
+            asyncio.ensure_future(self._run_target(target), loop=self._loop)
+            for target in self._targets
+        ]
+
+        await asyncio.gather(*self._target_tasks, loop=self._loop)
 
 
-def main(scan_target: str, ws_url: str):
+def main(targets: List[TargetConfig], ws_url: str, state_dir: Optional[str] = None,
+         scan_workers: int = 1, scan_threads: Optional[int] = None,
+         hash_workers: int = DEFAULT_HASH_WORKERS, hash_rate_limit: Optional[float] = None,
+         max_chunk_entries: int = DEFAULT_MAX_CHUNK_ENTRIES,
+         protocols: Sequence[str] = protocol.SUPPORTED_PROTOCOLS,
+         compression: str = protocol.COMPRESSION_NONE,
+         compress_threshold: int = protocol.DEFAULT_COMPRESS_THRESHOLD,
+         compress_level: int = protocol.DEFAULT_COMPRESS_LEVEL,
+         send_window: int = DEFAULT_SEND_WINDOW,
+         spool_dir: Optional[str] = None, spool_max_size: int = DEFAULT_SPOOL_MAX_SIZE * 1024 * 1024,
+         spool_policy: str = SPOOL_POLICY_BLOCK,
+         coalesce_threshold: Optional[int] = DEFAULT_COALESCE_THRESHOLD,
+         heartbeat: Optional[float] = DEFAULT_HEARTBEAT):
     loop = asyncio.get_event_loop()
 
-    log.info(f"Client app start. Scan directory: {scan_target}. Server WS URL: {ws_url}")
+    log.info(f"Client app start. Targets: {', '.join(t.path for t in targets)}. Server WS URL: {ws_url}")
 
     agent = Agent(
         ws_url=ws_url,
-        scan_target=scan_target,
-        loop=loop
+        targets=targets,
+        loop=loop,
+        state_dir=state_dir,
+        scan_workers=scan_workers,
+        scan_threads=scan_threads,
+        hash_workers=hash_workers,
+        hash_rate_limit=hash_rate_limit,
+        max_chunk_entries=max_chunk_entries,
+        protocols=protocols,
+        compression=compression,
+        compress_threshold=compress_threshold,
+        compress_level=compress_level,
+        send_window=send_window,
+        spool_dir=spool_dir,
+        spool_max_size=spool_max_size,
+        spool_policy=spool_policy,
+        coalesce_threshold=coalesce_threshold,
+        heartbeat=heartbeat,
     )
 
     try:
@@ -1,59 +1,354 @@
 from typing import (
-    Dict, Optional, )
+    Dict, Optional, List, Tuple, Iterator, Iterable, Union, )
 
 import os
+import time
+import queue
+import threading
+import itertools
 from os import path
+from concurrent.futures import Executor, Future
 
 import logging
 
 from datetime import datetime
 import pytz
 
+from fspy.agent.filters import PathFilter
+from fspy.agent.hashing import ContentHasher
+from fspy.agent.snapshot import (
+    DirState, Snapshot, file_state_from_stat, load_snapshot, save_snapshot, CREATED, DELETED, UPDATED, )
 from fspy.common.model import FileState, FileDiff, FullDiff
 
 log = logging.getLogger(__name__)
 
+DEFAULT_MAX_CHUNK_ENTRIES = 1000
+
 
 def _file_state_from_file_path(file_path: str) -> FileState:
-    stat_info = os.stat(file_path)
+    return file_state_from_stat(file_path, os.stat(file_path))
+
+
+def _list_dir(dir_path: str,
+              path_filter: PathFilter = None) -> Optional[Tuple[List[Tuple[str, os.stat_result]], List[str]]]:
+    """
+    Lists single directory with os.scandir.
+    Returns (file name, stat result) pairs and paths of sub-directories to descend
+     or None if directory can not be listed.
+    Entries which disappear (or can not be accessed) during listing are skipped,
+     so are entries rejected by path_filter (file names are checked before stat call).
+    """
+    files = []
+    sub_dirs = []
+
+    try:
+        with os.scandir(dir_path) as dir_iter:
+            for entry in dir_iter:
+                try:
+                    if entry.is_dir():
+                        # Same as os.walk(followlinks=False): symlinks to directories are neither files nor descended
+                        if entry.is_symlink():
+                            continue
+
+                        if path_filter is None or path_filter.descend(dir_path, entry.name):
+                            sub_dirs.append(entry.path)
+                        continue
+
+                    if path_filter is None:
+                        files.append((entry.name, entry.stat()))
+                    elif path_filter.accept_name(dir_path, entry.name):
+                        stat_info = entry.stat()
+
+                        if path_filter.accept_stat(stat_info):
+                            files.append((entry.name, stat_info))
+
+                except FileNotFoundError:
+                    log.debug("File disappeared during scan: %s", entry.path)
+                except OSError as e:
+                    log.warning("Can not get stat for %s: %s", entry.path, e)
+
+    except FileNotFoundError:
+        log.debug("Directory disappeared during scan: %s", dir_path)
+        return None
+    except OSError as e:
+        log.warning("Can not list directory %s: %s", dir_path, e)
+        return None
+
+    return files, sub_dirs
+
+
+def _restat_files(dir_path: str, names: Tuple[str, ...],
+                  path_filter: PathFilter = None) -> List[Tuple[str, os.stat_result]]:
+    files = []
+
+    for name in names:
+        file_path = path.join(dir_path, name)
+
+        try:
+            stat_info = os.stat(file_path)
+
+            if path_filter is None or path_filter.accept_stat(stat_info):
+                files.append((name, stat_info))
+        except FileNotFoundError:
+            log.debug("File disappeared during scan: %s", file_path)
+        except OSError as e:
+            log.warning("Can not get stat for %s: %s", file_path, e)
+
+    return files
+
+
+def _scan_dir(dir_path: str,
+              ref_snapshot: Snapshot = None,
+              refresh_files: bool = True,
+              path_filter: PathFilter = None) -> Tuple[Optional[DirState], Optional[List[Tuple[str, os.stat_result]]]]:
+    """
+    Scans single directory. Returns its state and (file name, stat result) pairs.
+    If directory listing was not changed since reference scan, directory is not listed again:
+     its files are re-stat'ed by known names or (if not refresh_files) None is returned instead of files,
+     so they should be taken from reference snapshot as is.
+    """
+    try:
+        dir_stat = os.stat(dir_path)
+    except FileNotFoundError:
+        log.debug("Directory disappeared during scan: %s", dir_path)
+        return None, []
+    except OSError as e:
+        log.warning("Can not get stat for directory %s: %s", dir_path, e)
+        return None, []
+
+    ref_state = ref_snapshot.dir_state(dir_path) if ref_snapshot is not None else None
+
+    if ref_state is not None and ref_state.same_listing(dir_stat):
+        if refresh_files:
+            return ref_state, _restat_files(dir_path, ref_snapshot.file_names(dir_path), path_filter)
+
+        return ref_state, None
+
+    listed_ns = int(time.time() * 10 ** 9)
+    listing = _list_dir(dir_path, path_filter)
 
-    return FileState(
-        path=file_path,
-        date_created=datetime.fromtimestamp(stat_info.st_ctime, pytz.utc),
-        date_updated=datetime.fromtimestamp(stat_info.st_mtime, pytz.utc),
-        size=stat_info.st_size
+    if listing is None:
+        return None, []
+
+    files, sub_dirs = listing
+
+    dir_state = DirState(
+        inode=dir_stat.st_ino,
+        mtime_ns=dir_stat.st_mtime_ns,
+        listed_ns=listed_ns,
+        sub_dirs=tuple(sub_dirs),
     )
 
+    return dir_state, files
+
+
+def _add_scan_result(snapshot: Snapshot, dir_path: str, dir_state: DirState,
+                     files: Optional[List[Tuple[str, os.stat_result]]], ref_snapshot: Optional[Snapshot]):
+    dir_id = snapshot.set_dir(dir_path, dir_state)
+
+    if files is None:
+        snapshot.copy_files(dir_id, ref_snapshot, dir_path)
+    else:
+        for name, stat_info in files:
+            snapshot.add_file(dir_id, name, stat_info)
+
+
+def scandir_snapshot(dir_path: str, ref_snapshot: Snapshot = None, refresh_files: bool = True,
+                     path_filter: PathFilter = None) -> Snapshot:
+    """
+    Builds snapshot of directory tree.
+    If reference snapshot is provided - directories with unchanged listing are not listed again.
+    If path filter is provided - excluded directories are pruned and excluded files are not stat'ed.
+    """
+    snapshot = Snapshot()
+    pending_dirs = [dir_path]
+
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        dir_state, files = _scan_dir(current_dir, ref_snapshot, refresh_files, path_filter)
+
+        if dir_state is None:
+            continue
+
+        _add_scan_result(snapshot, current_dir, dir_state, files, ref_snapshot)
+        pending_dirs.extend(dir_state.sub_dirs)
+
+    return snapshot
+
+
+def parallel_scandir_snapshot(dir_path: str, executor: Executor, ref_snapshot: Snapshot = None,
+                              refresh_files: bool = True, path_filter: PathFilter = None) -> Snapshot:
+    """
+    Same as scandir_snapshot, but directories are scanned concurrently on executor.
+    Useful when scan is latency-bound (e.g. NFS/SMB mounts): stat calls of different directories overlap.
+    Results are merged into snapshot by calling thread only.
+    """
+    snapshot = Snapshot()
+    results = queue.Queue()  # type: queue.Queue
+
+    def submit(current_dir: str):
+        future = executor.submit(_scan_dir, current_dir, ref_snapshot, refresh_files, path_filter)
+        future.add_done_callback(lambda f: results.put((current_dir, f)))
+
+    submit(dir_path)
+    in_progress = 1
+
+    while in_progress:
+        current_dir, future = results.get()  # type: str, Future
+        in_progress -= 1
+
+        dir_state, files = future.result()
+
+        if dir_state is None:
+            continue
+
+        _add_scan_result(snapshot, current_dir, dir_state, files, ref_snapshot)
+
+        for sub_dir in dir_state.sub_dirs:
+            submit(sub_dir)
+            in_progress += 1
+
+    return snapshot
+
+
+def walk_snapshot(dir_path: str) -> Dict[str, FileState]:
+    """
+    Reference implementation: os.walk + separate os.stat call for each file, stored as dict of FileState.
+    Kept for comparison in benchmarks.
+    """
+    snapshot = {}
+
+    for walk_dir_path, dirs, files in os.walk(dir_path):
+        for fn in files:
+            full_fn = path.join(walk_dir_path, fn)
+
+            try:
+                snapshot[full_fn] = _file_state_from_file_path(full_fn)
+            except FileNotFoundError:
+                log.debug("File disappeared during scan: %s", full_fn)
+
+    return snapshot
+
+
+def iter_diff_chunks(entries: Iterable[Tuple[str, Union[FileState, FileDiff]]],
+                     run_start: datetime, run_end: datetime, max_entries: Optional[int] = None) -> Iterator[FullDiff]:
+    """
+    Groups (kind, entry) pairs of Snapshot.iter_diff into FullDiff chunks of at most max_entries entries.
+    At least one (possibly empty) chunk is yielded.
+    """
+    def new_chunk():
+        return FullDiff(run_start=run_start, run_end=run_end, created=[], deleted=[], updated=[])
+
+    chunk = new_chunk()
+    entries_count = 0
+
+    for kind, entry in entries:
+        if entries_count == max_entries:
+            yield chunk
+            chunk = new_chunk()
+            entries_count = 0
+
+        getattr(chunk, kind).append(entry)
+        entries_count += 1
+
+    yield chunk
+
+
+def split_diff(full_diff: FullDiff, max_entries: Optional[int] = None) -> Iterator[FullDiff]:
+    entries = itertools.chain(
+        ((CREATED, file_state) for file_state in full_diff.created),
+        ((DELETED, file_state) for file_state in full_diff.deleted),
+        ((UPDATED, file_diff) for file_diff in full_diff.updated),
+    )
+
+    return iter_diff_chunks(entries, full_diff.run_start, full_diff.run_end, max_entries)
+
+
+class ScanInProgressError(RuntimeError):
+    pass
+
+
+def check_scan_target(dir_path: str, comparator_name: str) -> str:
+    if not os.path.isabs(dir_path):
+        dir_path = path.abspath(dir_path)
+
+    base_error_text = f"Can not create {comparator_name} for '{dir_path}'"
+
+    if not path.exists(dir_path):
+        raise ValueError(f"{base_error_text}: not exists")
+
+    if not path.isdir(dir_path):
+        raise ValueError(f"{base_error_text}: not a directory")
+
+    return dir_path
+
 
 class SimpleComparator:
-    def __init__(self, dir_path: str):
-        if not os.path.isabs(dir_path):
-            dir_path = path.abspath(dir_path)
+    """
+    Compares snapshots of directory tree taken on each scan.
+
+    Per-directory states are stored in reference snapshot. In incremental mode
+     directories with unchanged mtime/inode are not listed again.
+    Fast mode (implies incremental) also does not re-stat files of such directories,
+     so in-place file updates are detected only when the containing directory changes.
+
+    If snapshot_path is provided, reference snapshot is loaded from it on start
+     and written to it after each scan with changes, so first scan after restart produces real diff.
+
+    If traversal_executor is provided, directories are scanned concurrently on it.
+    If path_filter is provided, only matching part of the tree is scanned.
+    If content_hasher is provided, diff entries get content hashes.
+    Concurrent scans are not allowed: ScanInProgressError is raised.
+    """
+
+    def __init__(self, dir_path: str, incremental: bool = False, fast: bool = False,
+                 snapshot_path: Optional[str] = None, traversal_executor: Optional[Executor] = None,
+                 path_filter: Optional[PathFilter] = None, content_hasher: Optional[ContentHasher] = None):
+        self._dir_path = check_scan_target(dir_path, type(self).__name__)
+        self._incremental = incremental or fast
+        self._fast = fast
+
+        # Rules which reject nothing only slow down traversal
+        self._path_filter = path_filter if path_filter is not None and not path_filter.empty else None
 
-        base_error_text = f"Can not create SimpleComparator for '{dir_path}'"
+        self._traversal_executor = traversal_executor
+        self._content_hasher = content_hasher
+        self._scan_lock = threading.Lock()
 
-        if not path.exists(dir_path):
-            raise ValueError(f"{base_error_text}: not exists")
+        self._snapshot_path = snapshot_path
+        self._ref_snapshot = None  # type: Snapshot
 
-        if not path.isdir(dir_path):
-            raise ValueError(f"{base_error_text}: not a directory")
+        if snapshot_path is not None:
+            self._ref_snapshot = load_snapshot(snapshot_path, self._dir_path)
 
-        self._dir_path = dir_path
-        self._ref_snapshot = None  # type: Dict[str, FileState]
+            if self._ref_snapshot is not None:
+                log.info(f"Reference snapshot with {len(self._ref_snapshot)} files loaded from {snapshot_path}")
 
-    def get_snapshot(self) -> Dict[str, FileState]:
-        new_snapshot = {}
+    @property
+    def dir_path(self) -> str:
+        return self._dir_path
 
-        for dir_path, dirs, files in os.walk(self._dir_path):
-            for fn in files:
-                full_fn = path.join(dir_path, fn)
+    def get_snapshot(self) -> Snapshot:
+        ref_snapshot = self._ref_snapshot if self._incremental else None
 
-                new_snapshot[full_fn] = _file_state_from_file_path(full_fn)
+        if self._traversal_executor is not None:
+            return parallel_scandir_snapshot(self._dir_path, self._traversal_executor, ref_snapshot=ref_snapshot,
+                                             refresh_files=not self._fast, path_filter=self._path_filter)
 
-        return new_snapshot
+        return scandir_snapshot(self._dir_path, ref_snapshot=ref_snapshot, refresh_files=not self._fast,
+                                path_filter=self._path_filter)
+
+    def _save_snapshot(self):
+        if self._snapshot_path is None:
+            return
+
+        try:
+            save_snapshot(self._ref_snapshot, self._snapshot_path, self._dir_path)
+        except OSError as e:
+            log.error(f"Can not save reference snapshot to {self._snapshot_path}: {e}")
 
     @staticmethod
-    def get_diff(old: Dict[str, FileState], new: Dict[str, FileState],
+    def get_diff(old: Snapshot, new: Snapshot,
                  run_start: datetime = None, run_end: datetime = None) -> FullDiff:
 
         now = datetime.now(pytz.utc)
@@ -61,33 +356,65 @@ class SimpleComparator:
         run_start = now if run_start is None else run_start
         run_end = now if run_end is None else run_end
 
+        created, deleted, updated = old.diff(new)
+
         return FullDiff(
             run_start=run_start,
             run_end=run_end,
 
-            created=[new[fn] for fn in new.keys() - old.keys()],
-            deleted=[old[fn] for fn in old.keys() - new.keys()],
-            updated=[
-                FileDiff(
-                    before=old[fn],
-                    after=new[fn],
-                )
-                for fn in old.keys() & new.keys()
-                if old[fn] != new[fn]
-            ],
+            created=created,
+            deleted=deleted,
+            updated=updated,
         )
 
     def scan(self) -> Optional[FullDiff]:
+        """Returns diff with previous scan or None for the first scan"""
+        chunks = list(self.scan_chunks(max_entries=None))
+        return chunks[0] if chunks else None
+
+    def scan_chunks(self, max_entries: Optional[int] = DEFAULT_MAX_CHUNK_ENTRIES) -> Iterator[FullDiff]:
+        """
+        Same as scan(), but diff is produced lazily in chunks of at most max_entries entries,
+         so huge diffs are never held in memory at once.
+        Nothing is yielded for the first scan, otherwise at least one (possibly empty) chunk.
+        """
+        if not self._scan_lock.acquire(blocking=False):
+            raise ScanInProgressError(f"Scan of {self._dir_path} is already running")
+
+        try:
+            yield from self._scan_chunks(max_entries)
+        finally:
+            self._scan_lock.release()
+
+    def _scan_chunks(self, max_entries: Optional[int]) -> Iterator[FullDiff]:
         scan_start = datetime.now(pytz.utc)
         new_snapshot = self.get_snapshot()
         scan_end = datetime.now(pytz.utc)
 
-        if self._ref_snapshot is None:
-            self._ref_snapshot = new_snapshot
-            return None
-
-        full_diff = self.get_diff(old=self._ref_snapshot, new=new_snapshot,
-                                  run_start=scan_start, run_end=scan_end)
+        old_snapshot = self._ref_snapshot
         self._ref_snapshot = new_snapshot
 
-        return full_diff
+        if old_snapshot is None:
+            self._save_snapshot()
+
+            if self._content_hasher is not None:
+                self._content_hasher.refresh(new_snapshot)
+
+            return
+
+        changed = False
+
+        for chunk in iter_diff_chunks(old_snapshot.iter_diff(new_snapshot), scan_start, scan_end, max_entries):
+            changed = changed or bool(chunk)
+
+            if self._content_hasher is not None:
+                self._content_hasher.annotate(chunk, new_snapshot)
+
+            yield chunk
+
+        if self._content_hasher is not None:
+            self._content_hasher.refresh(new_snapshot)
+
+        # Unchanged snapshot differs from saved one only by listing times, no need to rewrite it
+        if changed:
+            self._save_snapshot()
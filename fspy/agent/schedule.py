@@ -0,0 +1,71 @@
+from typing import NamedTuple
+
+DEFAULT_MIN_SCAN_INTERVAL = 1
+DEFAULT_MAX_SCAN_INTERVAL = 60
+DEFAULT_SCAN_BUDGET = 0.1
+
+# Interval is divided by this factor after scan with changes and multiplied after idle one
+SPEEDUP_FACTOR = 2
+SLOWDOWN_FACTOR = 1.5
+
+
+class ScanInterval(NamedTuple):
+    seconds: float
+    reason: str
+
+
+class AdaptiveScanInterval:
+    """
+    Chooses delay before next scan of target from results of previous one.
+
+    Delay is shortened after scans which found changes and lengthened after idle ones.
+    Budget is max share of wall time which may be spent on scanning of target (CPU and IO):
+     scan which took 3s with budget 0.1 is followed by at least 27s pause.
+    Resulting delay is always kept within [min_interval, max_interval].
+    """
+
+    def __init__(self, initial: float, min_interval: float = DEFAULT_MIN_SCAN_INTERVAL,
+                 max_interval: float = DEFAULT_MAX_SCAN_INTERVAL, budget: float = DEFAULT_SCAN_BUDGET):
+        if not 0 < budget <= 1:
+            raise ValueError(f"Scan budget must be in (0, 1], got {budget}")
+
+        if min_interval > max_interval:
+            raise ValueError(f"Min scan interval {min_interval} is greater than max scan interval {max_interval}")
+
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+
+        self._interval = ScanInterval(self._clamp(initial), "initial")
+
+    @property
+    def seconds(self) -> float:
+        return self._interval.seconds
+
+    @property
+    def reason(self) -> str:
+        return self._interval.reason
+
+    def _clamp(self, seconds: float) -> float:
+        return min(max(seconds, self.min_interval), self.max_interval)
+
+    def update(self, scan_duration: float, changes_count: int) -> ScanInterval:
+        if changes_count:
+            seconds = self.seconds / SPEEDUP_FACTOR
+            reason = f"{changes_count} changes detected"
+        else:
+            seconds = self.seconds * SLOWDOWN_FACTOR
+            reason = "no changes"
+
+        budget_seconds = scan_duration / self.budget - scan_duration
+        if budget_seconds > seconds:
+            seconds = budget_seconds
+            reason = f"scan took {scan_duration:.3f}s, budget {self.budget:.0%}"
+
+        if seconds < self.min_interval:
+            reason = f"{reason}, min bound"
+        elif seconds > self.max_interval:
+            reason = f"{reason}, max bound"
+
+        self._interval = ScanInterval(self._clamp(seconds), reason)
+        return self._interval
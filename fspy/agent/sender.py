@@ -1,25 +1,119 @@
-from typing import Optional
+from typing import Optional, Sequence, Dict, Deque, NamedTuple
 
+import random
 import asyncio
 import aiohttp
+from collections import OrderedDict, deque
 
 import logging
 
-from fspy.common import model
+from fspy.agent.coalesce import coalesce_chunks
+from fspy.agent.scanner import DEFAULT_MAX_CHUNK_ENTRIES
+from fspy.agent.spool import DiffSpool
+from fspy.common import model, protocol
 
 log = logging.getLogger(__name__)
 
+# Messages sent but not acknowledged yet
+DEFAULT_SEND_WINDOW = 8
+DEFAULT_MAX_ATTEMPTS = 10
+# Base and cap (seconds) of exponential backoff of resending and reconnecting
+DEFAULT_ATTEMPTS_DELAY = 1
+DEFAULT_MAX_ATTEMPTS_DELAY = 60
+# Interval (seconds) of pings to collector, connection without pong is closed
+DEFAULT_HEARTBEAT = 30
+
+
+class _Pending(NamedTuple):
+    chunk: model.DiffChunk
+    attempt: int
+    # Id in spool, if diff was taken from spool
+    record_id: Optional[int]
+
 
 class DiffSender:
-    def __init__(self, ws_url: str, diff_queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+    """
+    Sends diff chunks from queue to collector.
+    Wire protocol is negotiated on connect: first of protocols supported by collector is used,
+     collectors which do not support negotiation get JSON.
+    Compression (see fspy.common.protocol) is either zlib for binary messages larger than compress_threshold
+     or permessage-deflate extension for all messages, if collector accepts it.
+
+    With sequenced protocol up to window messages are sent without waiting for responses,
+     each response acknowledges (or rejects) message by its sequence number. Otherwise message is sent
+     after previous one is acknowledged.
+    Rejected messages are resent after backoff delay, messages in flight when connection is lost - after reconnect.
+     Collector skips chunks it already saved, so resending is safe. Message is dropped after max_attempts,
+     unless it is spooled. Rejections with retry_after (collector is busy) are not counted as attempts.
+    Delays of resending and reconnecting grow exponentially from attempts_delay up to max_attempts_delay
+     and are picked at random below that bound (full jitter), so agents which lost collector at the same time
+     do not come back at the same time. Collector may ask to wait longer with retry_after in response.
+     Dead connections are detected by pings every heartbeat seconds.
+
+    When coalesce_threshold or more chunks are queued, queued scans of each source are merged into one net diff
+     (see fspy.agent.coalesce), so agent catching up after outage sends only the outcome of missed changes.
+
+    If spool is provided, diffs are taken from it instead of the queue and removed from it only when acknowledged,
+     so diffs not sent before restart are sent after it. Spooled diffs are resent until collector accepts them.
+    """
+
+    def __init__(self, ws_url: str, diff_queue: asyncio.Queue, loop: asyncio.AbstractEventLoop,
+                 protocols: Sequence[str] = protocol.SUPPORTED_PROTOCOLS,
+                 compression: str = protocol.COMPRESSION_NONE,
+                 compress_threshold: int = protocol.DEFAULT_COMPRESS_THRESHOLD,
+                 compress_level: int = protocol.DEFAULT_COMPRESS_LEVEL,
+                 window: int = DEFAULT_SEND_WINDOW,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 attempts_delay: float = DEFAULT_ATTEMPTS_DELAY,
+                 max_attempts_delay: float = DEFAULT_MAX_ATTEMPTS_DELAY,
+                 heartbeat: Optional[float] = DEFAULT_HEARTBEAT,
+                 spool: Optional[DiffSpool] = None,
+                 coalesce_threshold: Optional[int] = None,
+                 max_chunk_entries: Optional[int] = DEFAULT_MAX_CHUNK_ENTRIES):
+        if compression not in protocol.COMPRESSION_MODES:
+            raise ValueError(f"Unknown compression {compression}. Expected one of {protocol.COMPRESSION_MODES}")
+
+        if window < 1:
+            raise ValueError(f"Send window must be positive, got {window}")
+
         self._loop = loop
 
         self._ws_url = ws_url
         self._ws = None
+        self._protocols = tuple(protocols)
+        # Window bits of permessage-deflate, 0 - do not offer the extension
+        self._ws_compress = 15 if compression == protocol.COMPRESSION_DEFLATE else 0
+        self._compress_threshold = compress_threshold if compression == protocol.COMPRESSION_ZLIB else None
+        self._compress_level = compress_level
+        self._heartbeat = heartbeat
         self._session = aiohttp.ClientSession(loop=loop)
 
+        self._window = window
+        self._max_attempts = max_attempts
+        self._attempts_delay = attempts_delay
+        self._max_attempts_delay = max_attempts_delay
+
+        # Failed connections since last acknowledged diff
+        self._reconnects = 0
+        # Loop time before which collector asked not to come back
+        self._not_before = 0.0
+
+        self._next_seq = 0
+        self._in_flight = OrderedDict()  # type: Dict[int, _Pending]
+        self._retry = deque()  # type: Deque[_Pending]
+        # Set on responses and scheduled retries
+        self._wakeup = asyncio.Event(loop=loop)
+
         self._diff_send_task = None  # type: asyncio.Task
+        self._diff_get_task = None  # type: asyncio.Task
         self._diff_queue = diff_queue
+        self._coalesce_threshold = coalesce_threshold
+        self._max_chunk_entries = max_chunk_entries
+
+        self._spool = spool
+        if spool is not None:
+            # Diffs are put to spool from scan threads
+            spool.on_put = lambda: loop.call_soon_threadsafe(self._wakeup.set)
 
     async def _get_ws(self) -> Optional[aiohttp.ClientWebSocketResponse]:
         if self._ws is None or self._ws.closed:
@@ -27,63 +121,236 @@ class DiffSender:
             self._ws = None
             # noinspection PyBroadException
             try:
-                self._ws = await self._session.ws_connect(self._ws_url)
-                log.info("Web-socket connection established")
+                self._ws = await self._session.ws_connect(self._ws_url, protocols=self._protocols,
+                                                          compress=self._ws_compress, heartbeat=self._heartbeat)
+                ws_protocol = self._ws.protocol or protocol.JSON_PROTOCOL
+                log.info(f"Web-socket connection established. Protocol: {ws_protocol}, "
+                         f"permessage-deflate: {'on' if self._ws.compress else 'off'}")
+
+                if self._compress_threshold is not None and ws_protocol not in protocol.COMPRESSED_PROTOCOLS:
+                    log.warning("Collector does not support compressed messages, diffs are sent uncompressed")
             except Exception:
                 log.exception("Failed to connect to web-socket")
                 return None
 
         return self._ws
 
-    async def _send_diff_attempt(self, diff: model.FullDiff) -> bool:
-        ws = await self._get_ws()
+    def _done(self, pending: _Pending):
+        """Diff is acknowledged by collector"""
+        if pending.record_id is not None:
+            self._spool.ack(pending.record_id)
 
-        if ws is None:
-            log.warning("Can not get WS. Waiting for next attempt")
-            return False
+    def _backoff(self, attempt: int) -> float:
+        """Full jitter: random delay below exponentially growing bound, but not sooner than collector asked"""
+        bound = min(self._max_attempts_delay, self._attempts_delay * 2 ** min(attempt - 1, 32))
+        return max(random.uniform(0, bound), self._not_before - self._loop.time())
 
+    def _retry_later(self, pending: _Pending, delay: float, count_attempt: bool = True):
+        """count_attempt=False - diff was not tried by collector (it is busy), so attempt is not used up"""
+        if count_attempt and pending.attempt >= self._max_attempts:
+            if pending.record_id is None:
+                log.warning(f"Max number of attempts was exceeded. Diff of {pending.chunk.source_name} "
+                            f"(scan {pending.chunk.scan_id}, chunk {pending.chunk.chunk_index}) will not be sent.")
+                return
+
+            # Spooled diff is never given up (only acknowledgement removes it), it is resent with capped backoff
+            if pending.attempt == self._max_attempts:
+                log.warning(f"Max number of attempts was exceeded. Spooled diff of {pending.chunk.source_name} "
+                            f"(scan {pending.chunk.scan_id}, chunk {pending.chunk.chunk_index}) is kept in spool "
+                            f"and resent until collector accepts it.")
+
+        def schedule():
+            self._retry.append(pending._replace(attempt=pending.attempt + 1) if count_attempt else pending)
+            self._wakeup.set()
+
+        if delay:
+            self._loop.call_later(delay, schedule)
+        else:
+            schedule()
+
+    async def _receive_responses(self, ws: aiohttp.ClientWebSocketResponse):
+        """Returns when connection is closed or broken"""
         # noinspection PyBroadException
         try:
-            await ws.send_str(diff.json())
-            resp_dict = await ws.receive_json()
-            resp = model.DiffReportHandlingResponse(**resp_dict)
+            while True:
+                resp_dict = await ws.receive_json()
+                resp = model.DiffReportHandlingResponse(**resp_dict)
+
+                if resp.retry_after is not None:
+                    log.warning(f"Collector asks to wait {resp.retry_after:.1f}s. Message: '{resp.message}'")
+                    self._not_before = max(self._not_before, self._loop.time() + resp.retry_after)
+
+                    if resp.seq is None and not self._in_flight:
+                        # Not an answer to diff, e.g. connection is not admitted
+                        continue
 
-            if not resp.handled:
-                log.error(f"Server did not handle diff. Message: '{resp.message}'. Waiting for next attempt")
-                return False
+                # Collectors without sequence numbers answer in order
+                seq = resp.seq if resp.seq is not None else next(iter(self._in_flight), None)
+                pending = self._in_flight.pop(seq, None)
 
+                if pending is None:
+                    log.warning(f"Response to unknown message {seq}: {resp_dict}")
+                    continue
+
+                self._wakeup.set()
+
+                if resp.handled:
+                    log.debug(f"Diff {seq} successfully sent to server")
+                    self._reconnects = 0
+                    self._done(pending)
+                elif resp.retry_after is not None:
+                    # Collector is overloaded, diff is resent after the wait it asked for
+                    self._retry_later(pending, self._backoff(pending.attempt), count_attempt=False)
+                else:
+                    log.error(f"Server did not handle diff {seq} (attempt {pending.attempt} of {self._max_attempts})."
+                              f" Message: '{resp.message}'. Waiting for next attempt")
+                    self._retry_later(pending, self._backoff(pending.attempt))
+
+        except asyncio.CancelledError:
+            raise
         except Exception:
-            log.exception("Error during sending diff report. Waiting for next attempt")
-            return False
+            if ws.closed:
+                log.info(f"Web-socket connection closed. Code: {ws.close_code}")
+            else:
+                log.exception("Error during receiving responses")
 
-        return True
+    async def _wait(self, receiver: asyncio.Future, *futures: asyncio.Future):
+        """Waits for any of futures, response or retry. Returns immediately if receiver is done"""
+        self._wakeup.clear()
+        wakeup = asyncio.ensure_future(self._wakeup.wait(), loop=self._loop)
 
-    async def _send_diff(self, diff, max_attempts=10, attempts_delay=5) -> bool:
+        try:
+            await asyncio.wait([receiver, wakeup, *futures], loop=self._loop, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            wakeup.cancel()
 
-        for attempt_num in range(1, max_attempts + 1):
-            log.debug(f"Trying to send diff (attempt {attempt_num} of {max_attempts})")
-            success = await self._send_diff_attempt(diff)
-            if success:
-                log.debug(f"Diff successfully sent to server")
-                return True
+    def _log_new(self, chunk: model.DiffChunk, origin: str):
+        log.info(f"Trying to send to server diff of {chunk.source_name} from {origin} "
+                 f"(scan {chunk.scan_id}, chunk {chunk.chunk_index}{', last' if chunk.last else ''})")
 
-            if attempt_num != max_attempts:
-                await asyncio.sleep(attempts_delay)
+    def _coalesce_queue(self):
+        """Replaces queued chunks with coalesced ones. Queue is not awaited, so nothing is put in between"""
+        chunks = []
+        while not self._diff_queue.empty():
+            chunks.append(self._diff_queue.get_nowait())
 
-        log.warning("Max number of attempts was exceeded. This diff will not be sent.")
-        return False
+        coalesced = coalesce_chunks(chunks, self._max_chunk_entries)
+
+        # Coalesced chunks are never more than original ones, so they fit into queue
+        for chunk in coalesced:
+            self._diff_queue.put_nowait(chunk)
+
+        if len(coalesced) < len(chunks):
+            log.info(f"Diff queue backlog coalesced: {len(chunks)} -> {len(coalesced)} chunks")
+
+    async def _next_pending(self, receiver: asyncio.Future) -> Optional[_Pending]:
+        """
+        Returns next diff to send: diff to retry or new one from queue or spool. None if connection is lost.
+        Nothing is returned before time collector asked to wait for
+        """
+        while not receiver.done():
+            wait_time = self._not_before - self._loop.time()
+            if wait_time > 0:
+                timer = asyncio.ensure_future(asyncio.sleep(wait_time, loop=self._loop), loop=self._loop)
+                try:
+                    await self._wait(receiver, timer)
+                finally:
+                    timer.cancel()
+                continue
+
+            if self._retry:
+                return self._retry.popleft()
+
+            if self._spool is not None:
+                record = self._spool.get_nowait()
+                if record is not None:
+                    self._log_new(record.chunk, "spool")
+                    return _Pending(record.chunk, 1, record.record_id)
+
+                await self._wait(receiver)
+                continue
+
+            if self._coalesce_threshold and self._diff_queue.qsize() >= self._coalesce_threshold:
+                self._coalesce_queue()
+
+            # Task is not cancelled between calls, so diff taken from queue is never lost
+            if self._diff_get_task is None:
+                self._diff_get_task = asyncio.ensure_future(self._diff_queue.get(), loop=self._loop)
+
+            await self._wait(receiver, self._diff_get_task)
+
+            if self._diff_get_task.done():
+                chunk = self._diff_get_task.result()  # type: model.DiffChunk
+                self._diff_get_task = None
+
+                self._log_new(chunk, "queue")
+                return _Pending(chunk, 1, None)
+
+        return None
+
+    async def _send(self, ws: aiohttp.ClientWebSocketResponse, chunk: model.DiffChunk):
+        if ws.protocol in protocol.BINARY_PROTOCOLS:
+            await ws.send_bytes(protocol.encode_diff_chunk(chunk, ws.protocol,
+                                                           compress_threshold=self._compress_threshold,
+                                                           compress_level=self._compress_level))
+        else:
+            await ws.send_str(chunk.json())
+
+    async def _serve_connection(self, ws: aiohttp.ClientWebSocketResponse):
+        """Sends diffs until connection is lost"""
+        window = self._window if ws.protocol in protocol.SEQUENCED_PROTOCOLS else 1
+        receiver = asyncio.ensure_future(self._receive_responses(ws), loop=self._loop)
 
-    async def _serve_diff_queue(self):
         try:
-            # Initial attempt to connect
-            await self._get_ws()
+            while True:
+                pending = await self._next_pending(receiver)
+                if pending is None:
+                    break
 
+                # Each transmission gets its own number, so late response to previous one is not confused with it
+                seq = self._next_seq
+                self._next_seq = (self._next_seq + 1) % 2 ** 32
+
+                pending.chunk.seq = seq
+                self._in_flight[seq] = pending
+
+                # noinspection PyBroadException
+                try:
+                    await self._send(ws, pending.chunk)
+                except Exception:
+                    log.exception("Error during sending diff report. Waiting for next attempt")
+                    break
+
+                while len(self._in_flight) >= window and not receiver.done():
+                    await self._wait(receiver)
+
+        finally:
+            receiver.cancel()
+
+            if not ws.closed:
+                await ws.close()
+
+            if self._in_flight:
+                log.warning(f"Connection lost, {len(self._in_flight)} diffs will be resent")
+
+            for pending in self._in_flight.values():
+                self._retry_later(pending, 0)
+            self._in_flight.clear()
+
+    async def _serve_diff_queue(self):
+        try:
             while True:
-                log.debug("Awaiting next diff in queue")
-                next_diff = await self._diff_queue.get()
+                ws = await self._get_ws()
+
+                if ws is not None:
+                    await self._serve_connection(ws)
+
+                self._reconnects += 1
+                delay = self._backoff(self._reconnects)
+
+                log.warning(f"No connection to collector. Next attempt in {delay:.1f}s")
+                await asyncio.sleep(delay, loop=self._loop)
 
-                log.info("Trying to send to server diff from queue")
-                await self._send_diff(next_diff)
         except asyncio.CancelledError:
             log.info("Diff queue serving was canceled")
 
@@ -91,6 +358,9 @@ class DiffSender:
         if self._diff_send_task:
             self._diff_send_task.cancel()
 
+        if self._diff_get_task:
+            self._diff_get_task.cancel()
+
         if self._ws:
             await self._ws.close()
 
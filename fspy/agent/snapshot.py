@@ -0,0 +1,468 @@
+from typing import (
+    Dict, Optional, List, Tuple, Iterator, NamedTuple, Union, )
+
+import os
+import sys
+import mmap
+import zlib
+import struct
+import hashlib
+from os import path
+from array import array
+
+import logging
+
+from datetime import datetime
+import pytz
+
+from fspy.common.model import FileState, FileDiff
+
+log = logging.getLogger(__name__)
+
+# Directories modified within this window before their listing are listed again on next scan:
+# changes made in the same timestamp tick as the listing do not move directory mtime
+RACY_DIR_WINDOW_NS = 2 * 10 ** 9
+
+_NS_IN_SECOND = 10 ** 9
+
+# Kinds of diff entries, same as names of FullDiff fields
+CREATED = "created"
+DELETED = "deleted"
+UPDATED = "updated"
+
+
+class DirState(NamedTuple):
+    inode: int
+    mtime_ns: int
+    listed_ns: int
+
+    sub_dirs: Tuple[str, ...]
+
+    def same_listing(self, stat_info: os.stat_result) -> bool:
+        return (
+            self.inode == stat_info.st_ino
+            and self.mtime_ns == stat_info.st_mtime_ns
+            and self.listed_ns - self.mtime_ns > RACY_DIR_WINDOW_NS
+        )
+
+
+def datetime_from_ns(timestamp_ns: int) -> datetime:
+    # Exact conversion (float seconds lose precision on microseconds rounding)
+    seconds, ns = divmod(timestamp_ns, _NS_IN_SECOND)
+    return datetime.fromtimestamp(seconds, pytz.utc).replace(microsecond=ns // 1000)
+
+
+def file_state_from_stat(file_path: str, stat_info: os.stat_result) -> FileState:
+    return FileState(
+        path=file_path,
+        date_created=datetime_from_ns(stat_info.st_ctime_ns),
+        date_updated=datetime_from_ns(stat_info.st_mtime_ns),
+        size=stat_info.st_size
+    )
+
+
+class Snapshot:
+    """
+    Compact snapshot of directory tree.
+
+    Directory paths are stored once in directory table. Files are stored per directory as name -> row,
+     raw stat values of each row are kept in typed arrays.
+    FileState objects are created only on demand (e.g. for entries which get into diff).
+    """
+    __slots__ = ('_dir_ids', '_dir_paths', '_dir_states', '_dir_files',
+                 '_inode', '_size', '_mtime_ns', '_ctime_ns', '_files_count')
+
+    def __init__(self):
+        self._dir_ids = {}  # type: Dict[str, int]
+        self._dir_paths = []  # type: List[str]
+        self._dir_states = []  # type: List[Optional[DirState]]
+        self._dir_files = []  # type: List[Dict[str, int]]
+
+        self._inode = array('Q')
+        self._size = array('Q')
+        self._mtime_ns = array('q')
+        self._ctime_ns = array('q')
+
+        self._files_count = 0
+
+    def __len__(self) -> int:
+        return self._files_count
+
+    def __contains__(self, file_path: str) -> bool:
+        return self.get(file_path) is not None
+
+    def dir_paths(self) -> List[str]:
+        return list(self._dir_ids)
+
+    def dir_state(self, dir_path: str) -> Optional[DirState]:
+        dir_id = self._dir_ids.get(dir_path)
+        return None if dir_id is None else self._dir_states[dir_id]
+
+    def file_names(self, dir_path: str) -> Tuple[str, ...]:
+        dir_id = self._dir_ids.get(dir_path)
+        return () if dir_id is None else tuple(self._dir_files[dir_id])
+
+    def set_dir(self, dir_path: str, dir_state: Optional[DirState] = None) -> int:
+        dir_id = self._dir_ids.get(dir_path)
+
+        if dir_id is None:
+            dir_id = len(self._dir_paths)
+            self._dir_ids[dir_path] = dir_id
+            self._dir_paths.append(dir_path)
+            self._dir_states.append(dir_state)
+            self._dir_files.append({})
+        else:
+            self._dir_states[dir_id] = dir_state
+
+        return dir_id
+
+    def remove_dir(self, dir_path: str):
+        dir_id = self._dir_ids.pop(dir_path, None)
+
+        if dir_id is not None:
+            self._files_count -= len(self._dir_files[dir_id])
+            self._dir_files[dir_id] = {}
+            self._dir_states[dir_id] = None
+
+    def _append_row(self, inode: int, size: int, mtime_ns: int, ctime_ns: int) -> int:
+        self._inode.append(inode)
+        self._size.append(size)
+        self._mtime_ns.append(mtime_ns)
+        self._ctime_ns.append(ctime_ns)
+
+        return len(self._inode) - 1
+
+    def add_file(self, dir_id: int, name: str, stat_info: os.stat_result):
+        files = self._dir_files[dir_id]
+
+        if name not in files:
+            self._files_count += 1
+
+        files[name] = self._append_row(stat_info.st_ino, stat_info.st_size,
+                                       stat_info.st_mtime_ns, stat_info.st_ctime_ns)
+
+    def copy_files(self, dir_id: int, other: "Snapshot", dir_path: str):
+        """Copies all files of directory from other snapshot"""
+        other_dir_id = other._dir_ids.get(dir_path)
+        if other_dir_id is None:
+            return
+
+        files = self._dir_files[dir_id]
+
+        for name, row in other._dir_files[other_dir_id].items():
+            if name not in files:
+                self._files_count += 1
+
+            files[name] = self._append_row(other._inode[row], other._size[row],
+                                           other._mtime_ns[row], other._ctime_ns[row])
+
+    def set_file(self, dir_path: str, name: str, stat_info: os.stat_result) -> bool:
+        """Adds or updates file in place. Returns True if file was added or its state was changed."""
+        dir_id = self._dir_ids.get(dir_path)
+        if dir_id is None:
+            dir_id = self.set_dir(dir_path)
+
+        row = self._dir_files[dir_id].get(name)
+
+        if row is None:
+            self.add_file(dir_id, name, stat_info)
+            return True
+
+        if (self._size[row] == stat_info.st_size
+                and self._mtime_ns[row] == stat_info.st_mtime_ns
+                and self._ctime_ns[row] == stat_info.st_ctime_ns):
+            return False
+
+        self._inode[row] = stat_info.st_ino
+        self._size[row] = stat_info.st_size
+        self._mtime_ns[row] = stat_info.st_mtime_ns
+        self._ctime_ns[row] = stat_info.st_ctime_ns
+
+        return True
+
+    def remove_file(self, dir_path: str, name: str) -> bool:
+        dir_id = self._dir_ids.get(dir_path)
+
+        if dir_id is None or self._dir_files[dir_id].pop(name, None) is None:
+            return False
+
+        self._files_count -= 1
+        return True
+
+    def _file_state(self, dir_path: str, name: str, row: int) -> FileState:
+        return FileState(
+            path=path.join(dir_path, name),
+            date_created=datetime_from_ns(self._ctime_ns[row]),
+            date_updated=datetime_from_ns(self._mtime_ns[row]),
+            size=self._size[row],
+        )
+
+    def file_state(self, dir_path: str, name: str) -> Optional[FileState]:
+        dir_id = self._dir_ids.get(dir_path)
+        if dir_id is None:
+            return None
+
+        row = self._dir_files[dir_id].get(name)
+        return None if row is None else self._file_state(dir_path, name, row)
+
+    def get(self, file_path: str) -> Optional[FileState]:
+        dir_path, name = path.split(file_path)
+        return self.file_state(dir_path, name)
+
+    def file_key(self, dir_path: str, name: str) -> Optional[Tuple[int, int, int]]:
+        """Returns (inode, size, mtime_ns) of file: content is considered unchanged while they are the same"""
+        dir_id = self._dir_ids.get(dir_path)
+        if dir_id is None:
+            return None
+
+        row = self._dir_files[dir_id].get(name)
+        return None if row is None else (self._inode[row], self._size[row], self._mtime_ns[row])
+
+    def iter_file_keys(self) -> Iterator[Tuple[str, Tuple[int, int, int]]]:
+        for dir_path, dir_id in self._dir_ids.items():
+            for name, row in self._dir_files[dir_id].items():
+                yield path.join(dir_path, name), (self._inode[row], self._size[row], self._mtime_ns[row])
+
+    def iter_file_states(self) -> Iterator[FileState]:
+        for dir_path, dir_id in self._dir_ids.items():
+            for name, row in self._dir_files[dir_id].items():
+                yield self._file_state(dir_path, name, row)
+
+    def to_dict(self) -> Dict[str, FileState]:
+        return {file_state.path: file_state for file_state in self.iter_file_states()}
+
+    def _same_row(self, row: int, other: "Snapshot", other_row: int) -> bool:
+        return (
+            self._size[row] == other._size[other_row]
+            and self._mtime_ns[row] == other._mtime_ns[other_row]
+            and self._ctime_ns[row] == other._ctime_ns[other_row]
+        )
+
+    def iter_diff(self, new: "Snapshot") -> Iterator[Tuple[str, Union[FileState, FileDiff]]]:
+        """
+        Lazily yields entries of new snapshot which differ from this one
+         as (kind, entry) pairs, kind is one of "created", "deleted" (FileState) or "updated" (FileDiff)
+        """
+        for dir_path, new_dir_id in new._dir_ids.items():
+            new_files = new._dir_files[new_dir_id]
+            old_dir_id = self._dir_ids.get(dir_path)
+
+            if old_dir_id is None:
+                for name, row in new_files.items():
+                    yield CREATED, new._file_state(dir_path, name, row)
+                continue
+
+            old_files = self._dir_files[old_dir_id]
+
+            for name, new_row in new_files.items():
+                old_row = old_files.get(name)
+
+                if old_row is None:
+                    yield CREATED, new._file_state(dir_path, name, new_row)
+                elif not new._same_row(new_row, self, old_row):
+                    yield UPDATED, FileDiff(
+                        before=self._file_state(dir_path, name, old_row),
+                        after=new._file_state(dir_path, name, new_row),
+                    )
+
+            for name in old_files.keys() - new_files.keys():
+                yield DELETED, self._file_state(dir_path, name, old_files[name])
+
+        for dir_path in self._dir_ids.keys() - new._dir_ids.keys():
+            old_files = self._dir_files[self._dir_ids[dir_path]]
+
+            for name, row in old_files.items():
+                yield DELETED, self._file_state(dir_path, name, row)
+
+    def diff(self, new: "Snapshot") -> Tuple[List[FileState], List[FileState], List[FileDiff]]:
+        """Returns (created, deleted, updated) entries of new snapshot relatively to this one"""
+        entries = {CREATED: [], DELETED: [], UPDATED: []}  # type: Dict[str, list]
+
+        for kind, entry in self.iter_diff(new):
+            entries[kind].append(entry)
+
+        return entries[CREATED], entries[DELETED], entries[UPDATED]
+
+
+SNAPSHOT_FILE_MAGIC = b"FSPYSNAP"
+SNAPSHOT_FILE_VERSION = 1
+
+# magic, version, CRC32 of body, directories count, rows count, target path length
+_FILE_HEADER = struct.Struct("<8sIIQQI")
+# inode, mtime_ns, listed_ns, has state, path length, sub-dirs blob length, names blob length, files count
+_DIR_RECORD = struct.Struct("<QqqBIIII")
+
+
+class SnapshotFileError(ValueError):
+    pass
+
+
+def snapshot_file_name(dir_path: str, variant: str = "") -> str:
+    """variant distinguishes snapshots of the same directory taken with different rules (e.g. path filters)"""
+    key = os.fsencode(dir_path)
+    if variant:
+        key += b"\0" + variant.encode()
+
+    return "snapshot-" + hashlib.sha1(key).hexdigest()[:16] + ".bin"
+
+
+def _fsync_dir(dir_path: str):
+    if sys.platform.startswith("win"):
+        return
+
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_snapshot(snapshot: Snapshot, file_path: str, dir_path: str):
+    """
+    Writes snapshot of dir_path to file atomically (temporary file + rename).
+
+    Layout: header, row arrays (inode, size, mtime_ns, ctime_ns) as raw machine values,
+     then directory records with NUL-separated sub-dirs and file names. Rows are written
+     in order of directory records, so removed rows are dropped.
+    """
+    inode = array('Q')
+    size = array('Q')
+    mtime_ns = array('q')
+    ctime_ns = array('q')
+
+    dir_records = []
+
+    for current_dir, dir_id in snapshot._dir_ids.items():
+        dir_state = snapshot._dir_states[dir_id]
+        files = snapshot._dir_files[dir_id]
+
+        for row in files.values():
+            inode.append(snapshot._inode[row])
+            size.append(snapshot._size[row])
+            mtime_ns.append(snapshot._mtime_ns[row])
+            ctime_ns.append(snapshot._ctime_ns[row])
+
+        path_bytes = os.fsencode(current_dir)
+        sub_dirs_blob = b"\0".join(os.fsencode(sub_dir) for sub_dir in dir_state.sub_dirs) if dir_state else b""
+        names_blob = b"\0".join(os.fsencode(name) for name in files)
+
+        dir_records.append(_DIR_RECORD.pack(
+            dir_state.inode if dir_state else 0,
+            dir_state.mtime_ns if dir_state else 0,
+            dir_state.listed_ns if dir_state else 0,
+            dir_state is not None,
+            len(path_bytes), len(sub_dirs_blob), len(names_blob), len(files),
+        ) + path_bytes + sub_dirs_blob + names_blob)
+
+    target_bytes = os.fsencode(dir_path)
+    body = [target_bytes, inode.tobytes(), size.tobytes(), mtime_ns.tobytes(), ctime_ns.tobytes()] + dir_records
+
+    crc = 0
+    for chunk in body:
+        crc = zlib.crc32(chunk, crc)
+
+    header = _FILE_HEADER.pack(SNAPSHOT_FILE_MAGIC, SNAPSHOT_FILE_VERSION, crc,
+                               len(dir_records), len(inode), len(target_bytes))
+
+    tmp_path = file_path + ".tmp"
+
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(header)
+        for chunk in body:
+            out_file.write(chunk)
+
+        out_file.flush()
+        os.fsync(out_file.fileno())
+
+    os.replace(tmp_path, file_path)
+    _fsync_dir(path.dirname(path.abspath(file_path)))
+
+
+def _parse_snapshot(buf: memoryview, dir_path: str) -> Snapshot:
+    if len(buf) < _FILE_HEADER.size:
+        raise SnapshotFileError("File is too short")
+
+    magic, version, crc, dirs_count, rows_count, target_len = _FILE_HEADER.unpack_from(buf, 0)
+
+    if magic != SNAPSHOT_FILE_MAGIC:
+        raise SnapshotFileError("Not a snapshot file")
+
+    if version != SNAPSHOT_FILE_VERSION:
+        raise SnapshotFileError(f"Unsupported snapshot file version {version}")
+
+    if zlib.crc32(buf[_FILE_HEADER.size:]) != crc:
+        raise SnapshotFileError("Checksum mismatch")
+
+    offset = _FILE_HEADER.size
+    target = os.fsdecode(bytes(buf[offset:offset + target_len]))
+    offset += target_len
+
+    if target != dir_path:
+        raise SnapshotFileError(f"Snapshot was taken for another directory: {target}")
+
+    snapshot = Snapshot()
+
+    for column in (snapshot._inode, snapshot._size, snapshot._mtime_ns, snapshot._ctime_ns):
+        column_size = rows_count * column.itemsize
+        column.frombytes(buf[offset:offset + column_size])
+        offset += column_size
+
+    row = 0
+
+    for _ in range(dirs_count):
+        (inode, mtime_ns, listed_ns, has_state,
+         path_len, sub_dirs_len, names_len, files_count) = _DIR_RECORD.unpack_from(buf, offset)
+        offset += _DIR_RECORD.size
+
+        current_dir = os.fsdecode(bytes(buf[offset:offset + path_len]))
+        offset += path_len
+
+        sub_dirs_blob = bytes(buf[offset:offset + sub_dirs_len])
+        offset += sub_dirs_len
+
+        names_blob = bytes(buf[offset:offset + names_len])
+        offset += names_len
+
+        dir_state = None
+        if has_state:
+            dir_state = DirState(
+                inode=inode,
+                mtime_ns=mtime_ns,
+                listed_ns=listed_ns,
+                sub_dirs=tuple(os.fsdecode(sub_dir) for sub_dir in sub_dirs_blob.split(b"\0")) if sub_dirs_blob else (),
+            )
+
+        dir_id = snapshot.set_dir(current_dir, dir_state)
+
+        if files_count:
+            names = [os.fsdecode(name) for name in names_blob.split(b"\0")]
+            snapshot._dir_files[dir_id] = dict(zip(names, range(row, row + files_count)))
+            snapshot._files_count += files_count
+            row += files_count
+
+    return snapshot
+
+
+def load_snapshot(file_path: str, dir_path: str) -> Optional[Snapshot]:
+    """
+    Loads snapshot of dir_path saved by save_snapshot. File is memory-mapped, so row arrays
+     are copied directly from page cache. Returns None if file does not exist or is not usable.
+    """
+    try:
+        with open(file_path, "rb") as in_file:
+            if os.fstat(in_file.fileno()).st_size == 0:
+                raise SnapshotFileError("File is empty")
+
+            with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                buf = memoryview(mm)
+                try:
+                    return _parse_snapshot(buf, dir_path)
+                finally:
+                    buf.release()
+
+    except FileNotFoundError:
+        log.info("Snapshot file %s does not exist", file_path)
+    except (OSError, SnapshotFileError, struct.error, UnicodeError) as e:
+        log.warning("Can not load snapshot file %s: %s", file_path, e)
+
+    return None
@@ -0,0 +1,365 @@
+from typing import Optional, Callable, List, NamedTuple, Tuple
+
+import os
+import zlib
+import struct
+import threading
+from os import path
+from bisect import bisect_right
+
+import logging
+
+from fspy.agent.snapshot import _fsync_dir
+from fspy.common import protocol
+from fspy.common.model import DiffChunk
+
+log = logging.getLogger(__name__)
+
+# Scans wait until collector acknowledges spooled diffs
+SPOOL_POLICY_BLOCK = "block"
+# Oldest segment is deleted with all its diffs
+SPOOL_POLICY_DROP_OLDEST = "drop_oldest"
+# New diff is not spooled
+SPOOL_POLICY_DROP_NEWEST = "drop_newest"
+SPOOL_POLICIES = (SPOOL_POLICY_BLOCK, SPOOL_POLICY_DROP_OLDEST, SPOOL_POLICY_DROP_NEWEST)
+
+# MiB
+DEFAULT_SPOOL_MAX_SIZE = 256
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+
+SPOOL_FILE_MAGIC = b"FSPYSPOL"
+SPOOL_FILE_VERSION = 1
+SEGMENT_FILE_SUFFIX = ".seg"
+
+# magic, version, id of first record
+_SEGMENT_HEADER = struct.Struct("<8sIQ")
+# payload length, CRC32 of payload
+_RECORD_HEADER = struct.Struct("<II")
+
+# Diffs are stored in binary protocol encoding without sequence number
+_RECORD_ENCODING = protocol.BINARY_PROTOCOL_V2
+
+
+class SpoolRecord(NamedTuple):
+    record_id: int
+    chunk: DiffChunk
+
+
+class SpoolClosedError(Exception):
+    pass
+
+
+class _Segment:
+    __slots__ = ("first_id", "file_path", "size", "count", "acked")
+
+    def __init__(self, first_id: int, file_path: str, size: int = _SEGMENT_HEADER.size, count: int = 0):
+        self.first_id = first_id
+        self.file_path = file_path
+        self.size = size
+        self.count = count
+        self.acked = 0
+
+    @property
+    def end_id(self) -> int:
+        return self.first_id + self.count
+
+
+def _segment_file_name(first_id: int) -> str:
+    return f"{first_id:020d}{SEGMENT_FILE_SUFFIX}"
+
+
+def _load_segment(file_path: str) -> Optional[_Segment]:
+    """
+    Counts valid records of segment file. Torn or damaged tail (crash during append) is truncated.
+    Returns None for files which are not segments.
+    """
+    with open(file_path, "r+b") as seg_file:
+        buf = seg_file.read()
+
+        try:
+            magic, version, first_id = _SEGMENT_HEADER.unpack_from(buf, 0)
+        except struct.error:
+            magic, version, first_id = None, None, None
+
+        if magic != SPOOL_FILE_MAGIC or version != SPOOL_FILE_VERSION:
+            log.error(f"Not a spool segment or unsupported version: {file_path}")
+            return None
+
+        segment = _Segment(first_id, file_path)
+
+        while segment.size < len(buf):
+            try:
+                length, crc = _RECORD_HEADER.unpack_from(buf, segment.size)
+            except struct.error:
+                break
+
+            payload_start = segment.size + _RECORD_HEADER.size
+            payload = buf[payload_start:payload_start + length]
+
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+
+            segment.size = payload_start + length
+            segment.count += 1
+
+        if segment.size < len(buf):
+            log.warning(f"Spool segment {file_path} is damaged after {segment.count} records, "
+                        f"{len(buf) - segment.size} bytes are discarded")
+            seg_file.truncate(segment.size)
+
+    return segment
+
+
+class DiffSpool:
+    """
+    Durable FIFO of diff chunks waiting for sending, kept in segment files of spool directory.
+
+    Chunks are appended by scan threads (put), read one by one by sender (get_nowait)
+     and acknowledged in any order (ack). Segment file is deleted when all its records are acknowledged.
+    Total size of segments is capped by max_size bytes, policy decides what happens to new diffs when cap is hit.
+    After restart reading starts from the oldest remaining segment: acknowledged records of partially
+     acknowledged segment are sent again, collector skips chunks it has already saved.
+    """
+
+    def __init__(self, dir_path: str, max_size: int = DEFAULT_SPOOL_MAX_SIZE * 1024 * 1024,
+                 segment_size: int = DEFAULT_SEGMENT_SIZE, policy: str = SPOOL_POLICY_BLOCK):
+        if policy not in SPOOL_POLICIES:
+            raise ValueError(f"Unknown spool policy {policy}. Expected one of {SPOOL_POLICIES}")
+
+        self.dir_path = dir_path
+        self.max_size = max_size
+        self.segment_size = min(segment_size, max_size)
+        self.policy = policy
+
+        # Called from thread of put() after each new record
+        self.on_put = None  # type: Optional[Callable[[], None]]
+
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._segments = []  # type: List[_Segment]
+        self._writer = None
+        self._next_write_id = 0
+
+        self._reader = None
+        self._reader_segment = None  # type: Optional[_Segment]
+        self._reader_offset = 0
+        self._next_read_id = 0
+
+        os.makedirs(dir_path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        for file_name in sorted(os.listdir(self.dir_path)):
+            if not file_name.endswith(SEGMENT_FILE_SUFFIX):
+                continue
+
+            segment = _load_segment(path.join(self.dir_path, file_name))
+
+            if segment is None:
+                continue
+
+            if segment.count:
+                self._segments.append(segment)
+            else:
+                os.remove(segment.file_path)
+
+        if self._segments:
+            self._next_write_id = self._segments[-1].end_id
+            self._next_read_id = self._segments[0].first_id
+
+            log.info(f"Spool {self.dir_path}: {self.pending_count} diffs ({self.size} bytes) left from previous run")
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self._segments)
+
+    @property
+    def pending_count(self) -> int:
+        """Records not acknowledged yet"""
+        return sum(segment.count - segment.acked for segment in self._segments)
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+            self._reader_segment = None
+
+    def _open_segment(self) -> _Segment:
+        self._close_writer()
+
+        first_id = self._next_write_id
+        segment = _Segment(first_id, path.join(self.dir_path, _segment_file_name(first_id)))
+
+        self._writer = open(segment.file_path, "wb")
+        self._writer.write(_SEGMENT_HEADER.pack(SPOOL_FILE_MAGIC, SPOOL_FILE_VERSION, first_id))
+        self._writer.flush()
+        _fsync_dir(self.dir_path)
+
+        self._segments.append(segment)
+        return segment
+
+    def _remove_segment(self, segment: _Segment):
+        if segment is self._reader_segment:
+            self._close_reader()
+
+        if self._segments and segment is self._segments[-1]:
+            self._close_writer()
+
+        self._segments.remove(segment)
+        os.remove(segment.file_path)
+
+    def _remove_acked_tail(self):
+        """Last segment is kept for appending after all its records are acknowledged"""
+        if self._segments and self._segments[-1].acked == self._segments[-1].count:
+            self._remove_segment(self._segments[-1])
+
+    def _drop_oldest(self):
+        segment = self._segments[0]
+        dropped = segment.count - segment.acked
+
+        log.warning(f"Spool {self.dir_path} is full, {dropped} oldest diffs are dropped")
+        self._remove_segment(segment)
+        self._cond.notify_all()
+
+    def put(self, chunk: DiffChunk) -> bool:
+        """
+        Appends chunk to spool, blocks while spool is full with block policy.
+        Returns False if chunk was dropped. Raises SpoolClosedError if spool is closed.
+        """
+        payload = protocol.encode_diff_chunk(chunk, _RECORD_ENCODING)
+        record = _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        record_size = len(record) + _SEGMENT_HEADER.size
+
+        if record_size > self.max_size:
+            log.error(f"Diff of {len(payload)} bytes does not fit into spool of {self.max_size} bytes. Dropped")
+            return False
+
+        with self._cond:
+            while not self._closed and self.size + record_size > self.max_size:
+                self._remove_acked_tail()
+                if self.size + record_size <= self.max_size:
+                    break
+
+                if self.policy == SPOOL_POLICY_DROP_NEWEST:
+                    log.warning(f"Spool {self.dir_path} is full, diff of {chunk.source_name} is dropped")
+                    return False
+
+                if self.policy == SPOOL_POLICY_DROP_OLDEST:
+                    self._drop_oldest()
+                else:
+                    self._cond.wait()
+
+            if self._closed:
+                raise SpoolClosedError()
+
+            if not self._segments or self._writer is None or self._segments[-1].size >= self.segment_size:
+                self._open_segment()
+
+            segment = self._segments[-1]
+
+            self._writer.write(record)
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+
+            segment.size += len(record)
+            segment.count += 1
+            self._next_write_id += 1
+
+        if self.on_put is not None:
+            self.on_put()
+
+        return True
+
+    def _read_next(self) -> Optional[Tuple[int, bytes, int]]:
+        """Returns id, payload and CRC32 from header of next record which was not read yet or None"""
+        with self._cond:
+            while True:
+                index = bisect_right([segment.first_id for segment in self._segments], self._next_read_id) - 1
+
+                if index < 0:
+                    # Everything before first segment was dropped
+                    if not self._segments or self._next_read_id >= self._segments[0].first_id:
+                        return None
+
+                    self._next_read_id = self._segments[0].first_id
+                    continue
+
+                segment = self._segments[index]
+
+                if self._next_read_id < segment.end_id:
+                    break
+
+                if index == len(self._segments) - 1:
+                    return None
+
+                self._next_read_id = self._segments[index + 1].first_id
+
+            if segment is not self._reader_segment:
+                self._close_reader()
+                self._reader = open(segment.file_path, "rb")
+                self._reader_segment = segment
+                self._reader_offset = _SEGMENT_HEADER.size
+
+                # Skip records which were read before
+                for _ in range(self._next_read_id - segment.first_id):
+                    self._reader.seek(self._reader_offset)
+                    length, _ = _RECORD_HEADER.unpack(self._reader.read(_RECORD_HEADER.size))
+                    self._reader_offset += _RECORD_HEADER.size + length
+
+            self._reader.seek(self._reader_offset)
+            length, crc = _RECORD_HEADER.unpack(self._reader.read(_RECORD_HEADER.size))
+            payload = self._reader.read(length)
+
+            self._reader_offset += _RECORD_HEADER.size + length
+
+            record_id = self._next_read_id
+            self._next_read_id += 1
+
+        return record_id, payload, crc
+
+    def get_nowait(self) -> Optional[SpoolRecord]:
+        """Returns next record which was not read yet or None. Damaged records are skipped"""
+        while True:
+            next_record = self._read_next()
+            if next_record is None:
+                return None
+
+            record_id, payload, crc = next_record
+
+            if zlib.crc32(payload) == crc:
+                return SpoolRecord(record_id, protocol.decode_diff_chunk(payload, _RECORD_ENCODING))
+
+            log.error(f"Spool record {record_id} is damaged and will not be sent")
+            self.ack(record_id)
+
+    def ack(self, record_id: int):
+        """Marks record as sent. Segment which records are all sent is deleted"""
+        with self._cond:
+            index = bisect_right([segment.first_id for segment in self._segments], record_id) - 1
+            if index < 0 or record_id >= self._segments[index].end_id:
+                # Segment was dropped
+                return
+
+            segment = self._segments[index]
+            segment.acked += 1
+
+            # Last segment is deleted only if it is full, it is appended otherwise
+            if segment.acked == segment.count and (segment is not self._segments[-1] or
+                                                   segment.size >= self.segment_size):
+                self._remove_segment(segment)
+                self._cond.notify_all()
+
+    def close(self):
+        """Wakes up blocked put() calls. Segments are kept on disk for next run"""
+        with self._cond:
+            self._closed = True
+            self._remove_acked_tail()
+            self._close_writer()
+            self._close_reader()
+            self._cond.notify_all()
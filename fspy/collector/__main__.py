@@ -1,3 +1,5 @@
+from typing import Optional
+
 import logging
 import asyncio
 
@@ -5,15 +7,45 @@ import sys
 from argparse import ArgumentParser
 from aiohttp import web
 
-from fspy.collector.app import create_application
+from fspy.collector.app import create_application, DEFAULT_WS_HEARTBEAT, DEFAULT_TERMINAL_QUEUE_SIZE
+from fspy.collector.admission import DEFAULT_ADMISSION_BURST
+from fspy.collector.decoding import DEFAULT_OFFLOAD_THRESHOLD, DEFAULT_DECODE_WORKERS, DECODE_POOL_PROCESS, \
+    DECODE_POOLS, DEFAULT_MAX_MESSAGE_SIZE
+from fspy.collector.writing_thread import DEFAULT_WRITE_BATCH_SIZE, DEFAULT_WRITE_BATCH_DELAY, \
+    DEFAULT_WRITE_QUEUE_SIZE
+from fspy.collector.storage import SYNCHRONOUS_MODES, DEFAULT_SYNCHRONOUS, DEFAULT_WAL_AUTOCHECKPOINT, \
+    DEFAULT_READ_POOL_SIZE
 from fspy.collector import logging_config
 from fspy.common import defaults
 
 log = logging.getLogger(__name__)
 
 
-async def init_app(host: str, port: int, db_path: str) -> web.AppRunner:
-    app = create_application(db_path=db_path)
+async def init_app(host: str, port: int, db_path: str, ws_compress: bool = True,
+                   ws_heartbeat: Optional[float] = DEFAULT_WS_HEARTBEAT,
+                   admission_rate: Optional[float] = None,
+                   admission_burst: int = DEFAULT_ADMISSION_BURST,
+                   decode_offload_threshold: int = DEFAULT_OFFLOAD_THRESHOLD,
+                   decode_workers: int = DEFAULT_DECODE_WORKERS,
+                   decode_pool: str = DECODE_POOL_PROCESS,
+                   max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE,
+                   write_batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+                   write_batch_delay: float = DEFAULT_WRITE_BATCH_DELAY,
+                   wal: bool = True,
+                   synchronous: str = DEFAULT_SYNCHRONOUS,
+                   wal_autocheckpoint: int = DEFAULT_WAL_AUTOCHECKPOINT,
+                   read_pool_size: int = DEFAULT_READ_POOL_SIZE,
+                   shards: int = 1,
+                   write_queue_size: int = DEFAULT_WRITE_QUEUE_SIZE,
+                   terminal_queue_size: int = DEFAULT_TERMINAL_QUEUE_SIZE) -> web.AppRunner:
+    app = create_application(db_path=db_path, ws_compress=ws_compress, ws_heartbeat=ws_heartbeat,
+                             admission_rate=admission_rate, admission_burst=admission_burst,
+                             decode_offload_threshold=decode_offload_threshold, decode_workers=decode_workers,
+                             decode_pool=decode_pool, max_message_size=max_message_size,
+                             write_batch_size=write_batch_size,
+                             write_batch_delay=write_batch_delay, wal=wal, synchronous=synchronous,
+                             wal_autocheckpoint=wal_autocheckpoint, read_pool_size=read_pool_size, shards=shards,
+                             write_queue_size=write_queue_size, terminal_queue_size=terminal_queue_size)
 
     runner = web.AppRunner(app)
 
@@ -38,6 +70,49 @@ def main():
     parser.add_argument("--port", default=defaults.DEFAULT_PORT, type=int, help="bind port")
     parser.add_argument("--db_path", help="Path to SQLite DB. If does not exists - will be created", required=True)
     parser.add_argument("--verbose", help="Verbose logging", action='store_true')
+    parser.add_argument("--no_ws_compression", action='store_true',
+                        help="Refuse permessage-deflate compression of agent connections "
+                             "(zlib-compressed binary messages are still accepted)")
+    parser.add_argument("--ws_heartbeat", type=float, default=DEFAULT_WS_HEARTBEAT,
+                        help="Interval (seconds) of pings to agents, dead connections are closed. 0 - no pings")
+    parser.add_argument("--admission_rate", type=float, default=None,
+                        help="Max number of new agent connections per second. Agents over the limit are told "
+                             "when to retry, so many agents reconnecting at once are spread over time. "
+                             "If not provided - unlimited")
+    parser.add_argument("--admission_burst", type=int, default=DEFAULT_ADMISSION_BURST,
+                        help="Number of agent connections admitted at once over --admission_rate")
+    parser.add_argument("--decode_offload_threshold", type=int, default=DEFAULT_OFFLOAD_THRESHOLD,
+                        help="Messages of this size (bytes) and larger are decoded out of event loop, "
+                             "so huge diffs do not delay other agents")
+    parser.add_argument("--decode_workers", type=int, default=DEFAULT_DECODE_WORKERS,
+                        help="Number of workers decoding large messages. 0 - everything is decoded in event loop")
+    parser.add_argument("--decode_pool", choices=DECODE_POOLS, default=DECODE_POOL_PROCESS,
+                        help="Kind of decode workers. Decoders hold GIL, so only processes decode in parallel; "
+                             "threads only help with zlib-compressed messages")
+    parser.add_argument("--max_message_size", type=int, default=DEFAULT_MAX_MESSAGE_SIZE,
+                        help="Max size (bytes) of agent message, also after decompression. Larger ones are rejected")
+    parser.add_argument("--write_batch_size", type=int, default=DEFAULT_WRITE_BATCH_SIZE,
+                        help="Max number of reports saved to DB in one transaction (group commit). 1 - no batching")
+    parser.add_argument("--write_batch_delay", type=float, default=DEFAULT_WRITE_BATCH_DELAY,
+                        help="Seconds to wait for more reports to save in one transaction")
+    parser.add_argument("--no_wal", action='store_true',
+                        help="Use rollback journal instead of WAL. Report queries will block saving of reports")
+    parser.add_argument("--synchronous", choices=SYNCHRONOUS_MODES, default=DEFAULT_SYNCHRONOUS,
+                        help="SQLite synchronous mode. With WAL NORMAL is durable except for power loss")
+    parser.add_argument("--wal_autocheckpoint", type=int, default=DEFAULT_WAL_AUTOCHECKPOINT,
+                        help="Checkpoint WAL into DB when it grows over this number of pages. 0 - only on shutdown")
+    parser.add_argument("--read_pool_size", type=int, default=DEFAULT_READ_POOL_SIZE,
+                        help="Number of concurrent report queries")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Number of SQLite DBs reports are spread over by source name, each is written by own "
+                             "thread. First one is --db_path, others are next to it (e.g. fspy.1.sqlite). "
+                             "Keep it while agents have unfinished chunked scans")
+    parser.add_argument("--write_queue_size", type=int, default=DEFAULT_WRITE_QUEUE_SIZE,
+                        help="Max number of reports waiting to be saved (per shard). Over it agents are answered "
+                             "as busy and resend later, so slow disk does not exhaust memory. 0 - unbounded")
+    parser.add_argument("--terminal_queue_size", type=int, default=DEFAULT_TERMINAL_QUEUE_SIZE,
+                        help="Max number of reports waiting to be printed. Over it reports are not printed. "
+                             "0 - unbounded")
 
     args = parser.parse_args()
 
@@ -50,7 +125,24 @@ def main():
     loop = asyncio.get_event_loop()
 
     try:
-        runner = loop.run_until_complete(init_app(args.host, args.port, args.db_path))
+        runner = loop.run_until_complete(init_app(args.host, args.port, args.db_path,
+                                                   ws_compress=not args.no_ws_compression,
+                                                   ws_heartbeat=args.ws_heartbeat or None,
+                                                   admission_rate=args.admission_rate,
+                                                   admission_burst=args.admission_burst,
+                                                   decode_offload_threshold=args.decode_offload_threshold,
+                                                   decode_workers=args.decode_workers,
+                                                   decode_pool=args.decode_pool,
+                                                   max_message_size=args.max_message_size,
+                                                   write_batch_size=args.write_batch_size,
+                                                   write_batch_delay=args.write_batch_delay,
+                                                   wal=not args.no_wal,
+                                                   synchronous=args.synchronous,
+                                                   wal_autocheckpoint=args.wal_autocheckpoint,
+                                                   read_pool_size=args.read_pool_size,
+                                                   shards=args.shards,
+                                                   write_queue_size=args.write_queue_size,
+                                                   terminal_queue_size=args.terminal_queue_size))
     except KeyboardInterrupt:
         log.info("Interrupt signal received during initialization")
         loop.close()
@@ -0,0 +1,54 @@
+from typing import Optional, Callable, List
+
+import time
+import random
+from bisect import bisect_right, insort
+
+# Connections admitted at once after idle period
+DEFAULT_ADMISSION_BURST = 10
+
+
+class AdmissionControl:
+    """
+    Limits rate of new agent connections with token bucket: rate connections per second on average,
+     up to burst at once.
+
+    Rejected agent is told when to retry. Hint grows with number of agents which were rejected and have not
+     come back yet, and is jittered, so herd of agents reconnecting after collector restart is spread over time
+     needed to admit all of them instead of coming back at once again.
+    """
+
+    def __init__(self, rate: float, burst: int = DEFAULT_ADMISSION_BURST,
+                 clock: Callable[[], float] = time.monotonic):
+        if rate <= 0:
+            raise ValueError(f"Admission rate must be positive, got {rate}")
+
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._clock = clock
+
+        self._tokens = float(self.burst)
+        self._updated = clock()
+
+        # Sorted times rejected agents were told to come back at
+        self._waiting = []  # type: List[float]
+
+    def admit(self) -> Optional[float]:
+        """Returns None if connection is admitted, otherwise delay (seconds) after which agent should retry"""
+        now = self._clock()
+
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        del self._waiting[:bisect_right(self._waiting, now)]
+
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return None
+
+        min_delay = (len(self._waiting) + 1 - self._tokens) / self.rate
+        retry_after = random.uniform(min_delay, 2 * min_delay)
+
+        insort(self._waiting, now + retry_after)
+
+        return retry_after
@@ -1,26 +1,52 @@
+from typing import Optional
+
 import logging
 import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 from aiohttp import web, WSCloseCode
-from sqlalchemy import create_engine
+from sqlalchemy import inspect
 from sqlalchemy.engine import Engine
-from sqlalchemy import pool
 import asyncio
 
 from fspy.collector import view
+from fspy.collector.admission import AdmissionControl, DEFAULT_ADMISSION_BURST
+from fspy.collector.decoding import MessageDecoder, DEFAULT_OFFLOAD_THRESHOLD, DEFAULT_DECODE_WORKERS, \
+    DECODE_POOL_PROCESS, DEFAULT_MAX_MESSAGE_SIZE
+from fspy.collector.metrics import LoopLagMonitor, QueueGauge
 from fspy.collector.db import Base
+from fspy.collector.storage import create_write_engine, create_read_engine, checkpoint, DEFAULT_SYNCHRONOUS, \
+    DEFAULT_WAL_AUTOCHECKPOINT, DEFAULT_READ_POOL_SIZE
 from fspy.collector.terminal import diff_report_printer
 from fspy.collector.utils import AppWrapper
-from fspy.collector.writing_thread import WriteThreadManager
+from fspy.collector.sharding import ShardedWriteManager, shard_paths
+from fspy.collector.writing_thread import DEFAULT_WRITE_BATCH_SIZE, DEFAULT_WRITE_BATCH_DELAY, \
+    DEFAULT_WRITE_QUEUE_SIZE
 
 log = logging.getLogger(__name__)
 
+DEFAULT_WS_HEARTBEAT = 30
+# Reports waiting to be printed. When queue is full, reports are not printed
+DEFAULT_TERMINAL_QUEUE_SIZE = 1000
+
 
 def run_migrations(engine: Engine):
     log.info("Running migrations")
     # TODO FIX: Replace with running Alembic migrations
     Base.metadata.create_all(engine)
 
+    # create_all does not alter existing tables, so new (nullable) columns are added by hand
+    inspector = inspect(engine)
+
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name not in existing_columns:
+                log.info(f"Adding column {table.name}.{column.name}")
+                column_type = column.type.compile(dialect=engine.dialect)
+                engine.execute(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+
 
 async def on_shutdown(app: web.Application):
     app_wrapper = AppWrapper(app)
@@ -31,7 +57,17 @@ async def on_shutdown(app: web.Application):
 
     await app_wrapper.writing_thread_manager.close()
 
+    app_wrapper.report_executor.shutdown(wait=False)
+    for engine in app_wrapper.db_read_engines:
+        engine.dispose()
+
+    log.info("Checkpointing DB")
+    for engine in app_wrapper.db_engines:
+        await app.loop.run_in_executor(None, checkpoint, engine)
+
     app_wrapper.terminal_task.cancel()
+    app_wrapper.loop_lag.close()
+    app_wrapper.decoder.close()
 
     log.info("On shutdown procedure finished")
 
@@ -41,36 +77,79 @@ async def on_startup(app: web.Application):
 
     app_wrapper = AppWrapper(app)
 
-    log.info("Creating DB engine")
-
-    app_wrapper.db_engine = create_engine(f"sqlite:///{app_wrapper.db_path}", poolclass=pool.SingletonThreadPool)
-
-    await app.loop.run_in_executor(None, run_migrations, app_wrapper.db_engine)
+    for engine in app_wrapper.db_engines:
+        await app.loop.run_in_executor(None, run_migrations, engine)
 
-    log.info("Running writing thread")
-    app_wrapper.writing_thread_manager.run_worker(app_wrapper.db_engine)
+    log.info("Running writing threads")
+    app_wrapper.writing_thread_manager.run_workers(app_wrapper.db_engines)
 
     log.info("Initiating terminal task")
-    app_wrapper.terminal_queue = asyncio.Queue()
+    app_wrapper.terminal_queue = asyncio.Queue(maxsize=app_wrapper.terminal_queue_size)
+    app_wrapper.terminal_gauge = QueueGauge(app_wrapper.terminal_queue)
     app_wrapper.terminal_task = asyncio.ensure_future(diff_report_printer(app_wrapper.terminal_queue), loop=app.loop)
 
+    app_wrapper.loop_lag = LoopLagMonitor(app.loop)
+    app_wrapper.loop_lag.run()
+
     log.info("FSPY startup procedure finished")
 
 
-def create_application(db_path: str):
+def create_application(db_path: str, ws_compress: bool = True, ws_heartbeat: Optional[float] = DEFAULT_WS_HEARTBEAT,
+                       admission_rate: Optional[float] = None, admission_burst: int = DEFAULT_ADMISSION_BURST,
+                       decode_offload_threshold: int = DEFAULT_OFFLOAD_THRESHOLD,
+                       decode_workers: int = DEFAULT_DECODE_WORKERS, decode_pool: str = DECODE_POOL_PROCESS,
+                       max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE,
+                       write_batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+                       write_batch_delay: float = DEFAULT_WRITE_BATCH_DELAY,
+                       wal: bool = True, synchronous: str = DEFAULT_SYNCHRONOUS,
+                       wal_autocheckpoint: int = DEFAULT_WAL_AUTOCHECKPOINT,
+                       read_pool_size: int = DEFAULT_READ_POOL_SIZE, shards: int = 1,
+                       write_queue_size: int = DEFAULT_WRITE_QUEUE_SIZE,
+                       terminal_queue_size: int = DEFAULT_TERMINAL_QUEUE_SIZE):
+    """
+    ws_compress - accept permessage-deflate extension offered by agents
+    ws_heartbeat - interval (seconds) of pings to agents, connection without pong is closed. None - no pings
+    admission_rate - max rate (per second) of new agent connections, None - unlimited
+    decode_offload_threshold - messages of this size (bytes) and larger are decoded in pool of decode_workers
+    max_message_size - larger messages (received or decompressed, bytes) are rejected
+    write_batch_size - max number of reports saved in one transaction, write_batch_delay - seconds to wait for them
+    wal - WAL journal mode of SQLite, so report queries do not block writing. synchronous - SQLite synchronous mode,
+     wal_autocheckpoint - WAL size (pages) to checkpoint at
+    read_pool_size - number of concurrent report queries
+    shards - number of SQLite DBs (each with own writing thread) reports are spread over by source name
+    write_queue_size - reports waiting for writing thread of each shard, over it agents are answered as busy.
+     0 - unbounded
+    terminal_queue_size - reports waiting to be printed, over it they are not printed. 0 - unbounded
+    """
     log.info("Creating FSPY application")
     app = web.Application()
 
     app_wrapper = AppWrapper(app)
 
     app_wrapper.db_path = db_path
+
+    log.info("Creating DB engines")
+    paths = shard_paths(db_path, shards)
+    app_wrapper.db_engines = [create_write_engine(shard_path, wal=wal, synchronous=synchronous,
+                                                  wal_autocheckpoint=wal_autocheckpoint) for shard_path in paths]
+    app_wrapper.db_read_engines = [create_read_engine(shard_path, pool_size=read_pool_size) for shard_path in paths]
+    app_wrapper.report_executor = ThreadPoolExecutor(max_workers=read_pool_size, thread_name_prefix="fspy-report")
+    app_wrapper.ws_compress = ws_compress
+    app_wrapper.ws_heartbeat = ws_heartbeat
+    app_wrapper.admission = AdmissionControl(admission_rate, admission_burst) if admission_rate else None
+    app_wrapper.decoder = MessageDecoder(decode_offload_threshold, decode_workers, decode_pool,
+                                         max_message_size=max_message_size, loop=app.loop)
     app_wrapper.web_sockets = weakref.WeakSet()
-    app_wrapper.writing_thread_manager = WriteThreadManager(loop=app.loop)
+    app_wrapper.writing_thread_manager = ShardedWriteManager(shards, loop=app.loop, batch_size=write_batch_size,
+                                                             batch_delay=write_batch_delay,
+                                                             queue_size=write_queue_size)
+    app_wrapper.terminal_queue_size = terminal_queue_size
 
     log.info("Adding routes")
     app.add_routes([
         web.view("/ws", view.LogsCollectorView),
         web.view("/flat_report", view.FlatReportView),
+        web.view("/metrics", view.MetricsView),
     ])
 
     app.on_startup.append(on_startup)
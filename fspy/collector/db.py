@@ -1,13 +1,16 @@
-from typing import Optional
+from typing import Optional, List
 
-from sqlalchemy import Column, String, BigInteger, Integer, DateTime, Enum, ForeignKey
+from sqlalchemy import Column, String, BigInteger, Integer, DateTime, Enum, ForeignKey, Boolean, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 
 import enum
+import logging
 
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, Session
 
-from fspy.common import model
+from fspy.common import records
+
+log = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -29,7 +32,14 @@ class DiffReport(Base):
     source_name = Column(String(), index=True)
     source_ip = Column(String(), nullable=True, index=True)
 
+    # Diff of one scan may arrive in several chunks. Report is complete when all of them are saved
+    scan_id = Column(String(), nullable=True, index=True)
+    chunks_received = Column(Integer(), nullable=True)
+    chunks_total = Column(Integer(), nullable=True)
+    complete = Column(Boolean(), nullable=True)
+
     diff_list = relationship("FileDiff", back_populates="diff_report")
+    received_chunks = relationship("ReceivedChunk", back_populates="diff_report")
 
 
 class FileDiff(Base):
@@ -47,51 +57,154 @@ class FileDiff(Base):
     size_before = Column(BigInteger(), nullable=True)
     size_after = Column(BigInteger(), nullable=True)
 
-    operation_time = Column(DateTime(timezone=True), index=True)
+    # Provided by agents with content hashing enabled
+    hash_before = Column(String(), nullable=True)
+    hash_after = Column(String(), nullable=True)
 
+    operation_time = Column(DateTime(timezone=True), index=True)
 
-def diff_report_to_db_model(dr: model.DiffReport, source_ip: Optional[str] = None) -> DiffReport:
-    diff_report = DiffReport(
-        source_name=dr.source_name,
-        source_ip=source_ip,
 
-        run_start=dr.diff.run_start,
-        run_end=dr.diff.run_end,
+class ReceivedChunk(Base):
+    """Chunks already saved to report, so retransmitted ones are not saved twice"""
+    __tablename__ = 'received_chunks'
+    __table_args__ = (
+        UniqueConstraint("diff_report_id", "chunk_index", name="uq_received_chunk"),
     )
 
-    for file_state in dr.diff.created:
-        FileDiff(
-            diff_report=diff_report,
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+
+    diff_report_id = Column(BigInteger(), ForeignKey(DiffReport.id, name="fk_received_chunk_diff_report_id"))
+    diff_report = relationship(DiffReport, back_populates="received_chunks")
+
+    chunk_index = Column(Integer())
+
+
+def _file_diff_rows(diff_report_id: int, diff: records.DiffRecord) -> List[dict]:
+    """Rows of file_diffs table"""
+    rows = [
+        dict(
+            diff_report_id=diff_report_id,
             file_path=file_state.path,
 
             operation=OperationsEnum.CREATE,
+            size_before=None,
             size_after=file_state.size,
+            hash_before=None,
+            hash_after=file_state.content_hash,
 
-            operation_time=file_state.date_created
+            operation_time=file_state.date_created,
         )
+        for file_state in diff.created
+    ]
 
-    for file_diff in dr.diff.updated:
-        FileDiff(
-            diff_report=diff_report,
+    rows.extend(
+        dict(
+            diff_report_id=diff_report_id,
             file_path=file_diff.before.path,
 
             operation=OperationsEnum.UPDATE,
             size_before=file_diff.before.size,
             size_after=file_diff.after.size,
+            hash_before=file_diff.before.content_hash,
+            hash_after=file_diff.after.content_hash,
 
             operation_time=file_diff.after.date_updated,
         )
+        for file_diff in diff.updated
+    )
 
-    for file_state in dr.diff.deleted:
-        FileDiff(
-            diff_report=diff_report,
+    rows.extend(
+        dict(
+            diff_report_id=diff_report_id,
             file_path=file_state.path,
 
             operation=OperationsEnum.DELETE,
             size_before=file_state.size,
+            size_after=None,
+            hash_before=file_state.content_hash,
+            hash_after=None,
 
-            operation_time=dr.diff.run_start,
-            # operation_time=dr.diff.run_end,
+            operation_time=diff.run_start,
         )
+        for file_state in diff.deleted
+    )
+
+    return rows
+
+
+def _insert_file_diffs(session: Session, diff_report_id: int, diff: records.DiffRecord):
+    rows = _file_diff_rows(diff_report_id, diff)
+
+    if rows:
+        session.execute(FileDiff.__table__.insert(), rows)
+
+
+def insert_diff_report(session: Session, dr: records.ReportRecord, source_ip: Optional[str] = None) -> int:
+    """
+    Inserts report row and all its file diffs with one executemany, without building ORM objects.
+    Returns ID of report
+    """
+    result = session.execute(DiffReport.__table__.insert().values(
+        source_name=dr.source_name,
+        source_ip=source_ip,
+
+        run_start=dr.diff.run_start,
+        run_end=dr.diff.run_end,
+
+        chunks_received=1,
+        chunks_total=1,
+        complete=True,
+    ))
+    diff_report_id = result.inserted_primary_key[0]
+
+    _insert_file_diffs(session, diff_report_id, dr.diff)
+
+    return diff_report_id
+
+
+def diff_chunk_to_db_model(session: Session, chunk: records.ChunkRecord, source_ip: Optional[str] = None) -> DiffReport:
+    """
+    Adds chunk to report of its scan (creating it on first chunk).
+    Chunk which was already added (retransmitted by agent) is skipped.
+    File diffs of chunk are inserted in bulk (see insert_diff_report), report is flushed to get its ID.
+    """
+    diff_report = session.query(DiffReport).filter(
+        DiffReport.scan_id == chunk.scan_id,
+        DiffReport.source_name == chunk.source_name,
+    ).one_or_none()  # type: Optional[DiffReport]
+
+    if diff_report is not None:
+        duplicate = session.query(ReceivedChunk.id).filter(
+            ReceivedChunk.diff_report_id == diff_report.id,
+            ReceivedChunk.chunk_index == chunk.chunk_index,
+        ).first()
+
+        if duplicate is not None:
+            log.info(f"Chunk {chunk.chunk_index} of scan {chunk.scan_id} of {chunk.source_name} is already saved")
+            return diff_report
+
+    else:
+        diff_report = DiffReport(
+            source_name=chunk.source_name,
+            source_ip=source_ip,
+
+            run_start=chunk.diff.run_start,
+            run_end=chunk.diff.run_end,
+
+            scan_id=chunk.scan_id,
+            chunks_received=0,
+            complete=False,
+        )
+        session.add(diff_report)
+        session.flush()
+
+    _insert_file_diffs(session, diff_report.id, chunk.diff)
+    ReceivedChunk(diff_report=diff_report, chunk_index=chunk.chunk_index)
+
+    diff_report.chunks_received += 1
+    if chunk.last:
+        diff_report.chunks_total = chunk.chunk_index + 1
+
+    diff_report.complete = diff_report.chunks_received == diff_report.chunks_total
 
     return diff_report
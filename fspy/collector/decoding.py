@@ -0,0 +1,86 @@
+from typing import Optional, Union
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import logging
+
+from fspy.common import protocol
+from fspy.common.records import IngestRecord
+
+log = logging.getLogger(__name__)
+
+# Messages of this size (bytes) and larger are decoded out of event loop
+DEFAULT_OFFLOAD_THRESHOLD = 256 * 1024
+DEFAULT_DECODE_WORKERS = 2
+# Larger messages (received or decompressed) are rejected
+DEFAULT_MAX_MESSAGE_SIZE = 32 * 1024 * 1024
+
+# Decoders are pure Python and hold GIL, so only processes decode in parallel with event loop.
+#  Threads still let zlib decompression (which releases GIL) run in parallel and avoid pickling of messages
+DECODE_POOL_PROCESS = "process"
+DECODE_POOL_THREAD = "thread"
+DECODE_POOLS = (DECODE_POOL_PROCESS, DECODE_POOL_THREAD)
+
+
+def parse_diff_message(data: Union[str, bytes], ws_protocol: Optional[str], source_name: str,
+                       max_size: int = DEFAULT_MAX_MESSAGE_SIZE) -> IngestRecord:
+    """
+    Text messages are JSON, binary ones are in negotiated binary protocol.
+    source_name of connection is used for messages of older agents which do not carry it.
+    max_size - max size (bytes) of decompressed message. Raises ProtocolError
+    """
+    if isinstance(data, str):
+        return protocol.decode_json_message(data, source_name)
+
+    return protocol.decode_chunk_record(data, ws_protocol, max_size)
+
+
+class MessageDecoder:
+    """
+    Decodes small messages inline and large ones (offload_threshold bytes and more) in pool of workers,
+     so single huge diff does not stall other connections. workers=0 - everything is decoded inline.
+    Messages larger than max_message_size (received or decompressed) are rejected.
+    """
+
+    def __init__(self, offload_threshold: int = DEFAULT_OFFLOAD_THRESHOLD, workers: int = DEFAULT_DECODE_WORKERS,
+                 pool: str = DECODE_POOL_PROCESS, max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        if pool not in DECODE_POOLS:
+            raise ValueError(f"Unknown decode pool {pool}. Expected one of {DECODE_POOLS}")
+
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self.offload_threshold = offload_threshold
+        self.max_message_size = max_message_size
+
+        self._executor = None  # type: Optional[Executor]
+        if workers > 0:
+            if pool == DECODE_POOL_PROCESS:
+                self._executor = ProcessPoolExecutor(max_workers=workers)
+                # Workers are forked on first task. Start them now, before collector listens on its port,
+                #  so they do not inherit its sockets
+                self._executor.submit(int).result()
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fspy-decode")
+
+        self.inline_count = 0
+        self.offloaded_count = 0
+        # Offloaded messages which are being decoded or wait for free worker
+        self.offloaded_pending = 0
+
+    async def decode(self, data: Union[str, bytes], ws_protocol: Optional[str], source_name: str) -> IngestRecord:
+        if self._executor is None or len(data) < self.offload_threshold:
+            self.inline_count += 1
+            return parse_diff_message(data, ws_protocol, source_name, self.max_message_size)
+
+        self.offloaded_count += 1
+        self.offloaded_pending += 1
+        try:
+            return await self._loop.run_in_executor(self._executor, parse_diff_message,
+                                                    data, ws_protocol, source_name, self.max_message_size)
+        finally:
+            self.offloaded_pending -= 1
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
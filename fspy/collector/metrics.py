@@ -0,0 +1,92 @@
+from typing import Optional, Deque
+
+import asyncio
+from collections import deque
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Seconds between probes of event loop
+DEFAULT_LAG_INTERVAL = 0.5
+# Probes kept for mean and max
+LAG_WINDOW = 120
+# Lag (seconds) which is logged
+LAG_WARNING = 1.0
+
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag: how much later than scheduled sleeping coroutine is woken up.
+    Lag grows when callbacks block the loop (e.g. decoding of huge message or long synchronous DB call).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float = DEFAULT_LAG_INTERVAL):
+        self._loop = loop
+        self.interval = interval
+
+        self._samples = deque(maxlen=LAG_WINDOW)  # type: Deque[float]
+        self._task = None  # type: Optional[asyncio.Task]
+
+    async def _probe(self):
+        while True:
+            started = self._loop.time()
+            await asyncio.sleep(self.interval, loop=self._loop)
+
+            lag = max(self._loop.time() - started - self.interval, 0.0)
+            self._samples.append(lag)
+
+            if lag >= LAG_WARNING:
+                log.warning(f"Event loop was blocked for {lag:.2f}s")
+
+    @property
+    def last(self) -> float:
+        return self._samples[-1] if self._samples else 0.0
+
+    @property
+    def mean(self) -> float:
+        return sum(self._samples) / len(self._samples) if self._samples else 0.0
+
+    @property
+    def max(self) -> float:
+        return max(self._samples, default=0.0)
+
+    def run(self):
+        self._task = asyncio.ensure_future(self._probe(), loop=self._loop)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+class QueueGauge:
+    """
+    Puts to bounded queue without waiting. Keeps high watermark of queue depth and number of items
+     which were rejected because queue was full. Works with asyncio.Queue and async side of janus.Queue
+    """
+
+    def __init__(self, queue):
+        self._queue = queue
+
+        self.high_watermark = 0
+        self.rejected = 0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def max_size(self) -> int:
+        """0 - unbounded"""
+        return self._queue.maxsize
+
+    def put_nowait(self, item) -> bool:
+        """Returns False if queue is full"""
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+        self.high_watermark = max(self.high_watermark, self._queue.qsize())
+        return True
@@ -16,8 +16,41 @@ class FlatReportEntrySchema(BaseModel):
     size_before: Optional[int]
     size_after: Optional[int]
 
+    hash_before: Optional[str]
+    hash_after: Optional[str]
+
     operation_time: datetime
 
 
 class FlatReportSchema(BaseModel):
     entries: List[FlatReportEntrySchema]
+
+
+class LoopLagSchema(BaseModel):
+    # Seconds
+    last: float
+    mean: float
+    max: float
+
+
+class DecodeMetricsSchema(BaseModel):
+    inline: int
+    offloaded: int
+    offloaded_pending: int
+
+
+class QueueMetricsSchema(BaseModel):
+    depth: int
+    # 0 - unbounded
+    max_size: int
+    high_watermark: int
+    # Items not put because queue was full
+    rejected: int
+
+
+class MetricsSchema(BaseModel):
+    event_loop_lag: LoopLagSchema
+    decode: DecodeMetricsSchema
+    # Queue of writing thread of each shard
+    write_queues: List[QueueMetricsSchema]
+    terminal_queue: QueueMetricsSchema
@@ -0,0 +1,61 @@
+"""
+Sharded storage: reports of each source are saved to one of several SQLite DBs, each with its own writing thread,
+ so writers do not wait for each other's locks and disk syncs. Reports are read from all shards.
+
+Shard is chosen by source name, so all chunks of one scan get to the same DB.
+"""
+from typing import List, Optional
+
+import asyncio
+import zlib
+from os import path
+
+import logging
+
+from sqlalchemy.engine import Engine
+
+from fspy.collector.writing_thread import WriteThreadManager, DEFAULT_WRITE_BATCH_SIZE, DEFAULT_WRITE_BATCH_DELAY, \
+    DEFAULT_WRITE_QUEUE_SIZE
+
+log = logging.getLogger(__name__)
+
+
+def shard_paths(db_path: str, shards: int) -> List[str]:
+    """
+    First shard is db_path itself, others are next to it: fspy.sqlite, fspy.1.sqlite, fspy.2.sqlite, ...
+    So DB of collector without shards stays in reports after sharding is turned on
+    """
+    base, ext = path.splitext(db_path)
+    return [db_path] + [f"{base}.{index}{ext}" for index in range(1, shards)]
+
+
+def shard_index(source_name: str, shards: int) -> int:
+    # Built-in hash of str differs between runs
+    return zlib.crc32(source_name.encode()) % shards
+
+
+class ShardedWriteManager:
+    """Writing thread per shard, report is saved by thread of its source's shard"""
+
+    def __init__(self, shards: int, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 batch_size: int = DEFAULT_WRITE_BATCH_SIZE, batch_delay: float = DEFAULT_WRITE_BATCH_DELAY,
+                 queue_size: int = DEFAULT_WRITE_QUEUE_SIZE):
+        """queue_size - bound of queue of each shard"""
+        if shards < 1:
+            raise ValueError(f"Number of shards must be positive, got {shards}")
+
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.managers = [WriteThreadManager(loop=self.loop, batch_size=batch_size, batch_delay=batch_delay,
+                                            queue_size=queue_size)
+                         for _ in range(shards)]
+
+    def run_workers(self, engines: List[Engine]):
+        for manager, engine in zip(self.managers, engines):
+            manager.run_worker(engine)
+
+    async def save(self, data, source_ip=None):
+        manager = self.managers[shard_index(data.source_name, len(self.managers))]
+        return await manager.save(data, source_ip=source_ip)
+
+    async def close(self) -> None:
+        await asyncio.gather(*[manager.close() for manager in self.managers], loop=self.loop)
@@ -0,0 +1,65 @@
+"""
+SQLite engines of collector.
+
+Writing thread and report queries use separate engines. In WAL journal mode readers see consistent snapshot
+ of DB and do not block writer (and vice versa), so long /flat_report queries do not stall ingest.
+"""
+import sqlite3
+from os import path
+from urllib.request import pathname2url
+
+import logging
+
+from sqlalchemy import create_engine, event, pool
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+# In WAL mode NORMAL does not sync on each commit but DB is never corrupted: last commits may be lost
+#  on power failure only
+DEFAULT_SYNCHRONOUS = "NORMAL"
+# WAL is checkpointed into DB when it grows over this number of pages. 0 - only on shutdown
+DEFAULT_WAL_AUTOCHECKPOINT = 1000
+# Connections (and threads) for concurrent report queries
+DEFAULT_READ_POOL_SIZE = 4
+
+
+def create_write_engine(db_path: str, wal: bool = True, synchronous: str = DEFAULT_SYNCHRONOUS,
+                        wal_autocheckpoint: int = DEFAULT_WAL_AUTOCHECKPOINT) -> Engine:
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Unknown synchronous mode {synchronous}. Expected one of {SYNCHRONOUS_MODES}")
+
+    engine = create_engine(f"sqlite:///{db_path}", poolclass=pool.SingletonThreadPool)
+
+    # noinspection PyUnusedLocal
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+
+        # Journal mode is stored in DB file, so it is switched back if WAL is turned off
+        cursor.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+        if wal:
+            cursor.execute(f"PRAGMA wal_autocheckpoint={int(wal_autocheckpoint)}")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+
+        cursor.close()
+
+    return engine
+
+
+def create_read_engine(db_path: str, pool_size: int = DEFAULT_READ_POOL_SIZE) -> Engine:
+    """Engine of read-only connections for report queries. DB must already be created by write engine"""
+    uri = f"file:{pathname2url(path.abspath(db_path))}?mode=ro"
+
+    def connect():
+        # Pool hands connections to different threads
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    return create_engine("sqlite://", creator=connect, poolclass=pool.QueuePool, pool_size=pool_size,
+                         max_overflow=0)
+
+
+def checkpoint(engine: Engine):
+    """Moves WAL content to DB and truncates WAL"""
+    engine.execute("PRAGMA wal_checkpoint(TRUNCATE)")
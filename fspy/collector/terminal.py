@@ -4,7 +4,7 @@ import logging
 from datetime import datetime
 import tzlocal
 
-from fspy.common.model import DiffReport
+from fspy.common.records import IngestRecord
 
 log = logging.getLogger(__name__)
 
@@ -19,7 +19,7 @@ def format_time(time: datetime):
 async def diff_report_printer(diff_report_queue: asyncio.Queue):
     try:
         while True:
-            dr = await diff_report_queue.get()  # type: DiffReport
+            dr = await diff_report_queue.get()  # type: IngestRecord
             if log.isEnabledFor(logging.INFO):
                 for file_state in dr.diff.created:
                     log.info(TEMPLATE.format(
@@ -30,9 +30,14 @@ async def diff_report_printer(diff_report_queue: asyncio.Queue):
                     ))
 
                 for file_diff in dr.diff.updated:
+                    content_unchanged = (
+                        file_diff.before.content_hash is not None
+                        and file_diff.before.content_hash == file_diff.after.content_hash
+                    )
+
                     log.info(TEMPLATE.format(
                         source_name=dr.source_name,
-                        operation="UPDATE",
+                        operation="TOUCH" if content_unchanged else "UPDATE",
                         time=format_time(file_diff.after.date_updated),
                         path=file_diff.after.path,
                     ))
@@ -1,5 +1,6 @@
-from typing import Type
+from typing import Type, Optional, List
 import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 
@@ -9,7 +10,10 @@ from pydantic import BaseModel
 from aiohttp import web
 from sqlalchemy.engine import Engine
 
-from fspy.collector.writing_thread import WriteThreadManager
+from fspy.collector.admission import AdmissionControl
+from fspy.collector.decoding import MessageDecoder
+from fspy.collector.metrics import LoopLagMonitor, QueueGauge
+from fspy.collector.sharding import ShardedWriteManager
 import asyncio
 
 log = logging.getLogger(__name__)
@@ -20,10 +24,19 @@ class AppWrapper:
 
     KEY_WEB_SOCKETS = "web_sockets"
     KEY_WRITE_THREAD_MANAGER = "write_thread_manager"
-    KEY_DB_ENGINE = "db_engine"
+    KEY_DB_ENGINES = "db_engines"
+    KEY_DB_READ_ENGINES = "db_read_engines"
+    KEY_REPORT_EXECUTOR = "report_executor"
     KEY_DB_PATH = "db_path"
     KEY_TERMINAL_TASK = "terminal_task"
     KEY_TERMINAL_QUEUE = "terminal_queue"
+    KEY_TERMINAL_QUEUE_SIZE = "terminal_queue_size"
+    KEY_TERMINAL_GAUGE = "terminal_gauge"
+    KEY_WS_COMPRESS = "ws_compress"
+    KEY_WS_HEARTBEAT = "ws_heartbeat"
+    KEY_ADMISSION = "admission"
+    KEY_DECODER = "decoder"
+    KEY_LOOP_LAG = "loop_lag"
 
     def __init__(self, app: web.Application):
         self._app = app
@@ -37,7 +50,7 @@ class AppWrapper:
         self._app[self.KEY_WEB_SOCKETS] = val
 
     @property
-    def writing_thread_manager(self) -> WriteThreadManager:
+    def writing_thread_manager(self) -> ShardedWriteManager:
         return self._app[self.KEY_WRITE_THREAD_MANAGER]
 
     @writing_thread_manager.setter
@@ -45,12 +58,30 @@ class AppWrapper:
         self._app[self.KEY_WRITE_THREAD_MANAGER] = val
 
     @property
-    def db_engine(self) -> Engine:
-        return self._app[self.KEY_DB_ENGINE]
+    def db_engines(self) -> List[Engine]:
+        """Write engine of each shard"""
+        return self._app[self.KEY_DB_ENGINES]
 
-    @db_engine.setter
-    def db_engine(self, val: Engine):
-        self._app[self.KEY_DB_ENGINE] = val
+    @db_engines.setter
+    def db_engines(self, val: List[Engine]):
+        self._app[self.KEY_DB_ENGINES] = val
+
+    @property
+    def db_read_engines(self) -> List[Engine]:
+        """Read-only engine of each shard"""
+        return self._app[self.KEY_DB_READ_ENGINES]
+
+    @db_read_engines.setter
+    def db_read_engines(self, val: List[Engine]):
+        self._app[self.KEY_DB_READ_ENGINES] = val
+
+    @property
+    def report_executor(self) -> ThreadPoolExecutor:
+        return self._app[self.KEY_REPORT_EXECUTOR]
+
+    @report_executor.setter
+    def report_executor(self, val: ThreadPoolExecutor):
+        self._app[self.KEY_REPORT_EXECUTOR] = val
 
     @property
     def db_path(self) -> str:
@@ -76,6 +107,63 @@ class AppWrapper:
     def terminal_queue(self, val: asyncio.Queue):
         self._app[self.KEY_TERMINAL_QUEUE] = val
 
+    @property
+    def terminal_queue_size(self) -> int:
+        return self._app[self.KEY_TERMINAL_QUEUE_SIZE]
+
+    @terminal_queue_size.setter
+    def terminal_queue_size(self, val: int):
+        self._app[self.KEY_TERMINAL_QUEUE_SIZE] = val
+
+    @property
+    def terminal_gauge(self) -> QueueGauge:
+        """Puts to terminal_queue"""
+        return self._app[self.KEY_TERMINAL_GAUGE]
+
+    @terminal_gauge.setter
+    def terminal_gauge(self, val: QueueGauge):
+        self._app[self.KEY_TERMINAL_GAUGE] = val
+
+    @property
+    def ws_compress(self) -> bool:
+        return self._app[self.KEY_WS_COMPRESS]
+
+    @ws_compress.setter
+    def ws_compress(self, val: bool):
+        self._app[self.KEY_WS_COMPRESS] = val
+
+    @property
+    def ws_heartbeat(self) -> Optional[float]:
+        return self._app[self.KEY_WS_HEARTBEAT]
+
+    @ws_heartbeat.setter
+    def ws_heartbeat(self, val: Optional[float]):
+        self._app[self.KEY_WS_HEARTBEAT] = val
+
+    @property
+    def admission(self) -> Optional[AdmissionControl]:
+        return self._app[self.KEY_ADMISSION]
+
+    @admission.setter
+    def admission(self, val: Optional[AdmissionControl]):
+        self._app[self.KEY_ADMISSION] = val
+
+    @property
+    def decoder(self) -> MessageDecoder:
+        return self._app[self.KEY_DECODER]
+
+    @decoder.setter
+    def decoder(self, val: MessageDecoder):
+        self._app[self.KEY_DECODER] = val
+
+    @property
+    def loop_lag(self) -> LoopLagMonitor:
+        return self._app[self.KEY_LOOP_LAG]
+
+    @loop_lag.setter
+    def loop_lag(self, val: LoopLagMonitor):
+        self._app[self.KEY_LOOP_LAG] = val
+
 
 def marshal_response(*types: Type[BaseModel]):
     def wrapper(fn):
@@ -1,25 +1,37 @@
-from typing import Optional, List
+from typing import Optional, List, Set
 
+import asyncio
+import heapq
 import logging
 
 import pytz
 from aiohttp import web
 
 import pydantic
-import json
 
 from datetime import datetime
 import tzlocal
 
-from sqlalchemy import and_
+from sqlalchemy import and_, or_
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session, joinedload
 
 from fspy.collector import db, schemas
+from fspy.common import protocol
+from fspy.common.records import IngestRecord
+from fspy.collector.metrics import QueueGauge
 from fspy.collector.utils import AppWrapper
-from fspy.common.model import DiffReportHandlingResponse, DiffReport, FullDiff
+from fspy.collector.writing_thread import WriteQueueFull
+from fspy.common.model import DiffReportHandlingResponse
 
 log = logging.getLogger(__name__)
 
+# Sequenced messages of one connection which may be saved concurrently. Further messages are not read until
+#  one of them is saved, so TCP flow control slows down the agent
+MAX_IN_FLIGHT_PER_CONNECTION = 64
+# Seconds after which agent should resend diff which was rejected because writing thread is behind
+BUSY_RETRY_AFTER = 1.0
+
 
 # noinspection PyUnresolvedReferences
 class GetArgsMixin:
@@ -31,12 +43,64 @@ class GetArgsMixin:
 
 
 class LogsCollectorView(web.View, GetArgsMixin):
+    """
+    Receives diffs from agent. Each message is answered with DiffReportHandlingResponse.
+
+    Messages with sequence number are saved concurrently with reading of next ones and answered
+     in order of saving, response carries the number. Messages without it are answered in order of arrival.
+
+    When new connections come faster than admission control allows, connection is answered with
+     retry_after hint and closed.
+    """
+
     class GetArgs(pydantic.BaseModel):
         source_name: str
 
     @staticmethod
-    def _get_resp_dict(handled=True, message=None):
-        return DiffReportHandlingResponse(handled=handled, message=message).dict()
+    def _get_resp_dict(handled=True, message=None, seq=None, retry_after=None):
+        return DiffReportHandlingResponse(handled=handled, message=message, seq=seq, retry_after=retry_after).dict()
+
+    async def _respond(self, ws: web.WebSocketResponse, send_lock: asyncio.Lock,
+                       handled=True, message=None, seq=None, retry_after=None):
+        # Responses are sent by concurrent save tasks
+        async with send_lock:
+            await ws.send_json(self._get_resp_dict(handled=handled, message=message, seq=seq,
+                                                   retry_after=retry_after))
+
+    async def _save(self, ws: web.WebSocketResponse, send_lock: asyncio.Lock, diff_report: IngestRecord):
+        app_w = AppWrapper(self.request.app)
+        seq = getattr(diff_report, "seq", None)
+
+        log.info(f"Diff report from {self.request.remote}/{diff_report.source_name}")
+
+        retry_after = None
+
+        # noinspection PyBroadException
+        try:
+            await app_w.writing_thread_manager.save(diff_report, source_ip=self.request.remote)
+            handled, message = True, None
+
+            if not app_w.terminal_gauge.put_nowait(diff_report):
+                log.debug(f"Terminal queue is full, diff report from {self.request.remote} is not printed")
+
+        except WriteQueueFull as e:
+            log.warning(f"Diff report from {self.request.remote} is rejected: {e}")
+            handled, message, retry_after = False, "Collector is busy", BUSY_RETRY_AFTER
+
+        except Exception:
+            log.exception(f"Error during saving diff report from {self.request.remote}")
+            handled, message = False, "Unexpected error"
+
+        if ws.closed:
+            # Agent will resend the diff over new connection, saved chunks are skipped then
+            log.warning(f"Connection from {self.request.remote} closed before diff {seq} was acknowledged")
+            return
+
+        # noinspection PyBroadException
+        try:
+            await self._respond(ws, send_lock, handled=handled, message=message, seq=seq, retry_after=retry_after)
+        except Exception:
+            log.exception(f"Can not respond to {self.request.remote}")
 
     async def get(self):
         args = self.parse_arg()  # type: self.GetArgs
@@ -44,48 +108,57 @@ class LogsCollectorView(web.View, GetArgsMixin):
         app_w = AppWrapper(self.request.app)
 
         log.info(f"Handling new WS connection from {self.request.remote}")
-        ws = web.WebSocketResponse()
+        ws = web.WebSocketResponse(protocols=protocol.SUPPORTED_PROTOCOLS, compress=app_w.ws_compress,
+                                   heartbeat=app_w.ws_heartbeat, max_msg_size=app_w.decoder.max_message_size)
         await ws.prepare(self.request)
 
+        retry_after = app_w.admission.admit() if app_w.admission is not None else None
+        if retry_after is not None:
+            log.info(f"Too many new connections, {self.request.remote} is asked to retry in {retry_after:.1f}s")
+
+            await ws.send_json(self._get_resp_dict(handled=False, message="Collector is busy",
+                                                   retry_after=retry_after))
+            await ws.close()
+            return ws
+
         app_w.web_sockets.add(ws)
 
+        send_lock = asyncio.Lock()
+        in_flight = asyncio.Semaphore(MAX_IN_FLIGHT_PER_CONNECTION)
+        save_tasks = set()  # type: Set[asyncio.Future]
+
         try:
             async for msg in ws:
-                if msg.type == web.WSMsgType.TEXT:
-                    try:
-                        msg_dict = json.loads(msg.data)
-                        diff_report = DiffReport(
-                            source_name=args.source_name,
-                            diff=FullDiff(**msg_dict)
-                        )
-                    except json.JSONDecodeError:
-                        log.warning(f"Can not decode message from {self.request.remote}: {msg.data}")
-
-                        await ws.send_json(self._get_resp_dict(handled=False, message="Malformed JSON"))
-                        continue
-                    except pydantic.ValidationError as e:
-                        log.warning(f"Malformed message schema in message from {self.request.remote}: {e}")
-
-                        await ws.send_json(self._get_resp_dict(handled=False, message=str(e)))
-                        continue
-
-                    log.info(f"Diff report from {self.request.remote}/{diff_report.source_name}")
-
-                    # noinspection PyBroadException
-                    try:
-                        app_w.terminal_queue.put_nowait(diff_report)
-                        await app_w.writing_thread_manager.save(diff_report, source_ip=self.request.remote)
-                        await ws.send_json(self._get_resp_dict(handled=True))
-
-                    except Exception:
-                        log.exception(f"Error during saving diff report from {self.request.remote}")
-                        await ws.send_json(self._get_resp_dict(handled=False, message="Unexpected error"))
-                else:
+                if msg.type not in (web.WSMsgType.TEXT, web.WSMsgType.BINARY):
                     log.warning(f"Unexpected message type from {self.request.remote}: {msg.type}")
-                    await ws.send_json(self._get_resp_dict(handled=False, message="Unknown message type"))
+                    await self._respond(ws, send_lock, handled=False, message="Unknown message type")
+                    continue
+
+                try:
+                    diff_report = await app_w.decoder.decode(msg.data, ws.ws_protocol, args.source_name)
+                except protocol.ProtocolError as e:
+                    log.warning(f"Malformed message from {self.request.remote}: {e}")
+
+                    await self._respond(ws, send_lock, handled=False, message=str(e), seq=e.seq)
+                    continue
+
+                if getattr(diff_report, "seq", None) is None:
+                    await self._save(ws, send_lock, diff_report)
+                    continue
+
+                await in_flight.acquire()
+
+                save_task = asyncio.ensure_future(self._save(ws, send_lock, diff_report))
+                save_task.add_done_callback(lambda _: in_flight.release())
+                save_task.add_done_callback(save_tasks.discard)
+                save_tasks.add(save_task)
         finally:
             app_w.web_sockets.discard(ws)
 
+            if save_tasks:
+                # Diffs already received are saved even if connection is gone
+                await asyncio.gather(*save_tasks, return_exceptions=True)
+
         return ws
 
 
@@ -94,6 +167,8 @@ class FlatReportView(web.View, GetArgsMixin):
         date_start: datetime
         date_end: datetime
         source: Optional[str] = None
+        # Scans which chunks are still arriving are not reported by default
+        include_incomplete: bool = False
 
         # noinspection PyMethodParameters
         @pydantic.validator("date_start", "date_end")
@@ -102,9 +177,10 @@ class FlatReportView(web.View, GetArgsMixin):
                 value = tzlocal.get_localzone().localize(value)
             return value
 
-    def sync_get(self, args: "GetArgs"):
-        app_w = AppWrapper(self.request.app)
-        session = Session(bind=app_w.db_engine)
+    @staticmethod
+    def sync_get(engine: Engine, args: "GetArgs") -> List[schemas.FlatReportEntrySchema]:
+        """Entries of one shard ordered by operation time"""
+        session = Session(bind=engine)
 
         query = session.query(db.FileDiff).options(
             joinedload(db.FileDiff.diff_report)
@@ -117,6 +193,12 @@ class FlatReportView(web.View, GetArgsMixin):
             )
         )
 
+        if not args.include_incomplete:
+            # Reports saved before chunked uploads have no completeness flag
+            query = query.filter(
+                or_(db.DiffReport.complete.is_(True), db.DiffReport.complete.is_(None))
+            )
+
         if args.source:
             query = query.filter(
                 db.DiffReport.source_name == args.source
@@ -130,30 +212,73 @@ class FlatReportView(web.View, GetArgsMixin):
 
         session.close()
 
-        return schemas.FlatReportSchema(
-            entries=[
-                schemas.FlatReportEntrySchema(
-                    source_name=file_diff.diff_report.source_name,
-                    source_ip=file_diff.diff_report.source_ip,
+        return [
+            schemas.FlatReportEntrySchema(
+                source_name=file_diff.diff_report.source_name,
+                source_ip=file_diff.diff_report.source_ip,
 
-                    file_path=file_diff.file_path,
-                    operation=file_diff.operation,
+                file_path=file_diff.file_path,
+                operation=file_diff.operation,
 
-                    size_before=file_diff.size_before,
-                    size_after=file_diff.size_after,
+                size_before=file_diff.size_before,
+                size_after=file_diff.size_after,
 
-                    operation_time=pytz.utc.localize(file_diff.operation_time),
-                )
-                for file_diff in result
-            ]
-        )
+                hash_before=file_diff.hash_before,
+                hash_after=file_diff.hash_after,
+
+                operation_time=pytz.utc.localize(file_diff.operation_time),
+            )
+            for file_diff in result
+        ]
 
     async def get(self):
         args = self.parse_arg()  # type: self.GetArgs
 
         loop = self.request.app.loop
+        app_w = AppWrapper(self.request.app)
+
+        # Shards are queried concurrently, their ordered entries are merged
+        shard_entries = await asyncio.gather(*[
+            loop.run_in_executor(app_w.report_executor, self.sync_get, engine, args)
+            for engine in app_w.db_read_engines
+        ], loop=loop)
 
-        # TODO FIX: Use explicit thread pool executor
-        report = await loop.run_in_executor(None, self.sync_get, args)
+        report = schemas.FlatReportSchema(
+            entries=list(heapq.merge(*shard_entries, key=lambda entry: entry.operation_time))
+        )
 
         return web.json_response(text=report.json())
+
+
+class MetricsView(web.View):
+    """Health of collector ingest path: event loop lag, decoding of messages and depth of queues"""
+
+    @staticmethod
+    def _queue_metrics(gauge: QueueGauge) -> schemas.QueueMetricsSchema:
+        return schemas.QueueMetricsSchema(
+            depth=gauge.depth,
+            max_size=gauge.max_size,
+            high_watermark=gauge.high_watermark,
+            rejected=gauge.rejected,
+        )
+
+    async def get(self):
+        app_w = AppWrapper(self.request.app)
+
+        metrics = schemas.MetricsSchema(
+            event_loop_lag=schemas.LoopLagSchema(
+                last=app_w.loop_lag.last,
+                mean=app_w.loop_lag.mean,
+                max=app_w.loop_lag.max,
+            ),
+            decode=schemas.DecodeMetricsSchema(
+                inline=app_w.decoder.inline_count,
+                offloaded=app_w.decoder.offloaded_count,
+                offloaded_pending=app_w.decoder.offloaded_pending,
+            ),
+            write_queues=[self._queue_metrics(manager.queue_gauge)
+                          for manager in app_w.writing_thread_manager.managers],
+            terminal_queue=self._queue_metrics(app_w.terminal_gauge),
+        )
+
+        return web.json_response(text=metrics.json())
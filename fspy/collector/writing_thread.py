@@ -1,7 +1,8 @@
-from typing import Optional, NamedTuple, Any
+from typing import Optional, NamedTuple, Any, List, Tuple
 import asyncio
 import threading
-from queue import Queue
+import time
+from queue import Queue, Empty
 import janus
 
 import logging
@@ -10,10 +11,22 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
 from fspy.collector import db
-from fspy.common import model
+from fspy.collector.metrics import QueueGauge
+from fspy.common import records
 
 log = logging.getLogger(__name__)
 
+# Tasks written in one transaction (group commit), so many small reports share one fsync
+DEFAULT_WRITE_BATCH_SIZE = 100
+# Seconds to wait for more tasks after the first one of batch
+DEFAULT_WRITE_BATCH_DELAY = 0.005
+# Tasks waiting for writing thread. When queue is full, new reports are rejected instead of piling up in memory
+DEFAULT_WRITE_QUEUE_SIZE = 1000
+
+
+class WriteQueueFull(Exception):
+    pass
+
 
 class WriteTask(NamedTuple):
     loop: asyncio.AbstractEventLoop
@@ -30,56 +43,140 @@ def _finish_future_with_exc(fut: asyncio.Future, exc: Exception):
     fut.set_exception(exc)
 
 
-# TODO CONSIDER: Test performance with raw SQL calls
-def _serve_write_queue(q: Queue, engine: Engine):
-    while True:
-        session = Session(bind=engine)
+def _add_task(session: Session, task: WriteTask):
+    data = task.data
+
+    if isinstance(data, records.ReportRecord):
+        db.insert_diff_report(session, data, source_ip=task.source_ip)
+
+    elif isinstance(data, records.ChunkRecord):
+        db_diff_report = db.diff_chunk_to_db_model(session, data, source_ip=task.source_ip)
+        session.add(db_diff_report)
+
+        if db_diff_report.complete:
+            log.debug(f"Scan {data.scan_id} of {data.source_name} is complete")
+
+    else:
+        raise ValueError(f"Unknown instance type in writing queue: {data}")
+
+
+def _write_task(engine: Engine, task: WriteTask) -> Optional[Exception]:
+    session = Session(bind=engine)
+
+    try:
+        _add_task(session, task)
+        session.commit()
+
+    except Exception as exc:
+        log.exception("Exception during handling writing task")
+        session.rollback()
+        return exc
+
+    finally:
+        session.close()
+
+    return None
+
+
+def _write_batch(engine: Engine, tasks: List[WriteTask]) -> List[Optional[Exception]]:
+    """
+    Writes tasks in one transaction. If it fails, transaction is rolled back and tasks are written one by one,
+     so only failed tasks get the error.
+    """
+    if len(tasks) == 1:
+        return [_write_task(engine, tasks[0])]
+
+    session = Session(bind=engine)
+
+    try:
+        for task in tasks:
+            _add_task(session, task)
+
+        session.commit()
+
+    except Exception as exc:
+        log.warning(f"Group commit of {len(tasks)} tasks failed ({exc!r}), writing them one by one")
+        session.rollback()
+        return [_write_task(engine, task) for task in tasks]
+
+    finally:
+        session.close()
+
+    return [None] * len(tasks)
+
+
+def _get_batch(q: Queue, batch_size: int, batch_delay: float) -> Tuple[List[WriteTask], bool]:
+    """
+    Waits for task and takes up to batch_size tasks arriving in batch_delay seconds after it.
+    Second value is True if stop signal was received
+    """
+    log.debug("Waiting for task in queue")
+    task = q.get()  # type: Optional[WriteTask]
+
+    if task is None:
+        return [], True
+
+    tasks = [task]
+    deadline = time.monotonic() + batch_delay
+
+    while len(tasks) < batch_size:
+        timeout = deadline - time.monotonic()
 
-        # noinspection PyBroadException
         try:
-            log.debug("Waiting for task in queue")
-            task = q.get()  # type: Optional[WriteTask]
-            log.debug(f"Task fetched from queue {task}")
+            task = q.get(timeout=timeout) if timeout > 0 else q.get_nowait()
+        except Empty:
+            break
 
-            if task is None:
-                log.debug("Empty task received. Exiting...")
-                break
+        if task is None:
+            return tasks, True
 
-            try:
-                data = task.data
+        tasks.append(task)
 
-                if isinstance(data, model.DiffReport):
-                    db_diff_report = db.diff_report_to_db_model(data, source_ip=task.source_ip)
-                    session.add(db_diff_report)
+    return tasks, False
 
-                    session.commit()
 
-                else:
-                    raise ValueError(f"Unknown instance type in writing queue: {data}")
+def _serve_write_queue(q: Queue, engine: Engine, batch_size: int, batch_delay: float):
+    while True:
+        # noinspection PyBroadException
+        try:
+            tasks, stop = _get_batch(q, batch_size, batch_delay)
+            log.debug(f"{len(tasks)} tasks fetched from queue")
 
-            except Exception as exc:
-                log.exception("Exception during handling writing task")
-                task.loop.call_soon_threadsafe(_finish_future_with_exc, task.future, exc)
-                continue
+            for task, exc in zip(tasks, _write_batch(engine, tasks)):
+                if exc is None:
+                    task.loop.call_soon_threadsafe(_finish_future, task.future, None)
+                else:
+                    task.loop.call_soon_threadsafe(_finish_future_with_exc, task.future, exc)
 
-            task.loop.call_soon_threadsafe(_finish_future, task.future, None)
+            if stop:
+                log.debug("Empty task received. Exiting...")
+                break
 
         except Exception:
             log.exception("Error during serving writing queue")
 
 
 class WriteThreadManager:
-    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 batch_size: int = DEFAULT_WRITE_BATCH_SIZE, batch_delay: float = DEFAULT_WRITE_BATCH_DELAY,
+                 queue_size: int = DEFAULT_WRITE_QUEUE_SIZE):
+        """queue_size - max number of tasks waiting for writing thread, 0 - unbounded"""
         self.loop = loop if loop else asyncio.get_event_loop()
-        self.task_queue = janus.Queue(loop=self.loop)
+        self.task_queue = janus.Queue(maxsize=queue_size, loop=self.loop)
+        self.queue_gauge = QueueGauge(self.task_queue.async_q)
+
+        self.batch_size = max(batch_size, 1)
+        self.batch_delay = batch_delay
 
         self.worker_thread = None
 
     def run_worker(self, engine: Engine):
-        self.worker_thread = threading.Thread(target=_serve_write_queue, args=(self.task_queue.sync_q, engine,))
+        self.worker_thread = threading.Thread(target=_serve_write_queue,
+                                              args=(self.task_queue.sync_q, engine, self.batch_size, self.batch_delay))
         self.worker_thread.start()
 
     async def save(self, data, source_ip=None):
+        """Raises WriteQueueFull if writing thread is behind by queue_size tasks"""
         fut = self.loop.create_future()
 
         task = WriteTask(
@@ -89,7 +186,8 @@ class WriteThreadManager:
             source_ip=source_ip
         )
 
-        await self.task_queue.async_q.put(task)
+        if not self.queue_gauge.put_nowait(task):
+            raise WriteQueueFull(f"Write queue is full ({self.queue_gauge.max_size} tasks)")
 
         result = await fut
         log.debug("Get result from worker thread for %s", result)
@@ -1,4 +1,5 @@
 # TODO CONSIDER: Use named tuples for internal operations and convert to pydantic.BaseModel only during sending
+#  (collector ingest path already does, see fspy.common.records)
 from datetime import datetime
 from typing import List
 
@@ -11,6 +12,9 @@ class FileState(BaseModel):
     date_updated: datetime
     size: int
 
+    # Filled by agents with content hashing enabled
+    content_hash: str = None
+
 
 class FileDiff(BaseModel):
     before: FileState = None
@@ -35,6 +39,24 @@ class DiffReport(BaseModel):
     diff: FullDiff
 
 
+class DiffChunk(BaseModel):
+    """Part of diff of a single scan. Scan is complete when chunk marked as last arrives"""
+    source_name: str
+    scan_id: str
+    chunk_index: int
+    last: bool
+    diff: FullDiff
+
+    # Number of message on connection, echoed in response. Set by sender for each transmission
+    seq: int = None
+
+
 class DiffReportHandlingResponse(BaseModel):
     handled: bool
     message: str = None
+
+    # Sequence number of message this response is for
+    seq: int = None
+
+    # Collector is busy: agent should not send or reconnect sooner than in this number of seconds
+    retry_after: float = None
@@ -0,0 +1,540 @@
+"""
+Wire protocols of agent -> collector WebSocket, negotiated as WebSocket sub-protocol on connect.
+
+JSON protocol: pydantic JSON of DiffChunk (DiffReport/FullDiff from older agents) in text messages.
+ Used if peer does not support binary protocol. Collector validates messages by hand (decode_json_message),
+ same as pydantic does, except that values are not coerced between types (e.g. "512" is not a valid size).
+
+Binary protocol, version 1: diff chunk in single binary message (little-endian)
+    header:      message type, flags, source name length, chunk index,
+                 run start, run end (epoch microseconds), created / deleted / updated counts
+    source name: UTF-8
+    scan id:     1 byte length + ASCII
+    records:     created, deleted, updated (before and after record for each)
+file record:
+    path length, ctime, mtime (epoch microseconds), size, content hash length
+    path:        UTF-8 (undecodable file names are kept with surrogateescape)
+    hash:        raw digest bytes
+
+Binary protocol, version 2: same as version 1, but paths are front-coded.
+ Record carries length of prefix shared with path of previous record of the message and the rest of path only.
+ Paths of diff come in traversal order, so neighbours share target and directory chains.
+ Messages do not depend on each other, so chunk may be resent or sent over new connection.
+file record:
+    shared prefix length, suffix length, ctime, mtime (epoch microseconds), size, content hash length
+    suffix:      UTF-8 bytes of path after shared prefix
+    hash:        raw digest bytes
+
+Binary protocol, version 3: same as version 2, but sender may compress large messages.
+ Compressed message is message type byte followed by zlib stream of whole version 2 message.
+
+Binary protocol, version 4: version 3 message prefixed with message type and sequence number (u32),
+ which is echoed in response. Agent may send next messages without waiting for responses,
+ collector may handle them concurrently and respond in any order.
+
+Transport compression (permessage-deflate WebSocket extension) is negotiated independently of sub-protocol,
+ it compresses every message, JSON ones included.
+"""
+from typing import List, Optional, Union, Dict, Any
+
+import re
+import json
+import zlib
+import struct
+from datetime import datetime, timedelta, timezone
+
+import pytz
+
+from fspy.common.model import DiffChunk, FileState
+from fspy.common.records import FileRecord, FileDiffRecord, DiffRecord, ChunkRecord, ReportRecord, IngestRecord, \
+    chunk_to_model
+
+JSON_PROTOCOL = "fspy.json"
+BINARY_PROTOCOL_V1 = "fspy.bin.1"
+BINARY_PROTOCOL_V2 = "fspy.bin.2"
+BINARY_PROTOCOL_V3 = "fspy.bin.3"
+BINARY_PROTOCOL_V4 = "fspy.bin.4"
+
+# In order of preference
+BINARY_PROTOCOLS = (BINARY_PROTOCOL_V4, BINARY_PROTOCOL_V3, BINARY_PROTOCOL_V2, BINARY_PROTOCOL_V1)
+SUPPORTED_PROTOCOLS = BINARY_PROTOCOLS + (JSON_PROTOCOL,)
+
+# Protocols which messages carry sequence numbers, so several of them may be in flight
+SEQUENCED_PROTOCOLS = (BINARY_PROTOCOL_V4,)
+# Protocols which messages may be zlib-compressed
+COMPRESSED_PROTOCOLS = (BINARY_PROTOCOL_V4, BINARY_PROTOCOL_V3)
+
+COMPRESSION_NONE = "none"
+# zlib-compressed binary messages (binary protocol version 3+)
+COMPRESSION_ZLIB = "zlib"
+# permessage-deflate WebSocket extension
+COMPRESSION_DEFLATE = "deflate"
+COMPRESSION_MODES = (COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_DEFLATE)
+
+# Smaller messages are sent as is: header of zlib stream and CPU time are not paid off
+DEFAULT_COMPRESS_THRESHOLD = 1024
+DEFAULT_COMPRESS_LEVEL = 1
+# Same as default max message size of aiohttp WebSocket
+MAX_DECOMPRESSED_SIZE = 4 * 1024 * 1024
+
+MSG_DIFF_CHUNK = 1
+MSG_COMPRESSED = 2
+MSG_SEQUENCED = 3
+
+FLAG_LAST = 0x01
+
+_CHUNK_HEADER = struct.Struct("<BBHIqqIII")
+_SCAN_ID_LENGTH = struct.Struct("<B")
+_SEQUENCE_HEADER = struct.Struct("<BI")
+_FILE_RECORD_V1 = struct.Struct("<HqqQB")
+_FILE_RECORD_V2 = struct.Struct("<HHqqQB")
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+_PATH_ENCODING = ("utf-8", "surrogateescape")
+
+
+class ProtocolError(ValueError):
+    # Sequence number of malformed message, if it could be read
+    seq = None  # type: Optional[int]
+
+
+def datetime_to_us(value: datetime) -> int:
+    """Naive datetime is treated as UTC"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=pytz.utc)
+
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def datetime_from_us(timestamp_us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=timestamp_us)
+
+
+def common_prefix_length(a: bytes, b: bytes) -> int:
+    """Binary search over slice comparisons: few C-level compares instead of Python loop over bytes"""
+    low, high = 0, min(len(a), len(b))
+
+    while low < high:
+        middle = (low + high + 1) // 2
+
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+
+    return low
+
+
+class _RecordEncoder:
+    def __init__(self, version: str, parts: List[bytes]):
+        self._front_coding = version != BINARY_PROTOCOL_V1
+        self._parts = parts
+        self._prev_path = b""
+
+    def encode(self, file_state: FileState):
+        path_bytes = file_state.path.encode(*_PATH_ENCODING)
+        digest = bytes.fromhex(file_state.content_hash) if file_state.content_hash else b""
+        times_and_size = (
+            datetime_to_us(file_state.date_created),
+            datetime_to_us(file_state.date_updated),
+            file_state.size,
+            len(digest),
+        )
+
+        if self._front_coding:
+            shared = common_prefix_length(self._prev_path, path_bytes)
+            self._prev_path = path_bytes
+            path_bytes = path_bytes[shared:]
+
+            self._parts.append(_FILE_RECORD_V2.pack(shared, len(path_bytes), *times_and_size))
+        else:
+            self._parts.append(_FILE_RECORD_V1.pack(len(path_bytes), *times_and_size))
+
+        self._parts.append(path_bytes)
+        self._parts.append(digest)
+
+
+def compress_message(data: bytes, threshold: int = DEFAULT_COMPRESS_THRESHOLD,
+                     level: int = DEFAULT_COMPRESS_LEVEL) -> bytes:
+    """Returns message as is if it is smaller than threshold or does not shrink"""
+    if len(data) < threshold:
+        return data
+
+    compressed = bytes((MSG_COMPRESSED,)) + zlib.compress(data, level)
+
+    return compressed if len(compressed) < len(data) else data
+
+
+def decompress_message(data: bytes, max_size: int = MAX_DECOMPRESSED_SIZE) -> bytes:
+    """Returns message as is if it is not compressed"""
+    if not data or data[0] != MSG_COMPRESSED:
+        return data
+
+    decompressor = zlib.decompressobj()
+
+    try:
+        decompressed = decompressor.decompress(memoryview(data)[1:], max_size)
+    except zlib.error as e:
+        raise ProtocolError(f"Malformed compressed message: {e}") from e
+
+    if decompressor.unconsumed_tail:
+        raise ProtocolError(f"Compressed message is larger than {max_size} bytes")
+
+    if not decompressor.eof:
+        raise ProtocolError("Malformed compressed message: truncated zlib stream")
+
+    if decompressor.unused_data:
+        raise ProtocolError("Malformed compressed message: data after end of zlib stream")
+
+    return decompressed
+
+
+def encode_diff_chunk(chunk: DiffChunk, version: str = BINARY_PROTOCOL_V4,
+                      compress_threshold: Optional[int] = None, compress_level: int = DEFAULT_COMPRESS_LEVEL) -> bytes:
+    """
+    Message is compressed only if compress_threshold is set and protocol version supports compression.
+    Sequenced protocols require chunk.seq to be set.
+    """
+    if version not in BINARY_PROTOCOLS:
+        raise ValueError(f"Unknown binary protocol {version}")
+
+    data = _encode_diff_chunk(chunk, version)
+
+    if compress_threshold is not None and version in COMPRESSED_PROTOCOLS:
+        data = compress_message(data, compress_threshold, compress_level)
+
+    if version in SEQUENCED_PROTOCOLS:
+        if chunk.seq is None:
+            raise ValueError(f"Sequence number is required by {version}")
+
+        data = _SEQUENCE_HEADER.pack(MSG_SEQUENCED, chunk.seq) + data
+
+    return data
+
+
+def _encode_diff_chunk(chunk: DiffChunk, version: str) -> bytes:
+    source_name = chunk.source_name.encode()
+    scan_id = chunk.scan_id.encode("ascii")
+    diff = chunk.diff
+
+    parts = [
+        _CHUNK_HEADER.pack(
+            MSG_DIFF_CHUNK,
+            FLAG_LAST if chunk.last else 0,
+            len(source_name),
+            chunk.chunk_index,
+            datetime_to_us(diff.run_start),
+            datetime_to_us(diff.run_end),
+            len(diff.created),
+            len(diff.deleted),
+            len(diff.updated),
+        ),
+        source_name,
+        _SCAN_ID_LENGTH.pack(len(scan_id)),
+        scan_id,
+    ]
+
+    encoder = _RecordEncoder(version, parts)
+
+    for file_state in diff.created:
+        encoder.encode(file_state)
+
+    for file_state in diff.deleted:
+        encoder.encode(file_state)
+
+    for file_diff in diff.updated:
+        encoder.encode(file_diff.before)
+        encoder.encode(file_diff.after)
+
+    return b"".join(parts)
+
+
+class _RecordDecoder:
+    def __init__(self, version: str, buf: memoryview, offset: int):
+        self._front_coding = version != BINARY_PROTOCOL_V1
+        self._buf = buf
+        self._prev_path = b""
+
+        self.offset = offset
+
+    def decode(self) -> FileRecord:
+        buf = self._buf
+
+        if self._front_coding:
+            shared, suffix_len, ctime_us, mtime_us, size, hash_len = _FILE_RECORD_V2.unpack_from(buf, self.offset)
+            self.offset += _FILE_RECORD_V2.size
+
+            if shared > len(self._prev_path):
+                raise ProtocolError(f"Malformed diff chunk: shared prefix {shared} is longer than previous path")
+
+            path_bytes = self._prev_path[:shared] + bytes(buf[self.offset:self.offset + suffix_len])
+            self._prev_path = path_bytes
+            self.offset += suffix_len
+        else:
+            path_len, ctime_us, mtime_us, size, hash_len = _FILE_RECORD_V1.unpack_from(buf, self.offset)
+            self.offset += _FILE_RECORD_V1.size
+
+            path_bytes = bytes(buf[self.offset:self.offset + path_len])
+            self.offset += path_len
+
+        content_hash = None
+        if hash_len:
+            content_hash = bytes(buf[self.offset:self.offset + hash_len]).hex()
+            self.offset += hash_len
+
+        # Values are typed by the format itself, so no validation is needed
+        return FileRecord(
+            path_bytes.decode(*_PATH_ENCODING),
+            datetime_from_us(ctime_us),
+            datetime_from_us(mtime_us),
+            size,
+            content_hash,
+        )
+
+
+def decode_diff_chunk(data: bytes, version: str = BINARY_PROTOCOL_V4) -> DiffChunk:
+    """Same as decode_chunk_record, but returns pydantic model"""
+    return chunk_to_model(decode_chunk_record(data, version))
+
+
+def decode_chunk_record(data: bytes, version: str = BINARY_PROTOCOL_V4,
+                        max_size: int = MAX_DECOMPRESSED_SIZE) -> ChunkRecord:
+    """
+    max_size - max size (bytes) of decompressed message.
+    Raises ProtocolError with seq set if only sequence number of message could be decoded
+    """
+    if version not in BINARY_PROTOCOLS:
+        raise ProtocolError(f"Unknown binary protocol {version}")
+
+    seq = None
+
+    if version in SEQUENCED_PROTOCOLS:
+        try:
+            msg_type, seq = _SEQUENCE_HEADER.unpack_from(data, 0)
+        except struct.error as e:
+            raise ProtocolError(f"Malformed sequenced message: {e}") from e
+
+        if msg_type != MSG_SEQUENCED:
+            raise ProtocolError(f"Unknown message type {msg_type}, sequenced message expected")
+
+        data = memoryview(data)[_SEQUENCE_HEADER.size:]
+
+    try:
+        if version in COMPRESSED_PROTOCOLS:
+            data = decompress_message(data, max_size)
+
+        return _decode_diff_chunk(data, version, seq)
+
+    except ProtocolError as e:
+        e.seq = seq
+        raise
+
+
+def _decode_diff_chunk(data: bytes, version: str, seq: Optional[int]) -> ChunkRecord:
+    buf = memoryview(data)
+
+    try:
+        (msg_type, flags, source_name_len, chunk_index, run_start_us, run_end_us,
+         created_count, deleted_count, updated_count) = _CHUNK_HEADER.unpack_from(buf, 0)
+
+        if msg_type != MSG_DIFF_CHUNK:
+            raise ProtocolError(f"Unknown message type {msg_type}")
+
+        offset = _CHUNK_HEADER.size
+
+        source_name = bytes(buf[offset:offset + source_name_len]).decode()
+        offset += source_name_len
+
+        scan_id_len, = _SCAN_ID_LENGTH.unpack_from(buf, offset)
+        offset += _SCAN_ID_LENGTH.size
+
+        scan_id = bytes(buf[offset:offset + scan_id_len]).decode("ascii")
+        offset += scan_id_len
+
+        decoder = _RecordDecoder(version, buf, offset)
+
+        created = [decoder.decode() for _ in range(created_count)]
+        deleted = [decoder.decode() for _ in range(deleted_count)]
+        updated = [FileDiffRecord(decoder.decode(), decoder.decode()) for _ in range(updated_count)]
+
+        offset = decoder.offset
+
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ProtocolError(f"Malformed diff chunk: {e}") from e
+
+    if offset != len(buf):
+        raise ProtocolError(f"Malformed diff chunk: {len(buf)} bytes received, {offset} bytes expected")
+
+    if not source_name or not scan_id:
+        raise ProtocolError("Malformed diff chunk: empty source name or scan id")
+
+    return ChunkRecord(
+        source_name=source_name,
+        scan_id=scan_id,
+        chunk_index=chunk_index,
+        last=bool(flags & FLAG_LAST),
+        seq=seq,
+        diff=DiffRecord(
+            run_start=datetime_from_us(run_start_us),
+            run_end=datetime_from_us(run_end_us),
+            created=created,
+            deleted=deleted,
+            updated=updated,
+        ),
+    )
+
+
+# Same format as accepted by pydantic
+_DATETIME_RE = re.compile(
+    r"(\d{4})-(\d{1,2})-(\d{1,2})[T ](\d{1,2}):(\d{1,2})(?::(\d{1,2})(?:\.(\d{1,6})\d*)?)?"
+    r"(Z|[+-]\d{2}(?::?\d{2})?)?$"
+)
+# Numbers above are treated as milliseconds, same as pydantic does
+_MS_WATERSHED = 2e10
+
+_timezones = {0: timezone.utc}  # type: Dict[int, timezone]
+
+
+def _timezone(value: str) -> timezone:
+    if value == "Z":
+        return timezone.utc
+
+    sign = -1 if value[0] == "-" else 1
+    offset = sign * (int(value[1:3]) * 60 + (int(value[-2:]) if len(value) > 3 else 0))
+
+    tz = _timezones.get(offset)
+    if tz is None:
+        tz = _timezones[offset] = timezone(timedelta(minutes=offset))
+    return tz
+
+
+def _parse_datetime(value: Any, loc: str) -> datetime:
+    if isinstance(value, str):
+        match = _DATETIME_RE.match(value)
+
+        if match is not None:
+            year, month, day, hour, minute, second, microsecond, tz = match.groups()
+            try:
+                return datetime(
+                    int(year), int(month), int(day), int(hour), int(minute), int(second or 0),
+                    int(microsecond.ljust(6, "0")) if microsecond else 0,
+                    _timezone(tz) if tz else None,
+                )
+            except ValueError as e:
+                raise ProtocolError(f"{loc}: invalid datetime ({e})") from e
+
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        if value > _MS_WATERSHED:
+            value /= 1000
+        return _EPOCH + timedelta(seconds=value)
+
+    raise ProtocolError(f"{loc}: invalid datetime format")
+
+
+def _field(obj: Dict[str, Any], name: str, loc: str, required: bool = True) -> Any:
+    value = obj.get(name)
+
+    if value is None and required:
+        raise ProtocolError(f"{loc}.{name}: field required")
+    return value
+
+
+def _check_type(value: Any, value_type: type, loc: str) -> Any:
+    # bool is int subclass, but is not a number for the schema
+    if not isinstance(value, value_type) or (value_type is int and isinstance(value, bool)):
+        raise ProtocolError(f"{loc}: {value_type.__name__} expected")
+    return value
+
+
+def _object(value: Any, loc: str) -> Dict[str, Any]:
+    return _check_type(value, dict, loc)
+
+
+def _list(value: Any, loc: str) -> list:
+    return _check_type(value, list, loc)
+
+
+def _file_record(value: Any, loc: str) -> FileRecord:
+    obj = _object(value, loc)
+
+    content_hash = _field(obj, "content_hash", loc, required=False)
+    if content_hash is not None:
+        _check_type(content_hash, str, f"{loc}.content_hash")
+
+    return FileRecord(
+        _check_type(_field(obj, "path", loc), str, f"{loc}.path"),
+        _parse_datetime(_field(obj, "date_created", loc), f"{loc}.date_created"),
+        _parse_datetime(_field(obj, "date_updated", loc), f"{loc}.date_updated"),
+        _check_type(_field(obj, "size", loc), int, f"{loc}.size"),
+        content_hash,
+    )
+
+
+def _diff_record(value: Any, loc: str) -> DiffRecord:
+    obj = _object(value, loc)
+
+    updated = []
+    for index, file_diff in enumerate(_list(_field(obj, "updated", loc), f"{loc}.updated")):
+        file_diff_loc = f"{loc}.updated.{index}"
+        file_diff = _object(file_diff, file_diff_loc)
+
+        updated.append(FileDiffRecord(
+            _file_record(_field(file_diff, "before", file_diff_loc), f"{file_diff_loc}.before"),
+            _file_record(_field(file_diff, "after", file_diff_loc), f"{file_diff_loc}.after"),
+        ))
+
+    return DiffRecord(
+        run_start=_parse_datetime(_field(obj, "run_start", loc), f"{loc}.run_start"),
+        run_end=_parse_datetime(_field(obj, "run_end", loc), f"{loc}.run_end"),
+        created=[_file_record(file_state, f"{loc}.created.{index}")
+                 for index, file_state in enumerate(_list(_field(obj, "created", loc), f"{loc}.created"))],
+        deleted=[_file_record(file_state, f"{loc}.deleted.{index}")
+                 for index, file_state in enumerate(_list(_field(obj, "deleted", loc), f"{loc}.deleted"))],
+        updated=updated,
+    )
+
+
+def decode_json_message(data: Union[str, bytes], source_name: str) -> IngestRecord:
+    """
+    Decodes and validates JSON message: DiffChunk, DiffReport or bare FullDiff of older agents
+     (source_name of connection is used for it). Unknown fields are ignored.
+    Raises ProtocolError, with seq set if message is not valid, but carries valid sequence number.
+    """
+    try:
+        obj = json.loads(data)
+    except ValueError as e:
+        raise ProtocolError(f"Malformed JSON: {e}") from e
+
+    obj = _object(obj, "message")
+
+    seq = obj.get("seq")
+    if not isinstance(seq, int) or isinstance(seq, bool):
+        seq = None
+
+    try:
+        if "scan_id" in obj:
+            chunk_index = _check_type(_field(obj, "chunk_index", "message"), int, "message.chunk_index")
+            last = _check_type(_field(obj, "last", "message"), bool, "message.last")
+
+            return ChunkRecord(
+                source_name=_check_type(_field(obj, "source_name", "message"), str, "message.source_name"),
+                scan_id=_check_type(_field(obj, "scan_id", "message"), str, "message.scan_id"),
+                chunk_index=chunk_index,
+                last=last,
+                diff=_diff_record(_field(obj, "diff", "message"), "message.diff"),
+                seq=seq,
+            )
+
+        if "diff" in obj:
+            return ReportRecord(
+                source_name=_check_type(_field(obj, "source_name", "message"), str, "message.source_name"),
+                diff=_diff_record(obj["diff"], "message.diff"),
+            )
+
+        return ReportRecord(source_name=source_name, diff=_diff_record(obj, "message"))
+
+    except ProtocolError as e:
+        e.seq = seq
+        raise
@@ -0,0 +1,81 @@
+"""
+Lightweight records of diff messages for collector ingest path.
+
+Records are built by binary protocol decoder and by hand-rolled validator of JSON messages
+ (see fspy.common.protocol), so per-message pydantic validation is not paid for. Field names are the same
+ as of fspy.common.model classes, so code which only reads diffs accepts both.
+Pydantic models are kept for API boundary (agent side, responses, reports).
+"""
+from typing import NamedTuple, Optional, List, Union
+
+from datetime import datetime
+
+from fspy.common import model
+
+
+class FileRecord(NamedTuple):
+    path: str
+    date_created: datetime
+    date_updated: datetime
+    size: int
+    content_hash: Optional[str] = None
+
+
+class FileDiffRecord(NamedTuple):
+    before: FileRecord
+    after: FileRecord
+
+
+class DiffRecord(NamedTuple):
+    run_start: datetime
+    run_end: datetime
+    created: List[FileRecord]
+    deleted: List[FileRecord]
+    updated: List[FileDiffRecord]
+
+    def __bool__(self):
+        return bool(self.created) or bool(self.deleted) or bool(self.updated)
+
+
+class ChunkRecord(NamedTuple):
+    source_name: str
+    scan_id: str
+    chunk_index: int
+    last: bool
+    diff: DiffRecord
+    seq: Optional[int] = None
+
+
+class ReportRecord(NamedTuple):
+    """Whole diff of one scan, sent by agents without chunked uploads"""
+    source_name: str
+    diff: DiffRecord
+
+
+def _file_state(record: FileRecord) -> model.FileState:
+    return model.FileState.construct(**record._asdict())
+
+
+def diff_to_model(record: DiffRecord) -> model.FullDiff:
+    return model.FullDiff.construct(
+        run_start=record.run_start,
+        run_end=record.run_end,
+        created=[_file_state(file_record) for file_record in record.created],
+        deleted=[_file_state(file_record) for file_record in record.deleted],
+        updated=[model.FileDiff.construct(before=_file_state(file_diff.before), after=_file_state(file_diff.after))
+                 for file_diff in record.updated],
+    )
+
+
+def chunk_to_model(record: ChunkRecord) -> model.DiffChunk:
+    return model.DiffChunk.construct(
+        source_name=record.source_name,
+        scan_id=record.scan_id,
+        chunk_index=record.chunk_index,
+        last=record.last,
+        seq=record.seq,
+        diff=diff_to_model(record.diff),
+    )
+
+
+IngestRecord = Union[ChunkRecord, ReportRecord]
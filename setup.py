@@ -41,7 +41,7 @@ setuptools.setup(
         "SQLAlchemy==1.2.11",
     ],
 
-    packages=setuptools.find_packages(exclude=("tests",)),
+    packages=setuptools.find_packages(exclude=("tests", "benchmarks")),
 
     classifiers=['Private :: Do Not Upload'],
 
@@ -0,0 +1,50 @@
+import unittest
+
+from fspy.collector.admission import AdmissionControl
+
+
+class AdmissionControlTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+
+    def admission(self, rate: float, burst: int) -> AdmissionControl:
+        return AdmissionControl(rate, burst, clock=lambda: self.now)
+
+    def test_burst_and_rate(self):
+        admission = self.admission(rate=2, burst=3)
+
+        self.assertEqual([None, None, None], [admission.admit() for _ in range(3)])
+        self.assertIsNotNone(admission.admit())
+
+        self.now = 0.5
+        self.assertIsNone(admission.admit())
+        self.assertIsNotNone(admission.admit())
+
+    def test_herd_is_spread(self):
+        admission = self.admission(rate=10, burst=1)
+        admission.admit()
+
+        hints = [admission.admit() for _ in range(100)]
+
+        # Each rejected agent is told to wait longer than the ones before could be admitted
+        for waiting, hint in enumerate(hints):
+            self.assertGreaterEqual(hint, (waiting + 1) / 10)
+        self.assertLess(max(hints), 2 * 101 / 10)
+
+    def test_waiting_agents_expire(self):
+        admission = self.admission(rate=1, burst=1)
+        admission.admit()
+
+        first_hint = admission.admit()
+
+        # Agent which came back is not counted as waiting any more
+        self.now = 1000
+        admission.admit()
+        self.assertLessEqual(admission.admit(), 2)
+
+        self.assertLessEqual(first_hint, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
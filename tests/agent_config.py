@@ -0,0 +1,69 @@
+import unittest
+import json
+import tempfile
+from os import path
+
+import pydantic
+
+from fspy.agent.config import load_agent_config, parse_target_arg, check_source_names, TargetConfig, \
+    POLL_BACKEND, INOTIFY_BACKEND
+
+
+class AgentConfigTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory(prefix="fspy-tests")
+        self.config_path = path.join(self.temp_directory.name, "agent.json")
+
+    def tearDown(self):
+        self.temp_directory.cleanup()
+
+    def write_config(self, raw_config):
+        with open(self.config_path, "w") as config_file:
+            json.dump(raw_config, config_file)
+
+    def test_defaults(self):
+        self.write_config({"targets": [
+            {"path": "/var/log", "source_name": "logs", "scan_interval": 5},
+            {"path": "/srv/data", "backend": INOTIFY_BACKEND},
+        ]})
+
+        targets = load_agent_config(self.config_path, {"source_name": "host", "scan_interval": 1}).targets
+
+        self.assertEqual(["logs", "host"], [t.source_name for t in targets])
+        self.assertEqual([5, 1], [t.scan_interval for t in targets])
+        self.assertEqual([POLL_BACKEND, INOTIFY_BACKEND], [t.backend for t in targets])
+
+    def test_invalid(self):
+        self.write_config({"targets": [{"path": "/var/log", "source_name": "logs", "backend": "magic"}]})
+        self.assertRaises(pydantic.ValidationError, load_agent_config, self.config_path)
+
+        self.write_config({"targets": [{"path": "/var/log", "source_name": "logs", "unknown_option": 1}]})
+        self.assertRaises(pydantic.ValidationError, load_agent_config, self.config_path)
+
+        self.write_config({"targets": [
+            {"path": "/var/log", "source_name": "logs", "min_scan_interval": 10, "max_scan_interval": 5}
+        ]})
+        self.assertRaises(pydantic.ValidationError, load_agent_config, self.config_path)
+
+        self.write_config({"targets": [{"path": "/var/log", "source_name": "logs", "scan_budget": 2}]})
+        self.assertRaises(pydantic.ValidationError, load_agent_config, self.config_path)
+
+
+    def test_target_arg(self):
+        self.assertEqual(("/var/log", None), parse_target_arg("/var/log"))
+        self.assertEqual(("/var/log", "logs"), parse_target_arg("/var/log=logs"))
+        self.assertEqual(("/srv/a=b", "data"), parse_target_arg("/srv/a=b=data"))
+
+        self.assertRaises(ValueError, parse_target_arg, "/var/log=")
+        self.assertRaises(ValueError, parse_target_arg, "=logs")
+
+    def test_source_names(self):
+        check_source_names([TargetConfig(path="/var/log", source_name="logs"),
+                            TargetConfig(path="/srv/data", source_name="data")])
+
+        self.assertRaises(ValueError, check_source_names, [TargetConfig(path="/var/log", source_name="host"),
+                                                           TargetConfig(path="/srv/data", source_name="host")])
+
+
+if __name__ == '__main__':
+    unittest.main()
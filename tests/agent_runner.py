@@ -0,0 +1,69 @@
+import unittest
+
+import os
+import time
+import asyncio
+import tempfile
+from os.path import join
+
+from tests.util import with_file_structure
+
+from fspy.agent.config import TargetConfig
+from fspy.agent.runner import ScanTarget, Agent, create_comparator
+
+
+class ScanTargetTests(unittest.TestCase):
+    @with_file_structure({"a.txt": 10})
+    def test_diff_chunks(self, wd):
+        target_config = TargetConfig(path=wd, source_name="test")
+        target = ScanTarget(target_config, create_comparator(target_config))
+
+        chunks = []
+
+        self.assertIsNone(target.scan(chunks.append, max_chunk_entries=2))
+
+        summary = target.scan(chunks.append, max_chunk_entries=2)
+        self.assertEqual(0, summary.changes_count)
+        self.assertEqual([], chunks)
+
+        for i in range(5):
+            with open(join(wd, f"{i}.txt"), "wb") as fd:
+                fd.write(b"\0")
+        os.remove(join(wd, "a.txt"))
+
+        summary = target.scan(chunks.append, max_chunk_entries=2)
+
+        self.assertEqual((5, 1, 0, 3), summary)
+        self.assertEqual(1, len({chunk.scan_id for chunk in chunks}))
+        self.assertEqual([0, 1, 2], [chunk.chunk_index for chunk in chunks])
+        self.assertEqual([False, False, True], [chunk.last for chunk in chunks])
+        self.assertEqual({"test"}, {chunk.source_name for chunk in chunks})
+
+
+class AgentTests(unittest.TestCase):
+    def test_close_waits_for_scan(self):
+        loop = asyncio.new_event_loop()
+        events = []
+
+        def slow_scan(*_):
+            time.sleep(0.2)
+            events.append("scan finished")
+
+        with tempfile.TemporaryDirectory(prefix="fspy-tests") as wd:
+            agent = Agent("ws://127.0.0.1:1/ws", [TargetConfig(path=wd, source_name="test")], loop=loop)
+
+            target, = agent._targets
+            target.scan = slow_scan
+            target.close = lambda: events.append("target closed")
+
+            scan_future = agent._scan_executor.submit(target.scan)
+            loop.run_until_complete(agent.close())
+
+            self.assertTrue(scan_future.done())
+            self.assertEqual(["scan finished", "target closed"], events)
+
+        loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,20 @@
 import unittest
 import tempfile
+import sqlite3
 from os import path, environ
 
 from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
 
 from fspy.collector.logging_config import init_logging
 from fspy.collector.app import create_application
-from datetime import datetime
+from fspy.collector.decoding import DECODE_POOL_THREAD
+from fspy.collector.sharding import shard_index, shard_paths
+from datetime import datetime, timedelta
 import pytz
 
-from fspy.common.model import DiffReport, FullDiff, DiffReportHandlingResponse, FileState
+from fspy.common.protocol import SUPPORTED_PROTOCOLS, BINARY_PROTOCOL_V1, BINARY_PROTOCOL_V3, BINARY_PROTOCOL_V4, \
+    encode_diff_chunk
+from fspy.common.model import DiffReport, DiffChunk, FullDiff, DiffReportHandlingResponse, FileState, FileDiff
 
 
 class CollectorBaseTests(AioHTTPTestCase):
@@ -67,6 +72,438 @@ class CollectorBaseTests(AioHTTPTestCase):
 
                 self.assertTrue(resp.handled, f"Diff report was not handled. Message: {resp.message}")
 
+    @unittest_run_loop
+    async def test_many_sources_over_one_connection(self):
+        now = datetime.now(pytz.utc)
+
+        async with self.client.ws_connect(f"/ws?source_name=agent") as ws:
+            for source_name in ("logs", "data"):
+                report = DiffReport(
+                    source_name=source_name,
+                    diff=FullDiff(
+                        run_start=now,
+                        run_end=now,
+                        deleted=[],
+                        created=[FileState(path=f"/{source_name}/1.log", date_created=now, date_updated=now, size=1)],
+                        updated=[],
+                    )
+                )
+
+                await ws.send_str(report.json())
+                resp = DiffReportHandlingResponse(**await ws.receive_json())
+
+                self.assertTrue(resp.handled, f"Diff report was not handled. Message: {resp.message}")
+
+        resp = await self.client.get("/flat_report", params={
+            "date_start": (now - timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "date_end": (now + timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "source": "data",
+        })
+        self.assertEqual(200, resp.status)
+
+        entries = (await resp.json())["entries"]
+        self.assertEqual(["/data/1.log"], [e["file_path"] for e in entries])
+
+    @unittest_run_loop
+    async def test_content_hashes(self):
+        now = datetime.now(pytz.utc)
+
+        def file_state(content_hash):
+            return FileState(path="/data/1.log", date_created=now, date_updated=now, size=1, content_hash=content_hash)
+
+        async with self.client.ws_connect(f"/ws?source_name=data") as ws:
+            await ws.send_str(FullDiff(
+                run_start=now,
+                run_end=now,
+                deleted=[],
+                created=[],
+                updated=[FileDiff(before=file_state("aa"), after=file_state("aa"))],
+            ).json())
+
+            resp = DiffReportHandlingResponse(**await ws.receive_json())
+            self.assertTrue(resp.handled, f"Diff report was not handled. Message: {resp.message}")
+
+        resp = await self.client.get("/flat_report", params={
+            "date_start": (now - timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "date_end": (now + timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        })
+        self.assertEqual(200, resp.status)
+
+        entries = (await resp.json())["entries"]
+        self.assertEqual([("aa", "aa")], [(e["hash_before"], e["hash_after"]) for e in entries])
+
+
+    @unittest_run_loop
+    async def test_diff_chunks(self):
+        now = datetime.now(pytz.utc)
+        report_params = {
+            "date_start": (now - timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "date_end": (now + timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+
+        async def report_paths(**params):
+            resp = await self.client.get("/flat_report", params={**report_params, **params})
+            self.assertEqual(200, resp.status)
+            return sorted(e["file_path"] for e in (await resp.json())["entries"])
+
+        async with self.client.ws_connect(f"/ws?source_name=agent") as ws:
+            for chunk_index in range(3):
+                chunk = DiffChunk(
+                    source_name="data",
+                    scan_id="scan-1",
+                    chunk_index=chunk_index,
+                    last=chunk_index == 2,
+                    diff=FullDiff(
+                        run_start=now,
+                        run_end=now,
+                        deleted=[],
+                        created=[
+                            FileState(path=f"/data/{chunk_index}.log", date_created=now, date_updated=now, size=1)
+                        ],
+                        updated=[],
+                    )
+                )
+
+                await ws.send_str(chunk.json())
+                resp = DiffReportHandlingResponse(**await ws.receive_json())
+                self.assertTrue(resp.handled, f"Diff chunk was not handled. Message: {resp.message}")
+
+                if not chunk.last:
+                    # Scan is not reported until its last chunk arrives
+                    self.assertEqual([], await report_paths())
+                    self.assertEqual(chunk_index + 1, len(await report_paths(include_incomplete="true")))
+
+        self.assertEqual(["/data/0.log", "/data/1.log", "/data/2.log"], await report_paths())
+
+    @unittest_run_loop
+    async def test_binary_protocol(self):
+        now = datetime.now(pytz.utc)
+        chunk = DiffChunk(
+            source_name="data",
+            scan_id="scan-1",
+            chunk_index=0,
+            last=True,
+            diff=FullDiff(
+                run_start=now,
+                run_end=now,
+                deleted=[],
+                created=[FileState(path="/data/a.log", date_created=now, date_updated=now, size=1)],
+                updated=[],
+            )
+        )
+
+        async with self.client.ws_connect(f"/ws?source_name=agent", protocols=(BINARY_PROTOCOL_V3,)) as ws:
+            self.assertEqual(BINARY_PROTOCOL_V3, ws.protocol)
+
+            await ws.send_bytes(b"\x01 malformed")
+            resp = DiffReportHandlingResponse(**await ws.receive_json())
+            self.assertFalse(resp.handled)
+
+            await ws.send_bytes(encode_diff_chunk(chunk, BINARY_PROTOCOL_V3, compress_threshold=0))
+            resp = DiffReportHandlingResponse(**await ws.receive_json())
+            self.assertTrue(resp.handled, f"Diff chunk was not handled. Message: {resp.message}")
+
+        # Agent which does not know newer protocol versions
+        async with self.client.ws_connect(f"/ws?source_name=agent", protocols=(BINARY_PROTOCOL_V1,)) as ws:
+            self.assertEqual(BINARY_PROTOCOL_V1, ws.protocol)
+
+            await ws.send_bytes(encode_diff_chunk(chunk.copy(update={"scan_id": "scan-2"}), BINARY_PROTOCOL_V1))
+            resp = DiffReportHandlingResponse(**await ws.receive_json())
+            self.assertTrue(resp.handled, f"Diff chunk was not handled. Message: {resp.message}")
+
+        # JSON over permessage-deflate
+        async with self.client.ws_connect(f"/ws?source_name=agent", compress=15) as ws:
+            self.assertEqual(15, ws.compress)
+
+            await ws.send_str(chunk.copy(update={"scan_id": "scan-3"}).json())
+            resp = DiffReportHandlingResponse(**await ws.receive_json())
+            self.assertTrue(resp.handled, f"Diff chunk was not handled. Message: {resp.message}")
+
+        resp = await self.client.get("/flat_report", params={
+            "date_start": (now - timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "date_end": (now + timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        })
+        self.assertEqual(200, resp.status)
+        self.assertEqual(["/data/a.log"] * 3, [e["file_path"] for e in (await resp.json())["entries"]])
+
+    @unittest_run_loop
+    async def test_pipelined_chunks(self):
+        now = datetime.now(pytz.utc)
+
+        def chunk(chunk_index: int, seq: int) -> DiffChunk:
+            return DiffChunk(
+                source_name="data",
+                scan_id="scan-1",
+                chunk_index=chunk_index,
+                last=chunk_index == 4,
+                seq=seq,
+                diff=FullDiff(
+                    run_start=now,
+                    run_end=now,
+                    deleted=[],
+                    created=[FileState(path=f"/data/{chunk_index}.log", date_created=now, date_updated=now, size=1)],
+                    updated=[],
+                )
+            )
+
+        async with self.client.ws_connect(f"/ws?source_name=agent", protocols=SUPPORTED_PROTOCOLS) as ws:
+            self.assertEqual(BINARY_PROTOCOL_V4, ws.protocol)
+
+            # All chunks are sent before first response, chunk 2 is retransmitted and one message is malformed
+            messages = [encode_diff_chunk(chunk(i, seq=i)) for i in range(5)]
+            messages.append(encode_diff_chunk(chunk(2, seq=5)))
+            messages.append(encode_diff_chunk(chunk(3, seq=6))[:-1])
+
+            for message in messages:
+                await ws.send_bytes(message)
+
+            responses = {}
+            for _ in messages:
+                resp = DiffReportHandlingResponse(**await ws.receive_json())
+                responses[resp.seq] = resp.handled
+
+        self.assertEqual({0: True, 1: True, 2: True, 3: True, 4: True, 5: True, 6: False}, responses)
+
+        resp = await self.client.get("/flat_report", params={
+            "date_start": (now - timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "date_end": (now + timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        })
+        self.assertEqual(200, resp.status)
+        self.assertEqual(
+            [f"/data/{i}.log" for i in range(5)],
+            sorted(e["file_path"] for e in (await resp.json())["entries"])
+        )
+
+
+class CollectorAdmissionTests(AioHTTPTestCase):
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory(prefix="fspy-tests")
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.temp_directory.cleanup()
+
+    async def get_application(self):
+        db_path = path.join(self.temp_directory.name, "fspy-tests.sqlite")
+        return create_application(db_path, admission_rate=0.01, admission_burst=1)
+
+    @unittest_run_loop
+    async def test_admission(self):
+        async with self.client.ws_connect(f"/ws?source_name=agent") as ws:
+            async with self.client.ws_connect(f"/ws?source_name=agent") as rejected_ws:
+                resp = DiffReportHandlingResponse(**await rejected_ws.receive_json())
+
+                self.assertFalse(resp.handled)
+                self.assertGreaterEqual(resp.retry_after, 100)
+
+                await rejected_ws.receive()
+                self.assertTrue(rejected_ws.closed)
+
+            self.assertFalse(ws.closed)
+
+
+class CollectorDecodeOffloadTests(AioHTTPTestCase):
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory(prefix="fspy-tests")
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.temp_directory.cleanup()
+
+    async def get_application(self):
+        db_path = path.join(self.temp_directory.name, "fspy-tests.sqlite")
+        return create_application(db_path, decode_offload_threshold=0, decode_pool=DECODE_POOL_THREAD)
+
+    @unittest_run_loop
+    async def test_offloaded_decode(self):
+        now = datetime.now(pytz.utc)
+
+        chunk = DiffChunk(
+            source_name="data",
+            scan_id="scan-1",
+            chunk_index=0,
+            last=True,
+            seq=0,
+            diff=FullDiff(
+                run_start=now,
+                run_end=now,
+                deleted=[],
+                created=[FileState(path=f"/data/0.log", date_created=now, date_updated=now, size=1)],
+                updated=[],
+            )
+        )
+
+        async with self.client.ws_connect(f"/ws?source_name=agent", protocols=SUPPORTED_PROTOCOLS) as ws:
+            await ws.send_bytes(encode_diff_chunk(chunk))
+            self.assertTrue(DiffReportHandlingResponse(**await ws.receive_json()).handled)
+
+            # Error raised in worker is answered as usual
+            await ws.send_bytes(encode_diff_chunk(chunk.copy(update=dict(seq=1)))[:-1])
+            resp = DiffReportHandlingResponse(**await ws.receive_json())
+            self.assertFalse(resp.handled)
+            self.assertEqual(1, resp.seq)
+
+        resp = await self.client.get("/metrics")
+        self.assertEqual(200, resp.status)
+
+        metrics = await resp.json()
+        self.assertEqual({"inline": 0, "offloaded": 2, "offloaded_pending": 0}, metrics["decode"])
+        self.assertEqual({"last", "mean", "max"}, set(metrics["event_loop_lag"]))
+
+    @unittest_run_loop
+    async def test_large_message(self):
+        now = datetime.now(pytz.utc)
+
+        # Larger than default max message size of aiohttp (4 MB)
+        files_count = 100
+        chunk = DiffChunk(
+            source_name="data",
+            scan_id="scan-1",
+            chunk_index=0,
+            last=True,
+            seq=0,
+            diff=FullDiff(
+                run_start=now,
+                run_end=now,
+                deleted=[],
+                created=[FileState(path=f"/data/{i}/" + "x" * 60000, date_created=now, date_updated=now, size=1)
+                         for i in range(files_count)],
+                updated=[],
+            )
+        )
+
+        async with self.client.ws_connect(f"/ws?source_name=agent", protocols=SUPPORTED_PROTOCOLS) as ws:
+            message = encode_diff_chunk(chunk)
+            self.assertGreater(len(message), 4 * 1024 * 1024)
+
+            await ws.send_bytes(message)
+            resp = DiffReportHandlingResponse(**await ws.receive_json())
+            self.assertTrue(resp.handled, f"Large message was not handled. Message: {resp.message}")
+
+            # Decompressed size is checked against the same limit
+            await ws.send_bytes(encode_diff_chunk(chunk.copy(update=dict(scan_id="scan-2", seq=1)),
+                                                  compress_threshold=0))
+            resp = DiffReportHandlingResponse(**await ws.receive_json())
+            self.assertTrue(resp.handled, f"Large compressed message was not handled. Message: {resp.message}")
+
+
+class CollectorShardingTests(AioHTTPTestCase):
+    shards = 3
+
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory(prefix="fspy-tests")
+        self.db_path = path.join(self.temp_directory.name, "fspy-tests.sqlite")
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.temp_directory.cleanup()
+
+    async def get_application(self):
+        return create_application(self.db_path, shards=self.shards)
+
+    @unittest_run_loop
+    async def test_sharded_report(self):
+        now = datetime.now(pytz.utc).replace(microsecond=0)
+        sources = [f"agent-{i}" for i in range(6)]
+        self.assertGreater(len({shard_index(source_name, self.shards) for source_name in sources}), 1)
+
+        async with self.client.ws_connect(f"/ws?source_name=agent") as ws:
+            for source_index, source_name in enumerate(sources):
+                # Changes of all sources interleave in time
+                created = [
+                    FileState(path=f"/{source_name}/{i}.log", date_updated=now, size=1,
+                              date_created=now + timedelta(seconds=i * 10 + source_index))
+                    for i in range(3)
+                ]
+                report = DiffReport(source_name=source_name,
+                                    diff=FullDiff(run_start=now, run_end=now, deleted=[], created=created, updated=[]))
+
+                await ws.send_str(report.json())
+                self.assertTrue(DiffReportHandlingResponse(**await ws.receive_json()).handled)
+
+        resp = await self.client.get("/flat_report", params={
+            "date_start": (now - timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "date_end": (now + timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        })
+        self.assertEqual(200, resp.status)
+
+        entries = (await resp.json())["entries"]
+        self.assertEqual([f"/{source_name}/{i}.log" for i in range(3) for source_name in sources],
+                         [e["file_path"] for e in entries])
+
+        self.assertEqual(shard_paths(self.db_path, self.shards), [p for p in shard_paths(self.db_path, self.shards)
+                                                                  if path.exists(p)])
+
+
+class CollectorBackpressureTests(AioHTTPTestCase):
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory(prefix="fspy-tests")
+        self.db_path = path.join(self.temp_directory.name, "fspy-tests.sqlite")
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.temp_directory.cleanup()
+
+    async def get_application(self):
+        return create_application(self.db_path, write_queue_size=1, write_batch_size=1)
+
+    @unittest_run_loop
+    async def test_busy_when_write_queue_is_full(self):
+        now = datetime.now(pytz.utc)
+        messages_count = 5
+
+        def chunk(seq: int) -> DiffChunk:
+            return DiffChunk(
+                source_name="data",
+                scan_id=f"scan-{seq}",
+                chunk_index=0,
+                last=True,
+                seq=seq,
+                diff=FullDiff(
+                    run_start=now,
+                    run_end=now,
+                    deleted=[],
+                    created=[FileState(path=f"/data/{seq}.log", date_created=now, date_updated=now, size=1)],
+                    updated=[],
+                )
+            )
+
+        # Writing thread is stuck on locked DB: it holds at most one report and one more waits in queue
+        lock_connection = sqlite3.connect(self.db_path, isolation_level=None)
+        lock_connection.execute("BEGIN IMMEDIATE")
+
+        try:
+            async with self.client.ws_connect(f"/ws?source_name=agent", protocols=SUPPORTED_PROTOCOLS) as ws:
+                for seq in range(messages_count):
+                    await ws.send_bytes(encode_diff_chunk(chunk(seq)))
+
+                responses = []
+                while len(responses) < messages_count - 2:
+                    responses.append(DiffReportHandlingResponse(**await ws.receive_json()))
+
+                lock_connection.execute("ROLLBACK")
+
+                while len(responses) < messages_count:
+                    responses.append(DiffReportHandlingResponse(**await ws.receive_json()))
+        finally:
+            lock_connection.close()
+
+        self.assertEqual(set(range(messages_count)), {resp.seq for resp in responses})
+
+        busy = [resp for resp in responses if not resp.handled]
+        self.assertGreaterEqual(len(busy), messages_count - 2)
+        self.assertLess(len(busy), messages_count)
+        self.assertEqual({("Collector is busy", 1.0)}, {(resp.message, resp.retry_after) for resp in busy})
+
+        resp = await self.client.get("/metrics")
+        write_queue, = (await resp.json())["write_queues"]
+
+        self.assertEqual({"depth": 0, "max_size": 1, "high_watermark": 1, "rejected": len(busy)}, write_queue)
+
 
 if __name__ == '__main__':
     unittest.main()
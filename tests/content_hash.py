@@ -0,0 +1,184 @@
+import unittest
+from unittest import mock
+
+import os
+import time
+import threading
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+
+from tests.util import with_file_structure
+
+from fspy.agent import hashing
+from fspy.agent.hashing import ContentHasher, HashCache, RateLimiter, hash_file, hash_cache_file_name
+from fspy.agent.scanner import SimpleComparator
+
+
+def _key(file_path):
+    stat_info = os.stat(file_path)
+    return stat_info.st_ino, stat_info.st_size, stat_info.st_mtime_ns
+
+
+class ContentHashTests(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    @with_file_structure({"a.txt": 10})
+    def test_hash_file(self, wd):
+        file_path = join(wd, "a.txt")
+
+        self.assertEqual(hashlib.sha1(b"\0" * 10).hexdigest(), hash_file(file_path, _key(file_path)))
+        self.assertEqual(
+            hash_file(file_path, _key(file_path)),
+            hash_file(file_path, _key(file_path), limiter=RateLimiter(10 ** 6), chunk_size=3)
+        )
+
+        # File changed after stat is not hashed
+        self.assertIsNone(hash_file(file_path, (0, 0, 0)))
+        self.assertIsNone(hash_file(join(wd, "b.txt"), (0, 0, 0)))
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(1000)
+
+        started = time.monotonic()
+        for _ in range(3):
+            limiter.consume(100)
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_cache_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = join(tmp_dir, "hashes.bin")
+
+            cache = HashCache()
+            cache.put("/a", (1, 2, 3), "00ff")
+            cache.save(cache_path)
+
+            loaded = HashCache.load(cache_path)
+            self.assertEqual("00ff", loaded.get("/a", (1, 2, 3)))
+            self.assertIsNone(loaded.get("/a", (1, 2, 4)))
+            self.assertEqual("00ff", loaded.last("/a"))
+
+            with open(cache_path, "r+b") as cache_file:
+                cache_file.seek(-1, os.SEEK_END)
+                cache_file.write(b"\1")
+
+            self.assertEqual(0, len(HashCache.load(cache_path)))
+
+    def test_cache_file_name(self):
+        self.assertEqual(hash_cache_file_name("/data"), hash_cache_file_name("/data", ""))
+        self.assertNotEqual(hash_cache_file_name("/data"), hash_cache_file_name("/data", "include=*.log"))
+        self.assertNotEqual(hash_cache_file_name("/data", "include=*.log"),
+                            hash_cache_file_name("/data", "include=*.txt"))
+
+    @with_file_structure({"a.txt": 10, "b.txt": 20})
+    def test_touch_and_rewrite(self, wd):
+        with tempfile.TemporaryDirectory() as state_dir:
+            cache_path = join(state_dir, "hashes.bin")
+            hasher = ContentHasher(self.executor, cache_path=cache_path)
+            c = SimpleComparator(wd, content_hasher=hasher)
+            c.scan()
+            hasher.wait_baseline()
+
+            file_path = join(wd, "a.txt")
+            old_hash = hash_file(file_path, _key(file_path))
+
+            # Resolution for mtime/ctime is 1 second for some platforms
+            time.sleep(1)
+            os.utime(file_path)
+
+            with mock.patch.object(hashing, "hash_file", wraps=hashing.hash_file) as hash_file_mock:
+                f_diff = c.scan()
+
+                # Only changed file is hashed again
+                self.assertEqual([file_path], [call[0][0] for call in hash_file_mock.call_args_list])
+
+            self.assertEqual([(old_hash, old_hash)], [(d.before.content_hash, d.after.content_hash)
+                                                      for d in f_diff.updated])
+
+            with open(file_path, "wb") as fd:
+                fd.write(b"a" * 10)
+
+            f_diff = c.scan()
+            self.assertNotEqual(f_diff.updated[0].before.content_hash, f_diff.updated[0].after.content_hash)
+
+            # Hashes survive restart
+            hasher = ContentHasher(self.executor, cache_path=cache_path)
+            c = SimpleComparator(wd, content_hasher=hasher)
+
+            with mock.patch.object(hashing, "hash_file", wraps=hashing.hash_file) as hash_file_mock:
+                c.scan()
+                hasher.wait_baseline()
+                self.assertFalse(hash_file_mock.called)
+
+            os.remove(join(wd, "b.txt"))
+            self.assertIsNotNone(c.scan().deleted[0].content_hash)
+
+
+    @with_file_structure({"a.txt": 10, "b.txt": 20, "c.txt": 30})
+    def test_background_baseline(self, wd):
+        hash_started = threading.Event()
+        release_hash = threading.Event()
+        hashing_threads = set()
+
+        def blocked_hash_file(*args, **kwargs):
+            hashing_threads.add(threading.current_thread().name)
+            hash_started.set()
+            release_hash.wait(5)
+            return hash_file(*args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            hasher = ContentHasher(self.executor, cache_path=join(state_dir, "hashes.bin"))
+            c = SimpleComparator(wd, content_hasher=hasher)
+
+            with mock.patch.object(hashing, "hash_file", side_effect=blocked_hash_file) as hash_file_mock, \
+                    mock.patch.object(hashing, "BASELINE_BATCH_SIZE", 2), \
+                    mock.patch.object(HashCache, "save", autospec=True) as save_mock:
+                # Scan is not held by hashing of baseline and does not save cache meanwhile
+                c.scan()
+                self.assertTrue(hash_started.wait(5))
+                self.assertFalse(c.scan())
+                self.assertFalse(save_mock.called)
+
+                release_hash.set()
+                hasher.wait_baseline()
+                self.assertEqual(3, hash_file_mock.call_count)
+                self.assertEqual(1, save_mock.call_count)
+
+                # Baseline is hashed by shared executor
+                self.assertTrue(all(name.startswith("ThreadPoolExecutor") for name in hashing_threads))
+
+                # Unchanged files are not hashed again, cache is not saved again
+                c.scan()
+                self.assertEqual(3, hash_file_mock.call_count)
+                self.assertEqual(1, save_mock.call_count)
+
+    @with_file_structure({"a.txt": 10, "b.txt": 20})
+    def test_close_interrupts_baseline(self, wd):
+        with tempfile.TemporaryDirectory() as state_dir:
+            cache_path = join(state_dir, "hashes.bin")
+            hasher = ContentHasher(self.executor, cache_path=cache_path)
+            c = SimpleComparator(wd, content_hasher=hasher)
+
+            def stopping_hash_file(*args, **kwargs):
+                # Baseline is interrupted after the first file
+                hasher._stopped.set()
+                return hash_file(*args, **kwargs)
+
+            with mock.patch.object(hashing, "hash_file", side_effect=stopping_hash_file) as hash_file_mock:
+                c.scan()
+                hasher.close()
+
+                self.assertEqual(1, hash_file_mock.call_count)
+
+            # Hashed file is saved
+            self.assertEqual(1, len(HashCache.load(cache_path)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+
+from datetime import datetime, timedelta
+
+import pytz
+
+from fspy.agent.coalesce import merge_diffs, coalesce_chunks
+from fspy.common.model import FileState, FileDiff, FullDiff, DiffChunk
+
+T0 = datetime(2018, 9, 1, tzinfo=pytz.utc)
+
+
+def _state(file_path: str, size: int) -> FileState:
+    return FileState(path=file_path, date_created=T0, date_updated=T0 + timedelta(seconds=size), size=size)
+
+
+def _diff(minute: int, created=(), deleted=(), updated=()) -> FullDiff:
+    return FullDiff(run_start=T0 + timedelta(minutes=minute), run_end=T0 + timedelta(minutes=minute, seconds=1),
+                    created=list(created), deleted=list(deleted), updated=list(updated))
+
+
+def _chunk(source_name: str, scan_id: str, chunk_index: int, last: bool, diff: FullDiff) -> DiffChunk:
+    return DiffChunk(source_name=source_name, scan_id=scan_id, chunk_index=chunk_index, last=last, diff=diff)
+
+
+class MergeDiffsTests(unittest.TestCase):
+
+    def test_create_delete_cancel(self):
+        merged = merge_diffs([
+            _diff(0, created=[_state("/a", 1), _state("/b", 1)]),
+            _diff(1, deleted=[_state("/a", 1)]),
+        ])
+
+        self.assertEqual(["/b"], [fs.path for fs in merged.created])
+        self.assertEqual([], merged.deleted)
+        self.assertEqual(T0, merged.run_start)
+        self.assertEqual(T0 + timedelta(minutes=1, seconds=1), merged.run_end)
+
+    def test_chained_updates(self):
+        merged = merge_diffs([
+            _diff(0, updated=[FileDiff(before=_state("/a", 1), after=_state("/a", 2))]),
+            _diff(1, updated=[FileDiff(before=_state("/a", 2), after=_state("/a", 3))]),
+            _diff(2, created=[_state("/b", 1)]),
+            _diff(3, updated=[FileDiff(before=_state("/b", 1), after=_state("/b", 2))]),
+        ])
+
+        self.assertEqual([FileDiff(before=_state("/a", 1), after=_state("/a", 3))], merged.updated)
+        self.assertEqual([_state("/b", 2)], merged.created)
+
+    def test_delete_create(self):
+        merged = merge_diffs([
+            _diff(0, updated=[FileDiff(before=_state("/a", 1), after=_state("/a", 2))]),
+            _diff(1, deleted=[_state("/a", 2)]),
+            _diff(2, created=[_state("/a", 5)]),
+        ])
+
+        self.assertEqual([], merged.created)
+        self.assertEqual([], merged.deleted)
+        self.assertEqual([FileDiff(before=_state("/a", 1), after=_state("/a", 5))], merged.updated)
+
+
+class CoalesceChunksTests(unittest.TestCase):
+
+    def test_coalesce(self):
+        chunks = [
+            # Rest of partially sent scan
+            _chunk("src1", "s0", 1, True, _diff(0, created=[_state("/x", 1)])),
+            _chunk("src1", "s1", 0, False, _diff(1, created=[_state("/a", 1)])),
+            _chunk("src2", "t1", 0, True, _diff(1, created=[_state("/c", 1)])),
+            _chunk("src1", "s1", 1, True, _diff(1, created=[_state("/b", 1)])),
+            _chunk("src1", "s2", 0, True, _diff(2, deleted=[_state("/a", 1)])),
+            _chunk("src1", "s3", 0, True, _diff(3, created=[_state("/d", 1), _state("/e", 1)])),
+            # Scan which is still running
+            _chunk("src1", "s4", 0, False, _diff(4, created=[_state("/f", 1)])),
+        ]
+
+        result = coalesce_chunks(chunks, max_chunk_entries=2)
+
+        # Merged scan takes place of the first one
+        merged_id = result[1].scan_id
+        self.assertEqual(["s0", merged_id, merged_id, "t1", "s4"], [chunk.scan_id for chunk in result])
+
+        merged = result[1:3]
+        self.assertEqual([0, 1], [chunk.chunk_index for chunk in merged])
+        self.assertEqual([False, True], [chunk.last for chunk in merged])
+        self.assertEqual(["/b", "/d", "/e"], [fs.path for chunk in merged for fs in chunk.diff.created])
+
+    def test_incomplete_scan_breaks_run(self):
+        chunks = [
+            _chunk("src1", "s1", 0, True, _diff(1, created=[_state("/a", 1)])),
+            _chunk("src1", "s2", 0, False, _diff(2, deleted=[_state("/a", 1)])),
+            _chunk("src1", "s3", 0, True, _diff(3, created=[_state("/a", 1)])),
+        ]
+
+        self.assertEqual(chunks, coalesce_chunks(chunks))
+
+    def test_cancelled_out(self):
+        chunks = [
+            _chunk("src1", "s1", 0, True, _diff(1, created=[_state("/a", 1)])),
+            _chunk("src1", "s2", 0, True, _diff(2, deleted=[_state("/a", 1)])),
+        ]
+
+        self.assertEqual([], coalesce_chunks(chunks))
+
+
+if __name__ == '__main__':
+    unittest.main()
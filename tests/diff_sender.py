@@ -0,0 +1,227 @@
+import unittest
+
+import json
+import asyncio
+import tempfile
+from collections import Counter
+from datetime import datetime
+
+import pytz
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+
+from fspy.agent.sender import DiffSender
+from fspy.agent.spool import DiffSpool
+from fspy.common import protocol
+from fspy.common.model import DiffChunk, FullDiff, FileState, DiffReportHandlingResponse
+
+
+def _chunk(chunk_index: int, last: bool = False, scan_id: str = "scan-1") -> DiffChunk:
+    now = datetime.now(pytz.utc)
+    created = [FileState(path=f"/data/{scan_id}/{chunk_index}", date_created=now, date_updated=now, size=0)]
+    return DiffChunk(
+        source_name="data",
+        scan_id=scan_id,
+        chunk_index=chunk_index,
+        last=last,
+        diff=FullDiff(run_start=now, run_end=now, created=created, deleted=[], updated=[]),
+    )
+
+
+class DiffSenderTests(AioHTTPTestCase):
+    """Sender against fake collector, which answers in batches of batch_size messages in reverse order"""
+
+    def setUp(self):
+        self.protocols = protocol.SUPPORTED_PROTOCOLS
+        self.batch_size = 1
+        # Chunk indexes to reject on first reject_times transmissions
+        self.reject = set()
+        self.reject_times = 1
+        self.rejected = Counter()
+        # Connections to answer with retry hint and close
+        self.busy_connections = 0
+        # Diffs to answer with busy response and retry hint
+        self.busy_responses = 0
+        self.busy_retry_after = 0.01
+        self.connection_times = []
+
+        self.received = []
+        self.receive_times = []
+        self.responses = 0
+        super().setUp()
+
+    async def get_application(self):
+        app = web.Application()
+        app.router.add_get("/ws", self.handle_ws)
+        return app
+
+    async def handle_ws(self, request: web.Request):
+        ws = web.WebSocketResponse(protocols=self.protocols)
+        await ws.prepare(request)
+
+        self.connection_times.append(self.loop.time())
+        if self.busy_connections:
+            self.busy_connections -= 1
+            await ws.send_json(DiffReportHandlingResponse(handled=False, retry_after=0.3).dict())
+            await ws.close()
+            return ws
+
+        batch = []
+
+        async for msg in ws:
+            if msg.type == web.WSMsgType.BINARY:
+                chunk = protocol.decode_diff_chunk(msg.data, ws.ws_protocol)
+            else:
+                chunk = DiffChunk(**json.loads(msg.data))
+
+            self.received.append(chunk)
+            self.receive_times.append(self.loop.time())
+            batch.append(chunk)
+
+            if len(batch) < self.batch_size:
+                continue
+
+            for chunk in reversed(batch):
+                handled = chunk.chunk_index not in self.reject
+                if not handled:
+                    self.rejected[chunk.chunk_index] += 1
+                    if self.rejected[chunk.chunk_index] >= self.reject_times:
+                        self.reject.discard(chunk.chunk_index)
+
+                resp = DiffReportHandlingResponse(handled=handled, seq=chunk.seq)
+                if handled and self.busy_responses:
+                    self.busy_responses -= 1
+                    resp = DiffReportHandlingResponse(handled=False, message="Collector is busy", seq=chunk.seq,
+                                                      retry_after=self.busy_retry_after)
+                await ws.send_json(resp.dict(exclude=set() if chunk.seq is not None else {"seq"}))
+                self.responses += 1
+
+            batch = []
+
+        return ws
+
+    async def send(self, chunks_count: int, expected_responses: int, scans_count: int = 1, **kwargs):
+        diff_queue = asyncio.Queue(loop=self.loop)
+        for scan_index in range(scans_count):
+            for chunk_index in range(chunks_count):
+                diff_queue.put_nowait(_chunk(chunk_index, last=chunk_index == chunks_count - 1,
+                                             scan_id=f"scan-{scan_index}"))
+
+        sender = DiffSender(str(self.server.make_url("/ws")), diff_queue, loop=self.loop, attempts_delay=0.01,
+                            **kwargs)
+        await sender.run()
+
+        try:
+            for _ in range(500):
+                if self.responses >= expected_responses:
+                    break
+                await asyncio.sleep(0.01, loop=self.loop)
+        finally:
+            await sender.close()
+
+        self.assertEqual(expected_responses, self.responses)
+        self.assertTrue(diff_queue.empty())
+
+    @unittest_run_loop
+    async def test_window(self):
+        # Collector answers only after it got 3 messages, so stop-and-wait sender would hang
+        self.batch_size = 3
+
+        await self.send(6, expected_responses=6, window=3)
+
+        self.assertEqual(list(range(6)), [chunk.chunk_index for chunk in self.received])
+        self.assertEqual(6, len({chunk.seq for chunk in self.received}))
+
+    @unittest_run_loop
+    async def test_retry_rejected(self):
+        self.reject = {1}
+
+        await self.send(4, expected_responses=5, window=4)
+
+        self.assertEqual([0, 1, 1, 2, 3], sorted(chunk.chunk_index for chunk in self.received))
+
+    @unittest_run_loop
+    async def test_unsequenced_protocol(self):
+        # Collector which does not know sequence numbers, so answers are matched by order
+        self.protocols = (protocol.BINARY_PROTOCOL_V3,)
+        self.reject = {0}
+
+        await self.send(3, expected_responses=4, window=8)
+
+        # Rejected chunk is retried after jittered delay, so it may go before or after next chunks
+        self.assertEqual(0, self.received[0].chunk_index)
+        self.assertEqual([0, 0, 1, 2], sorted(chunk.chunk_index for chunk in self.received))
+        self.assertEqual({None}, {chunk.seq for chunk in self.received})
+
+    @unittest_run_loop
+    async def test_retry_after(self):
+        self.busy_connections = 1
+
+        await self.send(2, expected_responses=2)
+
+        self.assertEqual(2, len(self.connection_times))
+        self.assertGreaterEqual(self.connection_times[1] - self.connection_times[0], 0.3)
+
+    @unittest_run_loop
+    async def test_coalesce(self):
+        await self.send(2, expected_responses=1, scans_count=3, coalesce_threshold=4)
+
+        self.assertEqual(1, len(self.received))
+        self.assertEqual(6, len(self.received[0].diff.created))
+
+    @unittest_run_loop
+    async def test_spool(self):
+        self.reject = {2}
+
+        with tempfile.TemporaryDirectory(prefix="fspy-tests") as spool_dir:
+            spool = DiffSpool(spool_dir)
+            spool.put(_chunk(0))
+            spool.put(_chunk(1))
+
+            # Diffs put while sender is running wake it up
+            self.loop.call_later(0.05, spool.put, _chunk(2))
+            self.loop.call_later(0.05, spool.put, _chunk(3, last=True))
+
+            await self.send(0, expected_responses=5, window=4, spool=spool)
+
+            self.assertEqual([0, 1, 2, 2, 3], sorted(chunk.chunk_index for chunk in self.received))
+            self.assertEqual(0, spool.pending_count)
+            spool.close()
+
+    @unittest_run_loop
+    async def test_busy_is_not_attempt(self):
+        self.busy_responses = 4
+
+        await self.send(1, expected_responses=5, max_attempts=2)
+
+        self.assertEqual([0] * 5, [chunk.chunk_index for chunk in self.received])
+
+    @unittest_run_loop
+    async def test_busy_holds_new_diffs(self):
+        self.busy_responses = 1
+        self.busy_retry_after = 0.3
+
+        await self.send(3, expected_responses=4, window=1)
+
+        self.assertEqual([0, 0, 1, 2], sorted(chunk.chunk_index for chunk in self.received))
+        # Nothing is sent while collector asked to wait
+        self.assertGreaterEqual(min(self.receive_times[1:]) - self.receive_times[0], 0.3)
+
+    @unittest_run_loop
+    async def test_spooled_diff_is_not_given_up(self):
+        self.reject = {0}
+        self.reject_times = 4
+
+        with tempfile.TemporaryDirectory(prefix="fspy-tests") as spool_dir:
+            spool = DiffSpool(spool_dir)
+            spool.put(_chunk(0, last=True))
+
+            await self.send(0, expected_responses=5, spool=spool, max_attempts=2)
+
+            self.assertEqual([0] * 5, [chunk.chunk_index for chunk in self.received])
+            self.assertEqual(0, spool.pending_count)
+            spool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+import unittest
+
+import os
+import tempfile
+import threading
+from datetime import datetime
+
+import pytz
+
+from fspy.agent.spool import DiffSpool, SpoolClosedError, SPOOL_POLICY_BLOCK, SPOOL_POLICY_DROP_OLDEST, \
+    SPOOL_POLICY_DROP_NEWEST
+from fspy.common.model import DiffChunk, FullDiff, FileState
+
+
+def _chunk(chunk_index: int) -> DiffChunk:
+    now = datetime.now(pytz.utc)
+    created = [FileState(path=f"/data/file_{chunk_index}.txt", size=chunk_index,
+                         date_created=now, date_updated=now)]
+    return DiffChunk(
+        source_name="data",
+        scan_id="scan-1",
+        chunk_index=chunk_index,
+        last=False,
+        diff=FullDiff(run_start=now, run_end=now, created=created, deleted=[], updated=[]),
+    )
+
+
+class DiffSpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.TemporaryDirectory(prefix="fspy-tests")
+
+        # All test chunks are of the same size
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spool = DiffSpool(tmp_dir)
+            spool.put(_chunk(0))
+            one_record_size = spool.size
+            spool.put(_chunk(1))
+            self.record_size = spool.size - one_record_size
+            self.header_size = one_record_size - self.record_size
+            spool.close()
+
+    def tearDown(self):
+        self.spool_dir.cleanup()
+
+    def spool(self, records: int = 100, segment_records: int = 2, policy: str = SPOOL_POLICY_BLOCK) -> DiffSpool:
+        segment_size = self.header_size + segment_records * self.record_size
+        return DiffSpool(self.spool_dir.name, max_size=records // segment_records * segment_size,
+                         segment_size=segment_size, policy=policy)
+
+    def read_all(self, spool: DiffSpool):
+        records = []
+        while True:
+            record = spool.get_nowait()
+            if record is None:
+                return records
+            records.append(record)
+
+    def segment_files(self):
+        return sorted(os.listdir(self.spool_dir.name))
+
+    def test_fifo(self):
+        spool = self.spool()
+
+        for i in range(5):
+            self.assertTrue(spool.put(_chunk(i)))
+
+        records = self.read_all(spool)
+
+        self.assertEqual(list(range(5)), [record.chunk.chunk_index for record in records])
+        self.assertEqual("/data/file_3.txt", records[3].chunk.diff.created[0].path)
+        self.assertEqual(5, spool.pending_count)
+        self.assertEqual(3, len(self.segment_files()))
+
+        spool.put(_chunk(5))
+        self.assertEqual([5], [record.chunk.chunk_index for record in self.read_all(spool)])
+
+    def test_ack_out_of_order(self):
+        spool = self.spool()
+
+        for i in range(5):
+            spool.put(_chunk(i))
+        records = self.read_all(spool)
+
+        spool.ack(records[1].record_id)
+        self.assertEqual(3, len(self.segment_files()))
+
+        spool.ack(records[0].record_id)
+        self.assertEqual(2, len(self.segment_files()))
+
+        # Last segment is not full, so it is kept for appending
+        spool.ack(records[4].record_id)
+        self.assertEqual(2, len(self.segment_files()))
+        self.assertEqual(2, spool.pending_count)
+
+    def test_replay_after_restart(self):
+        spool = self.spool()
+
+        for i in range(5):
+            spool.put(_chunk(i))
+        records = self.read_all(spool)
+
+        spool.ack(records[0].record_id)
+        spool.ack(records[1].record_id)
+        spool.ack(records[2].record_id)
+        spool.close()
+
+        spool = self.spool()
+        spool.put(_chunk(5))
+
+        # Acknowledged record of partially acknowledged segment is sent again
+        self.assertEqual([2, 3, 4, 5], [record.chunk.chunk_index for record in self.read_all(spool)])
+
+    def test_acked_tail_removed_on_close(self):
+        spool = self.spool()
+
+        spool.put(_chunk(0))
+        spool.ack(spool.get_nowait().record_id)
+        spool.close()
+
+        self.assertEqual([], self.segment_files())
+        self.assertIsNone(self.spool().get_nowait())
+
+    def test_torn_tail(self):
+        spool = self.spool()
+
+        for i in range(3):
+            spool.put(_chunk(i))
+        spool.close()
+
+        last_segment = os.path.join(self.spool_dir.name, self.segment_files()[-1])
+        with open(last_segment, "r+b") as seg_file:
+            seg_file.truncate(os.path.getsize(last_segment) - 3)
+
+        spool = self.spool()
+        self.assertEqual(2, spool.pending_count)
+
+        spool.put(_chunk(3))
+        self.assertEqual([0, 1, 3], [record.chunk.chunk_index for record in self.read_all(spool)])
+
+    def test_damaged_records_skipped(self):
+        # Records damaged after spool was loaded. More of them in a row than recursion limit
+        records_count = 1100
+        spool = self.spool(records=2 * (records_count + 1), segment_records=records_count + 1)
+
+        # Chunks of the same size
+        for _ in range(records_count):
+            spool.put(_chunk(1))
+        spool.put(_chunk(2))
+
+        segment_file, = self.segment_files()
+        with open(os.path.join(self.spool_dir.name, segment_file), "r+b") as seg_file:
+            for i in range(records_count):
+                # Last byte of payload
+                seg_file.seek(self.header_size + (i + 1) * self.record_size - 1)
+                last_byte = seg_file.read(1)
+                seg_file.seek(-1, os.SEEK_CUR)
+                seg_file.write(bytes((last_byte[0] ^ 0xFF,)))
+
+        self.assertEqual([2], [record.chunk.chunk_index for record in self.read_all(spool)])
+        spool.close()
+
+    def test_drop_newest(self):
+        spool = self.spool(records=3, segment_records=1, policy=SPOOL_POLICY_DROP_NEWEST)
+
+        self.assertEqual([True, True, True, False], [spool.put(_chunk(i)) for i in range(4)])
+        self.assertEqual([0, 1, 2], [record.chunk.chunk_index for record in self.read_all(spool)])
+
+    def test_drop_oldest(self):
+        spool = self.spool(records=3, segment_records=1, policy=SPOOL_POLICY_DROP_OLDEST)
+
+        spool.put(_chunk(0))
+        record = spool.get_nowait()
+
+        for i in range(1, 5):
+            self.assertTrue(spool.put(_chunk(i)))
+
+        self.assertEqual([2, 3, 4], [record.chunk.chunk_index for record in self.read_all(spool)])
+
+        # Ack of dropped record is ignored
+        spool.ack(record.record_id)
+        self.assertEqual(3, spool.pending_count)
+
+    def test_block(self):
+        spool = self.spool(records=2, segment_records=1)
+
+        spool.put(_chunk(0))
+        spool.put(_chunk(1))
+
+        put_thread = threading.Thread(target=spool.put, args=(_chunk(2),))
+        put_thread.start()
+
+        put_thread.join(0.1)
+        self.assertTrue(put_thread.is_alive())
+
+        spool.ack(spool.get_nowait().record_id)
+
+        put_thread.join(5)
+        self.assertFalse(put_thread.is_alive())
+        self.assertEqual([1, 2], [record.chunk.chunk_index for record in self.read_all(spool)])
+
+    def test_close_unblocks_put(self):
+        spool = self.spool(records=1, segment_records=1)
+        spool.put(_chunk(0))
+
+        errors = []
+
+        def put():
+            try:
+                spool.put(_chunk(1))
+            except SpoolClosedError as e:
+                errors.append(e)
+
+        put_thread = threading.Thread(target=put)
+        put_thread.start()
+        put_thread.join(0.1)
+
+        spool.close()
+        put_thread.join(5)
+
+        self.assertEqual(1, len(errors))
+
+
+if __name__ == '__main__':
+    unittest.main()
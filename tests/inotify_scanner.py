@@ -0,0 +1,142 @@
+import unittest
+from unittest import mock
+
+import os
+import shutil
+from os.path import join
+
+import time
+
+from tests.util import with_file_structure
+
+from fspy.agent import inotify
+# noinspection PyProtectedMember
+from fspy.agent.scanner import _file_state_from_file_path
+from fspy.agent.inotify import InotifyComparator, inotify_available
+
+
+def _paths(file_states):
+    return {fs.path for fs in file_states}
+
+
+@unittest.skipUnless(inotify_available(), "inotify is not available")
+class InotifyScanner(unittest.TestCase):
+
+    @with_file_structure({"a.txt": 10, "b.txt": 20})
+    def test_no_changes(self, wd):
+        c = InotifyComparator(wd)
+
+        self.assertIsNone(c.scan())
+        self.assertFalse(c.scan())
+
+        c.close()
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20}})
+    def test_create_update_delete(self, wd):
+        c = InotifyComparator(wd)
+        c.scan()
+
+        file_to_update = join(wd, "a.txt")
+        file_to_delete = join(wd, "dir1", "b.txt")
+        file_to_create = join(wd, "dir1", "c.txt")
+
+        expected_deleted_file_state = _file_state_from_file_path(file_to_delete)
+
+        # Resolution for mtime/ctime is 1 second for some platforms
+        time.sleep(1)
+
+        with open(file_to_update, "wb") as fd:
+            fd.write(b"\0" * 10)
+        with open(file_to_create, "wb") as fd:
+            fd.write(b"a" * 30)
+        os.remove(file_to_delete)
+
+        f_diff = c.scan()
+
+        self.assertEqual([_file_state_from_file_path(file_to_create)], f_diff.created)
+        self.assertEqual([expected_deleted_file_state], f_diff.deleted)
+        self.assertEqual([_file_state_from_file_path(file_to_update)], [fd.after for fd in f_diff.updated])
+
+        self.assertFalse(c.scan())
+
+        c.close()
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20, "dir2": {"c.txt": 30}}})
+    def test_directories(self, wd):
+        c = InotifyComparator(wd)
+        c.scan()
+
+        os.makedirs(join(wd, "new", "nested"))
+        with open(join(wd, "new", "nested", "d.txt"), "wb") as fd:
+            fd.write(b"a" * 40)
+
+        os.rename(join(wd, "dir1", "dir2"), join(wd, "dir2_moved"))
+
+        f_diff = c.scan()
+
+        self.assertEqual(
+            {join(wd, "new", "nested", "d.txt"), join(wd, "dir2_moved", "c.txt")},
+            _paths(f_diff.created)
+        )
+        self.assertEqual({join(wd, "dir1", "dir2", "c.txt")}, _paths(f_diff.deleted))
+
+        # Watches follow moved and created directories
+        with open(join(wd, "dir2_moved", "e.txt"), "wb") as fd:
+            fd.write(b"a" * 50)
+
+        shutil.rmtree(join(wd, "dir1"))
+
+        f_diff = c.scan()
+
+        self.assertEqual({join(wd, "dir2_moved", "e.txt")}, _paths(f_diff.created))
+        self.assertEqual({join(wd, "dir1", "b.txt")}, _paths(f_diff.deleted))
+
+        c.close()
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20}})
+    def test_overflow_runs_reconcile(self, wd):
+        c = InotifyComparator(wd)
+        c.scan()
+
+        with open(join(wd, "c.txt"), "wb") as fd:
+            fd.write(b"a" * 30)
+
+        with mock.patch.object(inotify.Inotify, "read_events", return_value=[(-1, inotify.IN_Q_OVERFLOW, "")]):
+            with mock.patch.object(c, "_reconcile", wraps=c._reconcile) as reconcile:
+                f_diff = c.scan()
+
+        reconcile.assert_called_once()
+        self.assertEqual({join(wd, "c.txt")}, _paths(f_diff.created))
+
+        c.close()
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20}, "dir2": {"c.txt": 30}})
+    def test_watch_limit(self, wd):
+        c = InotifyComparator(wd, max_watches=2)
+        c.scan()
+
+        self.assertTrue(c.degraded)
+
+        os.remove(join(wd, "dir2", "c.txt"))
+        os.remove(join(wd, "dir1", "b.txt"))
+
+        f_diff = c.scan()
+
+        self.assertEqual({join(wd, "dir1", "b.txt"), join(wd, "dir2", "c.txt")}, _paths(f_diff.deleted))
+
+        c.close()
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20}})
+    def test_watch_limit_not_reached_on_reconcile(self, wd):
+        # Exactly as many watches as directories
+        c = InotifyComparator(wd, max_watches=2, reconcile_interval=0)
+        c.scan()
+        c.scan()
+
+        self.assertFalse(c.degraded)
+
+        c.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
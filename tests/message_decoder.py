@@ -0,0 +1,89 @@
+import unittest
+
+import asyncio
+from datetime import datetime
+
+import pytz
+
+from fspy.collector.decoding import MessageDecoder, DECODE_POOL_PROCESS, DECODE_POOL_THREAD
+from fspy.common import protocol
+from fspy.common.model import DiffChunk, FullDiff, FileState
+from fspy.common.records import ChunkRecord
+
+
+def _message(seq: int) -> bytes:
+    now = datetime(2018, 9, 2, 14, 53, 48, tzinfo=pytz.utc)
+    return protocol.encode_diff_chunk(DiffChunk(
+        source_name="data",
+        scan_id="scan-1",
+        chunk_index=0,
+        last=True,
+        seq=seq,
+        diff=FullDiff(
+            run_start=now,
+            run_end=now,
+            created=[FileState(path="/data/a.log", date_created=now, date_updated=now, size=1)],
+            deleted=[],
+            updated=[],
+        ),
+    ))
+
+
+class MessageDecoderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def decode(self, decoder: MessageDecoder, data: bytes):
+        return self.loop.run_until_complete(decoder.decode(data, protocol.BINARY_PROTOCOL_V4, "agent"))
+
+    def check_pool(self, pool: str):
+        decoder = MessageDecoder(offload_threshold=0, workers=1, pool=pool, loop=self.loop)
+        try:
+            record = self.decode(decoder, _message(seq=3))
+            self.assertIsInstance(record, ChunkRecord)
+            self.assertEqual(3, record.seq)
+            self.assertEqual(["/data/a.log"], [f.path for f in record.diff.created])
+
+            with self.assertRaises(protocol.ProtocolError) as cm:
+                self.decode(decoder, _message(seq=4)[:-1])
+            self.assertEqual(4, cm.exception.seq)
+
+            self.assertEqual((0, 2, 0), (decoder.inline_count, decoder.offloaded_count, decoder.offloaded_pending))
+        finally:
+            decoder.close()
+
+    def test_thread_pool(self):
+        self.check_pool(DECODE_POOL_THREAD)
+
+    def test_process_pool(self):
+        self.check_pool(DECODE_POOL_PROCESS)
+
+    def test_threshold(self):
+        message = _message(seq=0)
+
+        decoder = MessageDecoder(offload_threshold=len(message) + 1, workers=1, pool=DECODE_POOL_THREAD,
+                                 loop=self.loop)
+        self.decode(decoder, message)
+        decoder.offload_threshold = len(message)
+        self.decode(decoder, message)
+        decoder.close()
+
+        self.assertEqual((1, 1), (decoder.inline_count, decoder.offloaded_count))
+
+    def test_no_workers(self):
+        decoder = MessageDecoder(offload_threshold=0, workers=0, loop=self.loop)
+        self.decode(decoder, _message(seq=0))
+
+        self.assertEqual((1, 0), (decoder.inline_count, decoder.offloaded_count))
+
+    def test_unknown_pool(self):
+        with self.assertRaises(ValueError):
+            MessageDecoder(pool="fibers", loop=self.loop)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+
+import os
+from os.path import join
+
+from tests.util import with_file_structure
+
+from fspy.agent.filters import PathFilter
+from fspy.agent.scanner import SimpleComparator, scandir_snapshot
+
+
+class PathFilterTests(unittest.TestCase):
+    def test_patterns(self):
+        root = join(os.sep, "srv")
+        f = PathFilter(root, include=["*.log", "conf/*.ini"], exclude=["node_modules", "/build/", "*.tmp.log"])
+
+        self.assertTrue(f.accept_name(root, "a.log"))
+        self.assertTrue(f.accept_name(join(root, "x", "y"), "a.log"))
+        self.assertFalse(f.accept_name(root, "a.txt"))
+        self.assertFalse(f.accept_name(root, "a.tmp.log"))
+
+        self.assertTrue(f.accept_name(join(root, "conf"), "a.ini"))
+        self.assertFalse(f.accept_name(join(root, "x", "conf"), "a.ini"))
+
+        self.assertFalse(f.descend(join(root, "x"), "node_modules"))
+        self.assertFalse(f.descend(root, "build"))
+        self.assertTrue(f.descend(join(root, "x"), "build"))
+
+    def test_limits(self):
+        root = join(os.sep, "srv")
+        f = PathFilter(root, max_depth=1, max_file_size=10)
+
+        self.assertTrue(f.descend(root, "a"))
+        self.assertFalse(f.descend(join(root, "a"), "b"))
+
+        self.assertTrue(f.accept_stat(os.stat_result((0,) * 6 + (10,) + (0,) * 3)))
+        self.assertFalse(f.accept_stat(os.stat_result((0,) * 6 + (11,) + (0,) * 3)))
+
+    def test_key(self):
+        self.assertTrue(PathFilter("/srv").empty)
+        self.assertEqual("", PathFilter("/srv").key)
+        self.assertNotEqual(PathFilter("/srv", exclude=[".git"]).key, PathFilter("/srv", exclude=["*.pyc"]).key)
+
+    @with_file_structure({
+        "a.txt": 10, "big.txt": 100, "b.pyc": 1,
+        "node_modules": {"c.txt": 1, "d": {"e.txt": 1}},
+        "dir1": {"f.txt": 1, "dir2": {"g.txt": 1}},
+    })
+    def test_traversal(self, wd):
+        f = PathFilter(wd, exclude=["node_modules", "*.pyc"], max_depth=1, max_file_size=50)
+        snapshot = scandir_snapshot(wd, path_filter=f)
+
+        self.assertEqual({join(wd, "a.txt"), join(wd, "dir1", "f.txt")}, set(snapshot.to_dict().keys()))
+
+        # Excluded and too deep directories are pruned
+        self.assertEqual([join(wd, "dir1")], list(snapshot.dir_state(wd).sub_dirs))
+        self.assertIsNone(snapshot.dir_state(join(wd, "node_modules")))
+        self.assertEqual((), snapshot.dir_state(join(wd, "dir1")).sub_dirs)
+
+    @with_file_structure({"a.txt": 10, "cache": {"b.txt": 1}})
+    def test_comparator(self, wd):
+        c = SimpleComparator(wd, path_filter=PathFilter(wd, exclude=["cache"], max_file_size=50))
+        c.scan()
+
+        with open(join(wd, "cache", "c.txt"), "wb") as fd:
+            fd.write(b"\0")
+
+        self.assertFalse(c.scan())
+
+        with open(join(wd, "a.txt"), "wb") as fd:
+            fd.write(b"\0" * 100)
+
+        # File which became too large is reported as deleted
+        self.assertEqual([join(wd, "a.txt")], [fs.path for fs in c.scan().deleted])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import unittest
+
+import json
+import struct
+
+from datetime import datetime, timedelta
+
+import pytz
+
+from fspy.common import protocol
+from fspy.common.model import DiffChunk, DiffReport, FullDiff, FileState, FileDiff
+from fspy.common.records import ChunkRecord, ReportRecord, chunk_to_model, diff_to_model
+
+
+def _file_state(file_path: str, size: int = 10, content_hash: str = None) -> FileState:
+    now = datetime(2018, 9, 2, 14, 53, 48, 70242, tzinfo=pytz.utc)
+    return FileState(path=file_path, date_created=now - timedelta(hours=1), date_updated=now, size=size,
+                     content_hash=content_hash)
+
+
+def _diff_chunk(**kwargs) -> DiffChunk:
+    now = datetime(2018, 9, 2, 14, 53, 48, tzinfo=pytz.utc)
+    params = dict(
+        source_name="data",
+        scan_id="0123456789abcdef0123456789abcdef",
+        chunk_index=3,
+        last=True,
+        diff=FullDiff(
+            run_start=now,
+            run_end=now + timedelta(seconds=2),
+            created=[_file_state("/data/a.log", content_hash="da39a3ee5e6b4b0d3255bfef95601890afd80709")],
+            deleted=[_file_state("/data/b.log", size=0)],
+            updated=[FileDiff(before=_file_state("/data/c.log", size=1), after=_file_state("/data/c.log", size=2))],
+        ),
+    )
+    params.update(kwargs)
+    return DiffChunk(**params)
+
+
+def _for_version(chunk: DiffChunk, version: str) -> DiffChunk:
+    """Only sequenced protocols carry sequence number"""
+    return chunk.copy(update={"seq": 7 if version in protocol.SEQUENCED_PROTOCOLS else None})
+
+
+class BinaryProtocolTests(unittest.TestCase):
+    def test_round_trip(self):
+        for version in protocol.BINARY_PROTOCOLS:
+            with self.subTest(version=version):
+                chunk = _for_version(_diff_chunk(), version)
+                data = protocol.encode_diff_chunk(chunk, version)
+
+                self.assertEqual(chunk, protocol.decode_diff_chunk(data, version))
+                self.assertLess(len(data), len(chunk.json()) / 2)
+
+    def test_front_coding(self):
+        deep_dir = "/srv/data/" + "/".join(f"level_{i}" for i in range(10))
+        chunk = _diff_chunk(diff=FullDiff(
+            run_start=datetime(2018, 9, 2, tzinfo=pytz.utc),
+            run_end=datetime(2018, 9, 2, tzinfo=pytz.utc),
+            created=[_file_state(f"{deep_dir}/file_{i}.log") for i in range(100)] + [_file_state("/srv/other.log")],
+            deleted=[_file_state(f"{deep_dir}/старый_{i}.log") for i in range(10)],
+            updated=[],
+        ))
+
+        v1_data = protocol.encode_diff_chunk(chunk, protocol.BINARY_PROTOCOL_V1)
+        v2_data = protocol.encode_diff_chunk(chunk, protocol.BINARY_PROTOCOL_V2)
+
+        self.assertEqual(chunk, protocol.decode_diff_chunk(v2_data, protocol.BINARY_PROTOCOL_V2))
+        self.assertLess(len(v2_data), len(v1_data) / 2)
+
+    def test_common_prefix_length(self):
+        self.assertEqual(0, protocol.common_prefix_length(b"", b"/data"))
+        self.assertEqual(6, protocol.common_prefix_length(b"/data/a.log", b"/data/b.log"))
+        self.assertEqual(5, protocol.common_prefix_length(b"/data", b"/data/b.log"))
+        self.assertEqual(5, protocol.common_prefix_length(b"/data", b"/data"))
+
+    def test_not_last_empty_chunk(self):
+        chunk = _diff_chunk(last=False, chunk_index=0, seq=0, diff=FullDiff(
+            run_start=datetime(2018, 9, 2, tzinfo=pytz.utc),
+            run_end=datetime(2018, 9, 2, tzinfo=pytz.utc),
+            created=[], deleted=[], updated=[],
+        ))
+
+        self.assertEqual(chunk, protocol.decode_diff_chunk(protocol.encode_diff_chunk(chunk)))
+
+    def test_undecodable_path(self):
+        # File name which is not valid UTF-8, as returned by os.listdir()
+        chunk = _diff_chunk(diff=FullDiff(
+            run_start=datetime(2018, 9, 2, tzinfo=pytz.utc),
+            run_end=datetime(2018, 9, 2, tzinfo=pytz.utc),
+            created=[_file_state("/data/\udcff.log"), _file_state("/data/файл.log")], deleted=[], updated=[],
+        ))
+
+        for version in protocol.BINARY_PROTOCOLS:
+            data = protocol.encode_diff_chunk(_for_version(chunk, version), version)
+            decoded = protocol.decode_diff_chunk(data, version)
+            self.assertEqual(["/data/\udcff.log", "/data/файл.log"], [f.path for f in decoded.diff.created])
+
+    def test_naive_datetime_is_utc(self):
+        naive = datetime(2018, 9, 2, 14, 53, 48, 70242)
+
+        self.assertEqual(1535900028070242, protocol.datetime_to_us(naive))
+        self.assertEqual(naive.replace(tzinfo=pytz.utc), protocol.datetime_from_us(1535900028070242))
+
+    def test_malformed(self):
+        for version in protocol.BINARY_PROTOCOLS:
+            data = protocol.encode_diff_chunk(_for_version(_diff_chunk(), version), version)
+
+            for malformed in (b"", data[:10], data[:-1], data + b"\0", b"\x07" + data[1:]):
+                with self.assertRaises(protocol.ProtocolError):
+                    protocol.decode_diff_chunk(malformed, version)
+
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decode_diff_chunk(protocol.encode_diff_chunk(_diff_chunk(seq=1)), protocol.JSON_PROTOCOL)
+
+    def test_sequenced(self):
+        data = protocol.encode_diff_chunk(_diff_chunk(seq=2 ** 32 - 1))
+        self.assertEqual(2 ** 32 - 1, protocol.decode_diff_chunk(data).seq)
+
+        with self.assertRaises(ValueError):
+            protocol.encode_diff_chunk(_diff_chunk(seq=None), protocol.BINARY_PROTOCOL_V4)
+
+        # Sequence number of message with malformed body is known, so it can be rejected by number
+        with self.assertRaises(protocol.ProtocolError) as cm:
+            protocol.decode_diff_chunk(data[:-1])
+        self.assertEqual(2 ** 32 - 1, cm.exception.seq)
+
+        with self.assertRaises(protocol.ProtocolError) as cm:
+            protocol.decode_diff_chunk(data[:3])
+        self.assertIsNone(cm.exception.seq)
+
+    def test_compression(self):
+        chunk = _diff_chunk(diff=FullDiff(
+            run_start=datetime(2018, 9, 2, tzinfo=pytz.utc),
+            run_end=datetime(2018, 9, 2, tzinfo=pytz.utc),
+            created=[_file_state(f"/data/file_{i}.log") for i in range(100)], deleted=[], updated=[],
+        ))
+
+        plain = protocol.encode_diff_chunk(chunk, protocol.BINARY_PROTOCOL_V3)
+        compressed = protocol.encode_diff_chunk(chunk, protocol.BINARY_PROTOCOL_V3, compress_threshold=1024)
+
+        self.assertEqual(protocol.MSG_COMPRESSED, compressed[0])
+        self.assertLess(len(compressed), len(plain) / 4)
+        self.assertEqual(chunk, protocol.decode_diff_chunk(compressed, protocol.BINARY_PROTOCOL_V3))
+
+        # Below threshold and older protocol versions - not compressed
+        self.assertEqual(plain, protocol.encode_diff_chunk(chunk, protocol.BINARY_PROTOCOL_V3,
+                                                           compress_threshold=len(plain) + 1))
+        self.assertEqual(
+            protocol.encode_diff_chunk(chunk, protocol.BINARY_PROTOCOL_V2),
+            protocol.encode_diff_chunk(chunk, protocol.BINARY_PROTOCOL_V2, compress_threshold=0),
+        )
+
+    def test_compress_message(self):
+        incompressible = bytes(range(256))
+
+        self.assertEqual(incompressible, protocol.compress_message(incompressible, threshold=0))
+        self.assertEqual(b"\1" * 100, protocol.compress_message(b"\1" * 100, threshold=1024))
+        self.assertEqual(b"\1" * 2048, protocol.decompress_message(protocol.compress_message(b"\1" * 2048)))
+
+    def test_malformed_compressed(self):
+        compressed = protocol.compress_message(b"\1" * 2048)
+
+        for malformed in (compressed[:-2], compressed[:1] + b"garbage", compressed + b"\0"):
+            with self.assertRaises(protocol.ProtocolError):
+                protocol.decode_diff_chunk(malformed, protocol.BINARY_PROTOCOL_V3)
+
+        # Size of decompressed message is limited
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decompress_message(protocol.compress_message(b"\0" * 4096), max_size=4095)
+
+    def test_shared_prefix_out_of_range(self):
+        data = bytearray(protocol.encode_diff_chunk(_diff_chunk(seq=1)))
+
+        # Shared prefix length of the first record, there is no previous path to share it with
+        first_record = data.index(b"/data/a.log") - struct.calcsize("<HHqqQB")
+        data[first_record] = 5
+
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decode_diff_chunk(bytes(data))
+
+
+class JsonProtocolTests(unittest.TestCase):
+    def test_same_as_pydantic(self):
+        chunk = _diff_chunk(seq=5)
+
+        record = protocol.decode_json_message(chunk.json(), "ignored")
+
+        self.assertIsInstance(record, ChunkRecord)
+        self.assertEqual(DiffChunk(**json.loads(chunk.json())), chunk_to_model(record))
+
+    def test_older_messages(self):
+        diff = _diff_chunk().diff
+
+        record = protocol.decode_json_message(DiffReport(source_name="logs", diff=diff).json(), "ignored")
+        self.assertEqual(ReportRecord("logs", record.diff), record)
+        self.assertEqual(diff, diff_to_model(record.diff))
+
+        record = protocol.decode_json_message(diff.json(), "connection")
+        self.assertEqual("connection", record.source_name)
+        self.assertEqual(diff, diff_to_model(record.diff))
+
+    def test_datetime_formats(self):
+        utc = datetime(2018, 9, 2, 14, 53, 48, 70000, tzinfo=pytz.utc)
+        formats = {
+            "2018-09-02T14:53:48.07Z": utc,
+            "2018-09-02 17:53:48.070000+03:00": utc,
+            "2018-09-02T10:53:48.070-0400": utc,
+            "2018-09-02T14:53:48.07": utc.replace(tzinfo=None),
+            "2018-09-02T14:53": utc.replace(second=0, microsecond=0, tzinfo=None),
+            1535900028.07: utc,
+            1535900028070: utc,
+        }
+
+        for value, expected in formats.items():
+            diff = {"run_start": value, "run_end": value, "created": [], "deleted": [], "updated": []}
+            record = protocol.decode_json_message(json.dumps(diff), "data")
+            self.assertEqual(expected, record.diff.run_start, value)
+
+    def test_malformed(self):
+        chunk = json.loads(_diff_chunk(seq=9).json())
+        broken = [
+            ("[1, 2]", None),
+            ("{", None),
+            (json.dumps(dict(chunk, last=None)), 9),
+            (json.dumps(dict(chunk, chunk_index="1")), 9),
+            (json.dumps(dict(chunk, chunk_index=True)), 9),
+            (json.dumps(dict(chunk, diff=dict(chunk["diff"], run_start="yesterday"))), 9),
+            (json.dumps(dict(chunk, diff=dict(chunk["diff"], run_start="2018-13-02T14:53:48"))), 9),
+            (json.dumps(dict(chunk, diff=dict(chunk["diff"], created=[{"path": "/a"}]))), 9),
+            (json.dumps(dict(chunk, seq="9", diff=dict(chunk["diff"], updated=[{}]))), None),
+        ]
+
+        for data, seq in broken:
+            with self.assertRaises(protocol.ProtocolError, msg=data) as ctx:
+                protocol.decode_json_message(data, "data")
+            self.assertEqual(seq, ctx.exception.seq, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
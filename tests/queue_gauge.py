@@ -0,0 +1,35 @@
+import unittest
+
+import asyncio
+
+from fspy.collector.metrics import QueueGauge
+
+
+class QueueGaugeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_bounded(self):
+        queue = asyncio.Queue(maxsize=2, loop=self.loop)
+        gauge = QueueGauge(queue)
+
+        self.assertEqual([True, True, False], [gauge.put_nowait(i) for i in range(3)])
+        queue.get_nowait()
+        self.assertTrue(gauge.put_nowait(3))
+
+        self.assertEqual((2, 2, 2, 1), (gauge.depth, gauge.max_size, gauge.high_watermark, gauge.rejected))
+        self.assertEqual([1, 3], [queue.get_nowait() for _ in range(2)])
+
+    def test_unbounded(self):
+        gauge = QueueGauge(asyncio.Queue(loop=self.loop))
+
+        self.assertTrue(all(gauge.put_nowait(i) for i in range(100)))
+        self.assertEqual((100, 0, 100, 0), (gauge.depth, gauge.max_size, gauge.high_watermark, gauge.rejected))
+
+
+if __name__ == '__main__':
+    unittest.main()
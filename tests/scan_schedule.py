@@ -0,0 +1,48 @@
+import unittest
+
+from fspy.agent.schedule import AdaptiveScanInterval
+
+
+class AdaptiveScanIntervalTests(unittest.TestCase):
+    def test_changes_rate(self):
+        interval = AdaptiveScanInterval(initial=8, min_interval=1, max_interval=60, budget=0.5)
+
+        self.assertEqual(4, interval.update(scan_duration=0.01, changes_count=3).seconds)
+        self.assertIn("3 changes", interval.reason)
+
+        self.assertEqual(6, interval.update(scan_duration=0.01, changes_count=0).seconds)
+        self.assertEqual("no changes", interval.reason)
+
+    def test_bounds(self):
+        interval = AdaptiveScanInterval(initial=100, min_interval=1, max_interval=10)
+        self.assertEqual(10, interval.seconds)
+
+        for _ in range(10):
+            interval.update(scan_duration=0.01, changes_count=1)
+
+        self.assertEqual(1, interval.seconds)
+        self.assertIn("min bound", interval.reason)
+
+        for _ in range(10):
+            interval.update(scan_duration=0.01, changes_count=0)
+
+        self.assertEqual(10, interval.seconds)
+        self.assertIn("max bound", interval.reason)
+
+    def test_budget(self):
+        interval = AdaptiveScanInterval(initial=1, min_interval=1, max_interval=60, budget=0.1)
+
+        # Expensive scan slows down even frequently changing target
+        self.assertAlmostEqual(27, interval.update(scan_duration=3, changes_count=100).seconds)
+        self.assertIn("budget", interval.reason)
+
+        self.assertEqual(60, interval.update(scan_duration=30, changes_count=100).seconds)
+        self.assertIn("max bound", interval.reason)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, AdaptiveScanInterval, initial=1, budget=0)
+        self.assertRaises(ValueError, AdaptiveScanInterval, initial=1, min_interval=10, max_interval=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+import asyncio
+import tempfile
+from os import path
+from datetime import datetime
+
+import pytz
+from sqlalchemy.orm import Session
+
+from fspy.collector import db
+from fspy.collector.sharding import ShardedWriteManager, shard_paths, shard_index
+from fspy.collector.storage import create_write_engine
+from fspy.common.records import ReportRecord, DiffRecord, FileRecord
+
+
+class ShardingTests(unittest.TestCase):
+
+    def test_shard_paths(self):
+        self.assertEqual(["/data/fspy.sqlite"], shard_paths("/data/fspy.sqlite", 1))
+        self.assertEqual(["/data/fspy.sqlite", "/data/fspy.1.sqlite", "/data/fspy.2.sqlite"],
+                         shard_paths("/data/fspy.sqlite", 3))
+
+    def test_shard_index(self):
+        # Same in every run, so sources stay in their shards after restart
+        self.assertEqual([0, 2, 0, 0], [shard_index(source_name, 3) for source_name in ("a", "b", "c", "d")])
+        self.assertEqual({0}, {shard_index(f"agent-{i}", 1) for i in range(10)})
+
+    def test_no_shards(self):
+        with self.assertRaises(ValueError):
+            ShardedWriteManager(0, loop=asyncio.new_event_loop())
+
+    def test_writes_to_shard_of_source(self):
+        now = datetime(2018, 9, 2, 14, 53, 48, tzinfo=pytz.utc)
+        loop = asyncio.new_event_loop()
+
+        with tempfile.TemporaryDirectory(prefix="fspy-tests") as temp_dir:
+            engines = [create_write_engine(shard_path)
+                       for shard_path in shard_paths(path.join(temp_dir, "fspy-tests.sqlite"), 3)]
+            for engine in engines:
+                db.Base.metadata.create_all(engine)
+
+            manager = ShardedWriteManager(3, loop=loop, batch_delay=0)
+            manager.run_workers(engines)
+
+            sources = [f"agent-{i}" for i in range(8)]
+
+            async def run():
+                for source_name in sources:
+                    file_record = FileRecord(path=f"/{source_name}.log", date_created=now, date_updated=now, size=1)
+                    await manager.save(ReportRecord(source_name=source_name, diff=DiffRecord(
+                        run_start=now, run_end=now, created=[file_record], deleted=[], updated=[])))
+                await manager.close()
+
+            loop.run_until_complete(run())
+            loop.close()
+
+            for index, engine in enumerate(engines):
+                session = Session(bind=engine)
+                saved = sorted(source_name for source_name, in session.query(db.DiffReport.source_name))
+                session.close()
+                engine.dispose()
+
+                self.assertEqual([s for s in sources if shard_index(s, 3) == index], saved)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,20 @@
 import unittest
+from unittest import mock
 
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join
 
 import time
 
 from tests.util import with_file_structure
 
+from fspy.agent import scanner, snapshot
 # noinspection PyProtectedMember
-from fspy.agent.scanner import SimpleComparator, _file_state_from_file_path
+from fspy.agent.scanner import (
+    SimpleComparator, ScanInProgressError, _file_state_from_file_path,
+    scandir_snapshot, parallel_scandir_snapshot, walk_snapshot, )
 from fspy.common.model import FileDiff
 
 
@@ -98,6 +104,167 @@ class SimpleScanner(unittest.TestCase):
 
         self.assertTrue(f_diff)
 
+    @with_file_structure({"a.txt": 10, "b.txt": 20})
+    def test_baseline_survives_restart(self, wd):
+        with tempfile.TemporaryDirectory(prefix="fspy-tests") as state_dir:
+            snapshot_path = join(state_dir, "snapshot.bin")
+
+            self.assertIsNone(SimpleComparator(wd, snapshot_path=snapshot_path).scan())
+
+            file_to_create = join(wd, "c.txt")
+            with open(file_to_create, "wb") as fd:
+                fd.write(b"a" * 30)
+
+            f_diff = SimpleComparator(wd, snapshot_path=snapshot_path).scan()
+
+            self.assertEqual([_file_state_from_file_path(file_to_create)], f_diff.created)
+
+            # Saved baseline is updated after scan with changes
+            self.assertFalse(SimpleComparator(wd, snapshot_path=snapshot_path).scan())
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20, "dir2": {"c.txt": 30}}, "dir3": {}})
+    def test_scandir_same_as_walk(self, wd):
+        self.assertEqual(walk_snapshot(wd), scandir_snapshot(wd).to_dict())
+        self.assertEqual(3, len(scandir_snapshot(wd)))
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20, "dir2": {"c.txt": 30, "dir3": {}}}, "dir4": {"d": 1}})
+    def test_parallel_same_as_sequential(self, wd):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            self.assertEqual(scandir_snapshot(wd).to_dict(), parallel_scandir_snapshot(wd, executor).to_dict())
+
+            c = SimpleComparator(wd, traversal_executor=executor)
+            c.scan()
+
+            os.remove(join(wd, "dir1", "dir2", "c.txt"))
+
+            self.assertEqual([join(wd, "dir1", "dir2", "c.txt")], [fs.path for fs in c.scan().deleted])
+
+    @with_file_structure({"a.txt": 10})
+    def test_overlapping_scans(self, wd):
+        c = SimpleComparator(wd)
+
+        # noinspection PyProtectedMember
+        with c._scan_lock:
+            self.assertRaises(ScanInProgressError, c.scan)
+
+        self.assertIsNone(c.scan())
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "Symlinks are not supported")
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20}})
+    def test_scandir_skips_broken_and_dir_symlinks(self, wd):
+        os.symlink(join(wd, "not_exists.txt"), join(wd, "broken.txt"))
+        os.symlink(join(wd, "dir1"), join(wd, "dir1_link"))
+
+        self.assertEqual(
+            {join(wd, "a.txt"), join(wd, "dir1", "b.txt")},
+            set(scandir_snapshot(wd).to_dict().keys())
+        )
+
+    @with_file_structure({"a.txt": 10, "dir1": {}})
+    def test_scan_chunks(self, wd):
+        c = SimpleComparator(wd)
+
+        self.assertEqual([], list(c.scan_chunks(max_entries=2)))
+        self.assertEqual(1, len(list(c.scan_chunks(max_entries=2))))
+
+        for i in range(5):
+            with open(join(wd, "dir1", f"{i}.txt"), "wb") as fd:
+                fd.write(b"\0")
+        os.remove(join(wd, "a.txt"))
+
+        chunks = list(c.scan_chunks(max_entries=2))
+
+        self.assertEqual([2, 2, 2], [len(chunk.created) + len(chunk.deleted) for chunk in chunks])
+        self.assertEqual(5, sum(len(chunk.created) for chunk in chunks))
+        self.assertEqual([join(wd, "a.txt")], [fs.path for chunk in chunks for fs in chunk.deleted])
+
+
+@mock.patch.object(snapshot, "RACY_DIR_WINDOW_NS", -1)
+class IncrementalScanner(unittest.TestCase):
+    # Enough to get new directory mtime on file systems with coarse timestamps clock
+    MTIME_TICK = 0.05
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20}, "dir2": {"c.txt": 30}})
+    def test_unchanged_dirs_are_not_listed(self, wd):
+        c = SimpleComparator(wd, incremental=True)
+        c.scan()
+
+        time.sleep(self.MTIME_TICK)
+
+        file_to_create = join(wd, "dir1", "d.txt")
+        with open(file_to_create, "wb") as fd:
+            fd.write(b"a" * 40)
+
+        with mock.patch.object(scanner, "_list_dir", wraps=scanner._list_dir) as list_dir:
+            f_diff = c.scan()
+
+        self.assertEqual([mock.call(join(wd, "dir1"), None)], list_dir.call_args_list)
+        self.assertEqual([_file_state_from_file_path(file_to_create)], f_diff.created)
+        self.assertEqual([], f_diff.deleted)
+        self.assertEqual([], f_diff.updated)
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20}})
+    def test_update_in_unchanged_dir(self, wd):
+        c = SimpleComparator(wd, incremental=True)
+
+        file_to_update = join(wd, "dir1", "b.txt")
+
+        c.scan()
+
+        expected_updated_file_state_before = _file_state_from_file_path(file_to_update)
+
+        time.sleep(1)
+
+        with open(file_to_update, "wb") as fd:
+            fd.write(b"\0" * 25)
+
+        f_diff = c.scan()
+
+        self.assertEqual(
+            [FileDiff(
+                before=expected_updated_file_state_before,
+                after=_file_state_from_file_path(file_to_update),
+            )],
+            f_diff.updated
+        )
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20}, "dir2": {"c.txt": 30}})
+    def test_fast_mode_does_not_stat_files_in_unchanged_dirs(self, wd):
+        c = SimpleComparator(wd, fast=True)
+        c.scan()
+
+        time.sleep(1)
+
+        with open(join(wd, "dir2", "c.txt"), "wb") as fd:
+            fd.write(b"\0" * 35)
+
+        file_to_delete = join(wd, "dir1", "b.txt")
+        expected_deleted_file_state = _file_state_from_file_path(file_to_delete)
+        os.remove(file_to_delete)
+
+        f_diff = c.scan()
+
+        self.assertEqual([expected_deleted_file_state], f_diff.deleted)
+        self.assertEqual([], f_diff.updated)
+        self.assertEqual([], f_diff.created)
+
+    @with_file_structure({"a.txt": 10, "dir1": {"dir2": {"b.txt": 20}}})
+    def test_deleted_dir(self, wd):
+        c = SimpleComparator(wd, incremental=True)
+        c.scan()
+
+        file_to_delete = join(wd, "dir1", "dir2", "b.txt")
+        expected_deleted_file_state = _file_state_from_file_path(file_to_delete)
+
+        time.sleep(self.MTIME_TICK)
+
+        os.remove(file_to_delete)
+        os.rmdir(join(wd, "dir1", "dir2"))
+
+        f_diff = c.scan()
+
+        self.assertEqual([expected_deleted_file_state], f_diff.deleted)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+import os
+import tempfile
+from os.path import join
+
+from tests.util import with_file_structure
+
+# noinspection PyProtectedMember
+from fspy.agent.scanner import scandir_snapshot, walk_snapshot, _file_state_from_file_path
+from fspy.agent.snapshot import Snapshot, datetime_from_ns, save_snapshot, load_snapshot
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def test_datetime_from_ns(self):
+        self.assertEqual(
+            datetime_from_ns(1535900028070242999).isoformat(),
+            "2018-09-02T14:53:48.070242+00:00"
+        )
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20}})
+    def test_lookup(self, wd):
+        s = scandir_snapshot(wd)
+
+        self.assertEqual(2, len(s))
+        self.assertIn(join(wd, "dir1", "b.txt"), s)
+        self.assertNotIn(join(wd, "dir1", "c.txt"), s)
+        self.assertEqual(_file_state_from_file_path(join(wd, "a.txt")), s.get(join(wd, "a.txt")))
+        self.assertEqual(("b.txt",), s.file_names(join(wd, "dir1")))
+        self.assertEqual((join(wd, "dir1"),), s.dir_state(wd).sub_dirs)
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20}})
+    def test_set_and_remove(self, wd):
+        s = scandir_snapshot(wd)
+        file_path = join(wd, "a.txt")
+
+        self.assertFalse(s.set_file(wd, "a.txt", os.stat(file_path)))
+
+        with open(file_path, "ab") as fd:
+            fd.write(b"\0")
+
+        self.assertTrue(s.set_file(wd, "a.txt", os.stat(file_path)))
+        self.assertEqual(11, s.get(file_path).size)
+
+        self.assertTrue(s.remove_file(wd, "a.txt"))
+        self.assertFalse(s.remove_file(wd, "a.txt"))
+        self.assertEqual(1, len(s))
+
+        s.remove_dir(join(wd, "dir1"))
+        self.assertEqual(0, len(s))
+        self.assertEqual({}, s.to_dict())
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20, "dir2": {"c.txt": 30}}})
+    def test_diff(self, wd):
+        old = scandir_snapshot(wd)
+        old_dict = walk_snapshot(wd)
+
+        os.remove(join(wd, "dir1", "dir2", "c.txt"))
+        os.rmdir(join(wd, "dir1", "dir2"))
+        with open(join(wd, "dir1", "b.txt"), "ab") as fd:
+            fd.write(b"\0")
+        os.makedirs(join(wd, "dir3"))
+        with open(join(wd, "dir3", "d.txt"), "wb") as fd:
+            fd.write(b"\0")
+
+        created, deleted, updated = old.diff(scandir_snapshot(wd))
+
+        self.assertEqual([_file_state_from_file_path(join(wd, "dir3", "d.txt"))], created)
+        self.assertEqual([old_dict[join(wd, "dir1", "dir2", "c.txt")]], deleted)
+        self.assertEqual([join(wd, "dir1", "b.txt")], [fd.after.path for fd in updated])
+        self.assertEqual(old_dict[join(wd, "dir1", "b.txt")], updated[0].before)
+
+    def test_empty(self):
+        self.assertEqual(([], [], []), Snapshot().diff(Snapshot()))
+
+
+class SnapshotFileTests(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory(prefix="fspy-tests")
+        self.snapshot_path = join(self.state_dir.name, "snapshot.bin")
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    @with_file_structure({"a.txt": 10, "dir1": {"b.txt": 20, "dir2": {"c.txt": 30}}, "dir3": {}})
+    def test_round_trip(self, wd):
+        s = scandir_snapshot(wd)
+        s.remove_file(wd, "a.txt")
+
+        save_snapshot(s, self.snapshot_path, wd)
+        loaded = load_snapshot(self.snapshot_path, wd)
+
+        self.assertEqual(s.to_dict(), loaded.to_dict())
+        self.assertEqual(2, len(loaded))
+        for dir_path in s.dir_paths():
+            self.assertEqual(s.dir_state(dir_path), loaded.dir_state(dir_path))
+
+        self.assertEqual(([], [], []), s.diff(loaded))
+
+    @with_file_structure({"a.txt": 10})
+    def test_unusable_files(self, wd):
+        self.assertIsNone(load_snapshot(self.snapshot_path, wd))
+
+        save_snapshot(scandir_snapshot(wd), self.snapshot_path, wd)
+        self.assertIsNone(load_snapshot(self.snapshot_path, join(wd, "other")))
+
+        with open(self.snapshot_path, "r+b") as fd:
+            fd.seek(-1, os.SEEK_END)
+            fd.write(b"?")
+
+        self.assertIsNone(load_snapshot(self.snapshot_path, wd))
+
+        with open(self.snapshot_path, "wb"):
+            pass
+
+        self.assertIsNone(load_snapshot(self.snapshot_path, wd))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+
+import tempfile
+from os import path
+
+from sqlalchemy.exc import OperationalError
+
+from fspy.collector import db
+from fspy.collector.storage import create_write_engine, create_read_engine
+
+
+class StorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory(prefix="fspy-tests")
+        self.db_path = path.join(self.temp_directory.name, "fspy tests.sqlite")
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.dispose()
+        self.temp_directory.cleanup()
+
+    def write_engine(self, **kwargs):
+        engine = create_write_engine(self.db_path, **kwargs)
+        db.Base.metadata.create_all(engine)
+        self.engines.append(engine)
+        return engine
+
+    def read_engine(self):
+        engine = create_read_engine(self.db_path, pool_size=2)
+        self.engines.append(engine)
+        return engine
+
+    def insert_report(self, engine, source_name: str):
+        engine.execute(db.DiffReport.__table__.insert().values(source_name=source_name))
+
+    def test_pragmas(self):
+        engine = self.write_engine(synchronous="FULL", wal_autocheckpoint=10)
+
+        self.assertEqual("wal", engine.execute("PRAGMA journal_mode").scalar())
+        self.assertEqual(2, engine.execute("PRAGMA synchronous").scalar())
+        self.assertEqual(10, engine.execute("PRAGMA wal_autocheckpoint").scalar())
+
+    def test_no_wal(self):
+        self.write_engine().dispose()
+
+        self.assertEqual("delete", self.write_engine(wal=False).execute("PRAGMA journal_mode").scalar())
+
+    def test_unknown_synchronous(self):
+        with self.assertRaises(ValueError):
+            create_write_engine(self.db_path, synchronous="SOMETIMES")
+
+    def test_read_only(self):
+        self.write_engine()
+
+        with self.assertRaises(OperationalError):
+            self.insert_report(self.read_engine(), "reader")
+
+    def test_reader_does_not_block_writer(self):
+        write_engine = self.write_engine()
+        for i in range(10):
+            self.insert_report(write_engine, f"agent-{i}")
+
+        with self.read_engine().connect() as connection:
+            # Unfinished statement holds read snapshot, like long report query
+            result = connection.execute(db.DiffReport.__table__.select())
+            self.assertIsNotNone(result.fetchone())
+
+            self.insert_report(write_engine, "agent-10")
+
+            self.assertEqual(9, len(result.fetchall()))
+            result.close()
+
+            self.assertEqual(11, connection.execute("SELECT count(*) FROM diff_reports").scalar())
+
+
+if __name__ == '__main__':
+    unittest.main()
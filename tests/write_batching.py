@@ -0,0 +1,180 @@
+import unittest
+
+import asyncio
+import tempfile
+from os import path
+from datetime import datetime
+
+import pytz
+from sqlalchemy import create_engine, event, pool
+from sqlalchemy.orm import Session
+
+from fspy.collector import db
+from fspy.collector.writing_thread import WriteThreadManager, WriteQueueFull
+from fspy.common.records import ReportRecord, ChunkRecord, DiffRecord, FileRecord, FileDiffRecord
+
+
+def _diff(*paths, size=1) -> DiffRecord:
+    now = datetime(2018, 9, 2, 14, 53, 48, tzinfo=pytz.utc)
+    return DiffRecord(run_start=now, run_end=now, deleted=[], updated=[],
+                      created=[FileRecord(path=p, date_created=now, date_updated=now, size=size) for p in paths])
+
+
+class WriteBatchingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory(prefix="fspy-tests")
+        self.engine = create_engine(f"sqlite:///{path.join(self.temp_directory.name, 'fspy-tests.sqlite')}",
+                                    poolclass=pool.SingletonThreadPool)
+        db.Base.metadata.create_all(self.engine)
+
+        self.commits = 0
+
+        def on_commit(_):
+            self.commits += 1
+
+        event.listen(self.engine, "commit", on_commit)
+
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.engine.dispose()
+        self.temp_directory.cleanup()
+
+    def save_all(self, items, batch_size=100, batch_delay=0.2):
+        manager = WriteThreadManager(loop=self.loop, batch_size=batch_size, batch_delay=batch_delay)
+        manager.run_worker(self.engine)
+
+        async def run():
+            try:
+                return await asyncio.gather(*[manager.save(item) for item in items], loop=self.loop,
+                                            return_exceptions=True)
+            finally:
+                await manager.close()
+
+        return self.loop.run_until_complete(run())
+
+    def saved_paths(self):
+        session = Session(bind=self.engine)
+        result = sorted(file_path for file_path, in session.query(db.FileDiff.file_path))
+        session.close()
+        return result
+
+    def test_group_commit(self):
+        results = self.save_all([ReportRecord(source_name="agent", diff=_diff(f"/data/{i}.log")) for i in range(10)])
+
+        self.assertEqual([None] * 10, results)
+        self.assertEqual(1, self.commits)
+        self.assertEqual([f"/data/{i}.log" for i in range(10)], self.saved_paths())
+
+    def test_batch_size(self):
+        self.save_all([ReportRecord(source_name="agent", diff=_diff(f"/data/{i}.log")) for i in range(10)],
+                      batch_size=4)
+
+        self.assertEqual(3, self.commits)
+
+    def test_chunks_of_one_scan(self):
+        def chunk(chunk_index):
+            return ChunkRecord(source_name="agent", scan_id="scan-1", chunk_index=chunk_index, last=chunk_index == 2,
+                               diff=_diff(f"/data/{chunk_index}.log"))
+
+        # Retransmitted chunk in the same batch is skipped
+        self.save_all([chunk(0), chunk(1), chunk(1), chunk(2)])
+
+        session = Session(bind=self.engine)
+        diff_report = session.query(db.DiffReport).one()
+        self.assertEqual((3, 3, True), (diff_report.chunks_received, diff_report.chunks_total, diff_report.complete))
+        session.close()
+
+        self.assertEqual(["/data/0.log", "/data/1.log", "/data/2.log"], self.saved_paths())
+
+    def test_failures_per_task(self):
+        results = self.save_all([
+            ReportRecord(source_name="agent", diff=_diff("/data/0.log")),
+            # Fails on insert
+            ReportRecord(source_name="agent", diff=_diff("/data/1.log", size=object())),
+            ReportRecord(source_name="agent", diff=_diff("/data/2.log")),
+            "unknown data",
+            ReportRecord(source_name="agent", diff=_diff("/data/3.log")),
+        ])
+
+        self.assertEqual([None, None], [results[0], results[2]])
+        self.assertIsInstance(results[1], Exception)
+        self.assertIsInstance(results[3], ValueError)
+        self.assertIsNone(results[4])
+
+        self.assertEqual(["/data/0.log", "/data/2.log", "/data/3.log"], self.saved_paths())
+
+    def test_queue_full(self):
+        manager = WriteThreadManager(loop=self.loop, queue_size=2)
+        reports = [ReportRecord(source_name="agent", diff=_diff(f"/data/{i}.log")) for i in range(3)]
+
+        async def run():
+            # Writing thread is not running yet, so tasks stay in queue
+            saves = [asyncio.ensure_future(manager.save(report), loop=self.loop) for report in reports[:2]]
+            await asyncio.sleep(0, loop=self.loop)
+
+            with self.assertRaises(WriteQueueFull):
+                await manager.save(reports[2])
+
+            manager.run_worker(self.engine)
+            await asyncio.gather(*saves, loop=self.loop)
+            await manager.close()
+
+        self.loop.run_until_complete(run())
+
+        self.assertEqual((2, 1), (manager.queue_gauge.high_watermark, manager.queue_gauge.rejected))
+        self.assertEqual(["/data/0.log", "/data/1.log"], self.saved_paths())
+
+
+class BulkInsertTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        db.Base.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_insert_diff_report(self):
+        now = datetime(2018, 9, 2, 14, 53, 48, tzinfo=pytz.utc)
+
+        def file_record(p, size, content_hash=None):
+            return FileRecord(path=p, date_created=now, date_updated=now, size=size, content_hash=content_hash)
+
+        report = ReportRecord(source_name="agent", diff=DiffRecord(
+            run_start=now,
+            run_end=now,
+            created=[file_record("/data/a.log", 1, "aa")],
+            deleted=[file_record("/data/b.log", 2)],
+            updated=[FileDiffRecord(before=file_record("/data/c.log", 3, "cc"),
+                                    after=file_record("/data/c.log", 4, "dd"))],
+        ))
+
+        session = Session(bind=self.engine)
+        diff_report_id = db.insert_diff_report(session, report, source_ip="10.0.0.1")
+        session.commit()
+
+        # SQLite does not keep timezone
+        naive_now = now.replace(tzinfo=None)
+
+        r = session.query(db.DiffReport).one()
+        self.assertEqual(diff_report_id, r.id)
+        self.assertEqual(("agent", "10.0.0.1", naive_now, naive_now, 1, 1, True),
+                         (r.source_name, r.source_ip, r.run_start, r.run_end, r.chunks_received, r.chunks_total,
+                          r.complete))
+
+        self.assertEqual([
+            ("/data/a.log", db.OperationsEnum.CREATE, None, 1, None, "aa", naive_now),
+            ("/data/b.log", db.OperationsEnum.DELETE, 2, None, None, None, naive_now),
+            ("/data/c.log", db.OperationsEnum.UPDATE, 3, 4, "cc", "dd", naive_now),
+        ], [(d.file_path, d.operation, d.size_before, d.size_after, d.hash_before, d.hash_after, d.operation_time)
+            for d in session.query(db.FileDiff).filter(db.FileDiff.diff_report_id == diff_report_id)
+            .order_by(db.FileDiff.file_path)])
+
+        session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()